@@ -1,8 +1,15 @@
 """
 edX API classes which call edX service REST API endpoints using the edx-rest-api-client module.
 """
+import asyncio
+import fcntl
+import json
 import logging
+import os
+import threading
 from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import partial, wraps
 
 import backoff
 from requests.exceptions import ConnectionError
@@ -16,6 +23,11 @@ LOG = logging.getLogger(__name__)
 
 OAUTH_ACCESS_TOKEN_URL = "/oauth2/access_token"
 
+# Clients get a new access token when theirs is this close to expiring. Cached access tokens
+# are replaced sooner, once half of their lifetime has passed, so that a job that gets one from
+# the cache can use it for a good while before it needs a new one.
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+
 
 class EdxGatewayTimeoutError(Exception):
     """
@@ -30,14 +42,38 @@ class BaseApiClient:
     """
     append_slash = True
     _client = None
+    _access_token = None
+    _access_token_expires_at = None
+    _fetch_access_token = None
 
-    def __init__(self, lms_base_url, api_base_url, client_id, client_secret):
+    def __init__(self, lms_base_url, api_base_url, client_id, client_secret, token_cache=None):
         """
-        Retrieves OAuth access token from the LMS and creates REST API client instance.
+        Retrieves OAuth access token from the LMS (or `token_cache`, an AccessTokenCache, if
+        given) and creates REST API client instance.
         """
         self.api_base_url = api_base_url
-        access_token, __ = self.get_access_token(lms_base_url, client_id, client_secret)
-        self.create_client(access_token)
+        if token_cache is None:
+            self._fetch_access_token = lambda rejected: self.get_access_token(lms_base_url, client_id, client_secret)
+        else:
+            self._fetch_access_token = partial(
+                token_cache.get_access_token, lms_base_url, client_id, client_secret, self.get_access_token
+            )
+        self.refresh_access_token()
+
+    def access_token_expiring(self):
+        """
+        Is the client's access token expired, or about to expire?
+        """
+        return self._access_token_expires_at is not None and \
+            self._access_token_expires_at - TOKEN_REFRESH_MARGIN <= datetime.utcnow()
+
+    def refresh_access_token(self, rejected=None):
+        """
+        Retrieves a new OAuth access token (replacing `rejected`, a token the service refused, if
+        given) and recreates the REST API client with it.
+        """
+        self._access_token, self._access_token_expires_at = self._fetch_access_token(rejected=rejected)
+        self.create_client(self._access_token)
 
     def create_client(self, access_token):
         """
@@ -70,6 +106,133 @@ class BaseApiClient:
             raise
 
 
+class AccessTokenCache:
+    """
+    Caches OAuth access tokens by (OAuth URL, client ID) until half of their
+    lifetime has passed (or they're within `refresh_margin` of expiring, if
+    that's sooner), so that clients for different services can share one token
+    instead of each asking the LMS for its own.
+
+    With `path`, the tokens are also kept in that JSON file, which is locked
+    while a token is looked up or fetched. Every process using the same file
+    (e.g. retirement jobs running on the same worker) then shares the tokens
+    too, and only one of them asks the LMS for a new token when it expires.
+    """
+    def __init__(self, path=None, refresh_margin=TOKEN_REFRESH_MARGIN, clock=datetime.utcnow):
+        self.path = path
+        self.refresh_margin = refresh_margin
+        self._clock = clock
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def get_access_token(self, oauth_base_url, client_id, client_secret, fetch, rejected=None):
+        """
+        Returns an access token and expiration date (in UTC) for the client,
+        calling `fetch` (e.g. BaseApiClient.get_access_token) with the same
+        arguments if there isn't one that's fresh enough, or if the cached one
+        is `rejected` (i.e. a service refused it). Tokens without an
+        expiration date aren't cached.
+
+        Returns:
+            (str, datetime)
+        """
+        key = '{} {}'.format(oauth_base_url, client_id)
+        with self._lock:
+            if self._is_fresh(self._tokens.get(key), rejected):
+                return self._tokens[key][:2]
+            if self.path is None:
+                return self._remember(key, self._fetch(fetch, oauth_base_url, client_id, client_secret))[:2]
+
+            with self._locked_file():
+                tokens = self._read_file()
+                if self._is_fresh(tokens.get(key), rejected):
+                    return self._remember(key, tokens[key])[:2]
+
+                tokens[key] = self._remember(key, self._fetch(fetch, oauth_base_url, client_id, client_secret))
+                if tokens[key][1] is not None:
+                    self._write_file(tokens)
+                return tokens[key][:2]
+
+    def _fetch(self, fetch, *args):
+        """
+        Call `fetch`, returning the (access token, expiration date, fetch date) tuple that's cached.
+        """
+        fetched_at = self._clock()
+        access_token, expires_at = fetch(*args)
+        return access_token, expires_at, fetched_at
+
+    def _is_fresh(self, token, rejected=None):
+        """
+        Is this (access token, expiration date, fetch date) tuple good for a while yet?
+        """
+        if token is None or token[1] is None or token[0] == rejected:
+            return False
+        expires_at, fetched_at = token[1], token[2]
+        return expires_at - max(self.refresh_margin, (expires_at - fetched_at) / 2) > self._clock()
+
+    def _remember(self, key, token):
+        """
+        Keep `token` in memory if it can be cached, and return it.
+        """
+        if token[1] is not None:
+            self._tokens[key] = token
+        return token
+
+    @contextmanager
+    def _locked_file(self):
+        """
+        Hold an exclusive lock on the token file (using a separate lock file,
+        since the token file itself is replaced when it's written).
+        """
+        with open(self.path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_file(self):
+        """
+        Returns the (access token, expiration date, fetch date) tuples in the
+        file by key, ignoring the file if it's missing or unreadable.
+        """
+        try:
+            with open(self.path, 'r') as tokens_file:
+                return {
+                    key: (
+                        str(token['access_token']),
+                        datetime.fromisoformat(token['expires_at']),
+                        datetime.fromisoformat(token['fetched_at']),
+                    )
+                    for key, token in json.load(tokens_file).items()
+                }
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError, KeyError, TypeError, AttributeError) as exc:
+            LOG.warning("Ignoring unreadable access token cache %s: %s", self.path, exc)
+            return {}
+
+    def _write_file(self, tokens):
+        """
+        Replace the file with the cacheable `tokens`, readable only by the current user.
+        """
+        temp_path = self.path + '.tmp'
+        with os.fdopen(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as tokens_file:
+            json.dump(
+                {
+                    key: {
+                        'access_token': access_token,
+                        'expires_at': expires_at.isoformat(),
+                        'fetched_at': fetched_at.isoformat(),
+                    }
+                    for key, (access_token, expires_at, fetched_at) in tokens.items()
+                    if expires_at is not None
+                },
+                tokens_file
+            )
+        os.replace(temp_path, self.path)
+
+
 def _backoff_handler(details):
     """
     Simple logging handler for when timeout backoff occurs.
@@ -125,10 +288,56 @@ def _retry_lms_api():
             # to patch it in tests.
             on_backoff=lambda details: _backoff_handler(details)  # pylint: disable=unnecessary-lambda
         )
-        return func_with_backoff(func_with_timeout_backoff(func))
+        return func_with_backoff(func_with_timeout_backoff(_with_fresh_access_token(func)))
     return inner
 
 
+def _is_unauthorized(exc):
+    """
+    Was the request refused with a 401 Unauthorized, e.g. because the access token has expired?
+    """
+    return isinstance(exc, HttpClientError) and getattr(getattr(exc, 'response', None), 'status_code', None) == 401
+
+
+def _with_fresh_access_token(func):
+    """
+    Decorator for client methods that gets the client a new access token before the call if its
+    token is expiring, and again if the call is refused with a 401 Unauthorized anyway, so that a
+    client can be used for longer than its access token lasts. Works with coroutines too, for
+    edx_api_async, whose clients' refresh_access_token is a coroutine as well.
+    """
+    if asyncio.iscoroutinefunction(func):
+        @wraps(func)
+        async def coroutine_with_fresh_access_token(self, *args, **kwargs):
+            if self.access_token_expiring():
+                await self.refresh_access_token()
+            access_token = self._access_token  # pylint: disable=protected-access
+            try:
+                return await func(self, *args, **kwargs)
+            except HttpClientError as err:
+                if not _is_unauthorized(err) or self._fetch_access_token is None:  # pylint: disable=protected-access
+                    raise
+            LOG.info('Access token refused, retrying {} with a new one'.format(func.__name__))
+            await self.refresh_access_token(rejected=access_token)
+            return await func(self, *args, **kwargs)
+        return coroutine_with_fresh_access_token
+
+    @wraps(func)
+    def with_fresh_access_token(self, *args, **kwargs):
+        if self.access_token_expiring():
+            self.refresh_access_token()
+        access_token = self._access_token  # pylint: disable=protected-access
+        try:
+            return func(self, *args, **kwargs)
+        except HttpClientError as err:
+            if not _is_unauthorized(err) or self._fetch_access_token is None:  # pylint: disable=protected-access
+                raise
+        LOG.info('Access token refused, retrying {} with a new one'.format(func.__name__))
+        self.refresh_access_token(rejected=access_token)
+        return func(self, *args, **kwargs)
+    return with_fresh_access_token
+
+
 @contextmanager
 def correct_exception(log_404_as_error=True):
     """
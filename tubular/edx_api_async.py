@@ -0,0 +1,534 @@
+"""
+asyncio versions of the edX API classes in edx_api, so that one process can have hundreds of
+retirement calls in flight without a thread for each.
+
+The clients have the same methods as their edx_api counterparts (as coroutines), with the same
+retries (_retry_lms_api, including the one minute wait after a 504 Gateway Timeout) and the same
+exceptions (slumber's HttpClientError, HttpNotFoundError and HttpServerError, and requests'
+ConnectionError), so code that handles errors from one handles errors from the other. Requests are
+made with aiohttp, through a ClientSession from create_session() that all of the clients share, so
+connections to each service are pooled and kept alive between calls:
+
+    async with create_session(limit=200) as session:
+        lms = await AsyncLmsApi.create(lms_base_url, lms_base_url, client_id, client_secret, session)
+        ecommerce = await AsyncEcommerceApi.create(lms_base_url, ecommerce_base_url, client_id, client_secret,
+                                                   session)
+        await asyncio.gather(*(lms.retirement_retire_forum(learner) for learner in learners))
+"""
+import asyncio
+import json
+import logging
+from collections import namedtuple
+from datetime import datetime
+from functools import partial
+
+import aiohttp
+from requests.exceptions import ConnectionError  # pylint: disable=redefined-builtin
+from slumber.exceptions import HttpClientError, HttpNotFoundError, HttpServerError
+from slumber.utils import url_join
+
+from tubular.edx_api import TOKEN_REFRESH_MARGIN, BaseApiClient, _retry_lms_api, correct_exception
+
+LOG = logging.getLogger(__name__)
+
+# Default maximum number of connections a session keeps open, across all services.
+DEFAULT_CONNECTION_LIMIT = 100
+
+# Just enough of a requests Response for correct_exception and _retry_lms_api.
+AsyncResponse = namedtuple('AsyncResponse', 'status_code content headers')
+
+
+def create_session(limit=DEFAULT_CONNECTION_LIMIT, limit_per_host=0, timeout=None):
+    """
+    Create an aiohttp ClientSession for the clients to share, which keeps up
+    to `limit` connections open (and up to `limit_per_host` to each service,
+    if not 0). `timeout` is the total number of seconds a request can take, or
+    None to wait as long as it takes, as the edx_api clients do.
+    """
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=limit, limit_per_host=limit_per_host),
+        timeout=aiohttp.ClientTimeout(total=timeout),
+    )
+
+
+def _query_params(params):
+    """
+    Turn keyword arguments into query parameters the way requests does, with
+    one parameter for each item of a list.
+    """
+    query = []
+    for key, value in params.items():
+        for item in (value if isinstance(value, (list, tuple)) else [value]):
+            query.append((key, item if isinstance(item, str) else str(item)))
+    return query
+
+
+class AsyncResource:
+    """
+    asyncio version of the slumber Resource that edx_api clients make calls
+    through, e.g. `await client.api.user.v1.accounts(username).retirement_status.get()`.
+    Data is sent and received as JSON, with the access token as a JWT.
+    """
+    def __init__(self, session, base_url, access_token, append_slash=True):
+        self._session = session
+        self._base_url = base_url
+        self._access_token = access_token
+        self._append_slash = append_slash
+
+    def __getattr__(self, item):
+        if item.startswith('_'):
+            raise AttributeError(item)
+        return self(item)
+
+    def __call__(self, item):
+        return AsyncResource(self._session, url_join(self._base_url, item), self._access_token, self._append_slash)
+
+    def url(self):
+        """
+        The URL of this resource.
+        """
+        if self._append_slash and not self._base_url.endswith('/'):
+            return self._base_url + '/'
+        return self._base_url
+
+    async def get(self, **kwargs):  # pylint: disable=missing-function-docstring
+        return await self._request('GET', params=kwargs)
+
+    async def post(self, data=None, **kwargs):  # pylint: disable=missing-function-docstring
+        return await self._request('POST', data=data, params=kwargs)
+
+    async def patch(self, data=None, **kwargs):  # pylint: disable=missing-function-docstring
+        return await self._request('PATCH', data=data, params=kwargs)
+
+    async def put(self, data=None, **kwargs):  # pylint: disable=missing-function-docstring
+        return await self._request('PUT', data=data, params=kwargs)
+
+    async def delete(self, **kwargs):  # pylint: disable=missing-function-docstring
+        await self._request('DELETE', params=kwargs)
+        return True
+
+    async def _request(self, method, data=None, params=None):
+        """
+        Make the request, raising the same exceptions that slumber does for 4xx
+        and 5xx responses, and return the decoded response.
+        """
+        url = self.url()
+        headers = {
+            'accept': 'application/json',
+            'content-type': 'application/json',
+            'Authorization': 'JWT {}'.format(self._access_token),
+        }
+        try:
+            async with self._session.request(
+                method,
+                url,
+                params=_query_params(params or {}),
+                data=json.dumps(data) if data is not None else None,
+                headers=headers,
+            ) as resp:
+                response = AsyncResponse(resp.status, await resp.read(), resp.headers)
+        except aiohttp.ClientConnectionError as exc:
+            # Retried like a requests ConnectionError.
+            raise ConnectionError(str(exc)) from exc
+
+        if 400 <= response.status_code <= 499:
+            exception_class = HttpNotFoundError if response.status_code == 404 else HttpClientError
+            raise exception_class(
+                "Client Error {}: {}".format(response.status_code, url), response=response, content=response.content
+            )
+        if 500 <= response.status_code <= 599:
+            raise HttpServerError(
+                "Server Error {}: {}".format(response.status_code, url), response=response, content=response.content
+            )
+        return self._decode(response)
+
+    @staticmethod
+    def _decode(response):
+        """
+        Decode a JSON response, returning anything else as it is, as slumber does.
+        """
+        if response.status_code in (204, 205):
+            return None
+        content_type = response.headers.get('content-type', '').split(';')[0].strip()
+        if response.content and content_type == 'application/json':
+            try:
+                return json.loads(response.content.decode('utf-8'))
+            except ValueError:
+                return response.content
+        return response.content
+
+
+class AsyncBaseApiClient:
+    """
+    asyncio API client base class used to submit API requests to a particular web service.
+    """
+    append_slash = True
+    _client = None
+    _access_token = None
+    _access_token_expires_at = None
+
+    def __init__(self, api_base_url, access_token, session, expires_at=None, fetch_access_token=None):
+        """
+        Creates the client with an OAuth access token (see `create`) and an aiohttp ClientSession.
+        With `fetch_access_token`, which `create` passes, the client gets itself a new access token
+        when `expires_at` draws near or the token is refused, as edx_api clients do.
+        """
+        self.api_base_url = api_base_url
+        self._session = session
+        self._fetch_access_token = fetch_access_token
+        self._set_access_token(access_token, expires_at)
+
+    @classmethod
+    async def create(cls, lms_base_url, api_base_url, client_id, client_secret, session, token_cache=None):
+        """
+        Retrieves OAuth access token from the LMS (or `token_cache`, an AccessTokenCache, if
+        given) and creates the client. The token is fetched in a thread, as edx_api does it.
+        """
+        if token_cache is None:
+            def fetch_access_token(rejected=None):  # pylint: disable=unused-argument
+                return BaseApiClient.get_access_token(lms_base_url, client_id, client_secret)
+        else:
+            fetch_access_token = partial(
+                token_cache.get_access_token, lms_base_url, client_id, client_secret, BaseApiClient.get_access_token
+            )
+        access_token, expires_at = await asyncio.get_event_loop().run_in_executor(None, fetch_access_token)
+        return cls(api_base_url, access_token, session, expires_at, fetch_access_token)
+
+    def access_token_expiring(self):
+        """
+        Is the client's access token expired, or about to expire?
+        """
+        return self._fetch_access_token is not None and self._access_token_expires_at is not None and \
+            self._access_token_expires_at - TOKEN_REFRESH_MARGIN <= datetime.utcnow()
+
+    async def refresh_access_token(self, rejected=None):
+        """
+        Retrieves a new OAuth access token (replacing `rejected`, a token the service refused, if
+        given) in a thread, and makes requests with it from then on.
+        """
+        self._set_access_token(*await asyncio.get_event_loop().run_in_executor(
+            None, partial(self._fetch_access_token, rejected=rejected)
+        ))
+
+    def _set_access_token(self, access_token, expires_at):
+        """
+        Make requests with `access_token` from now on.
+        """
+        self._access_token = access_token
+        self._access_token_expires_at = expires_at
+        self._client = AsyncResource(self._session, self.api_base_url, access_token, self.append_slash)
+
+
+class AsyncLmsApi(AsyncBaseApiClient):
+    """
+    asyncio LMS API client with convenience methods for making API calls.
+    """
+    @_retry_lms_api()
+    async def learners_to_retire(self, states_to_request, cool_off_days=7):
+        """
+        Retrieves a list of learners awaiting retirement actions.
+        """
+        params = {
+            'cool_off_days': cool_off_days,
+            'states': states_to_request
+        }
+        with correct_exception():
+            return await self._client.api.user.v1.accounts.retirement_queue.get(**params)
+
+    @_retry_lms_api()
+    async def get_learners_by_date_and_status(self, state_to_request, start_date, end_date):
+        """
+        Retrieves a list of learners in the given retirement state that were
+        created in the retirement queue between the dates given. Date range
+        is inclusive, so to get one day you would set both dates to that day.
+
+        :param state_to_request: String LMS UserRetirementState state name (ex. COMPLETE)
+        :param start_date: Date or Datetime object
+        :param end_date: Date or Datetime
+        """
+        params = {
+            'start_date': start_date.strftime('%Y-%m-%d'),
+            'end_date': end_date.strftime('%Y-%m-%d'),
+            'state': state_to_request
+        }
+        with correct_exception():
+            return await self._client.api.user.v1.accounts.retirements_by_status_and_date.get(**params)
+
+    @_retry_lms_api()
+    async def get_learner_retirement_state(self, username):
+        """
+        Retrieves the given learner's retirement state.
+        """
+        with correct_exception():
+            return await self._client.api.user.v1.accounts(username).retirement_status.get()
+
+    @_retry_lms_api()
+    async def update_learner_retirement_state(self, username, new_state_name, message, force=False):
+        """
+        Updates the given learner's retirement state to the retirement state name new_string
+        with the additional string information in message (for logging purposes).
+        """
+        params = {
+            'data': {
+                'username': username,
+                'new_state': new_state_name,
+                'response': message
+            }
+        }
+
+        if force:
+            params['data']['force'] = True
+
+        with correct_exception():
+            return await self._client.api.user.v1.accounts.update_retirement_status.patch(**params)
+
+    @_retry_lms_api()
+    async def retirement_deactivate_logout(self, learner):
+        """
+        Performs the user deactivation and forced logout step of learner retirement
+        """
+        params = {'data': {'username': learner['original_username']}}
+        with correct_exception():
+            return await self._client.api.user.v1.accounts.deactivate_logout.post(**params)
+
+    @_retry_lms_api()
+    async def retirement_retire_forum(self, learner):
+        """
+        Performs the forum retirement step of learner retirement
+        """
+        # api/discussion/
+        params = {'data': {'username': learner['original_username']}}
+        try:
+            with correct_exception():
+                return await self._client.api.discussion.v1.accounts.retire_forum.post(**params)
+        except HttpNotFoundError:
+            return True
+
+    @_retry_lms_api()
+    async def retirement_retire_mailings(self, learner):
+        """
+        Performs the email list retirement step of learner retirement
+        """
+        params = {'data': {'username': learner['original_username']}}
+        with correct_exception():
+            return await self._client.api.user.v1.accounts.retire_mailings.post(**params)
+
+    @_retry_lms_api()
+    async def retirement_unenroll(self, learner):
+        """
+        Unenrolls the user from all courses
+        """
+        params = {'data': {'username': learner['original_username']}}
+        with correct_exception():
+            return await self._client.api.enrollment.v1.unenroll.post(**params)
+
+    # This endpoint additionally returns 500 when the EdxNotes backend service is unavailable.
+    @_retry_lms_api()
+    async def retirement_retire_notes(self, learner):
+        """
+        Deletes all the user's notes (aka. annotations)
+        """
+        params = {'data': {'username': learner['original_username']}}
+        with correct_exception():
+            return await self._client.api.edxnotes.v1.retire_user.post(**params)
+
+    @_retry_lms_api()
+    async def retirement_lms_retire_misc(self, learner):
+        """
+        Deletes, blanks, or one-way hashes personal information in LMS as
+        defined in EDUCATOR-2802 and sub-tasks.
+        """
+        params = {'data': {'username': learner['original_username']}}
+        with correct_exception():
+            return await self._client.api.user.v1.accounts.retire_misc.post(**params)
+
+    @_retry_lms_api()
+    async def retirement_lms_retire(self, learner):
+        """
+        Deletes, blanks, or one-way hashes all remaining personal information in LMS
+        """
+        params = {'data': {'username': learner['original_username']}}
+        with correct_exception():
+            return await self._client.api.user.v1.accounts.retire.post(**params)
+
+    @_retry_lms_api()
+    async def retirement_partner_queue(self, learner):
+        """
+        Calls LMS to add the given user to the retirement reporting queue
+        """
+        params = {'data': {'username': learner['original_username']}}
+        with correct_exception():
+            return await self._client.api.user.v1.accounts.retirement_partner_report.put(**params)
+
+    @_retry_lms_api()
+    async def retirement_partner_report(self):
+        """
+        Retrieves the list of users to create partner reports for and set their status to
+        processing
+        """
+        with correct_exception():
+            return await self._client.api.user.v1.accounts.retirement_partner_report.post()
+
+    @_retry_lms_api()
+    async def retirement_partner_cleanup(self, usernames):
+        """
+        Removes the given users from the partner reporting queue
+        """
+        params = {'data': usernames}
+        with correct_exception():
+            return await self._client.api.user.v1.accounts.retirement_partner_report_cleanup.post(**params)
+
+    @_retry_lms_api()
+    async def retirement_retire_proctoring_data(self, learner):
+        """
+        Deletes or hashes learner data from edx-proctoring
+        """
+        with correct_exception():
+            return await self._client.api.edx_proctoring.v1.retire_user(learner['user']['id']).post()
+
+    @_retry_lms_api()
+    async def retirement_retire_proctoring_backend_data(self, learner):
+        """
+        Removes the given learner from 3rd party proctoring backends
+        """
+        with correct_exception():
+            return await self._client.api.edx_proctoring.v1.retire_backend_user(learner['user']['id']).post()
+
+    @_retry_lms_api()
+    async def bulk_cleanup_retirements(self, usernames):
+        """
+        Deletes the retirements for all given usernames
+        """
+        params = {'data': {'usernames': usernames}}
+        with correct_exception():
+            return await self._client.api.user.v1.accounts.retirement_cleanup.post(**params)
+
+    async def replace_lms_usernames(self, username_mappings):
+        """
+        Calls LMS API to replace usernames.
+        Param:
+            username_mappings: list of dicts where key is current username and value is new desired username
+            [{current_un_1: desired_un_1}, {current_un_2: desired_un_2}]
+        """
+        request_data = {"username_mappings": username_mappings}
+        with correct_exception():
+            return await self._client.api.user.v1.accounts.replace_usernames.post(data=request_data)
+
+    async def replace_forums_usernames(self, username_mappings):
+        """
+        Calls the discussion forums API inside of LMS to replace usernames.
+        Param:
+            username_mappings: list of dicts where key is current username and value is new unique username
+            [{current_un_1: new_un_1}, {current_un_2: new_un_2}]
+        """
+        request_data = {"username_mappings": username_mappings}
+        with correct_exception():
+            return await self._client.api.discussion.v1.accounts.replace_usernames.post(data=request_data)
+
+
+class AsyncEcommerceApi(AsyncBaseApiClient):
+    """
+    asyncio Ecommerce API client with convenience methods for making API calls.
+    """
+    @_retry_lms_api()
+    async def retire_learner(self, learner):
+        """
+        Performs the learner retirement step for Ecommerce
+        """
+        params = {'data': {'username': learner['original_username']}}
+        with correct_exception():
+            return await self._client.api.v2.user.retire.post(**params)
+
+    @_retry_lms_api()
+    async def get_tracking_key(self, learner):
+        """
+        Fetches the ecommerce tracking id used for Segment tracking when
+        ecommerce doesn't have access to the LMS user id.
+        """
+        with correct_exception():
+            result = await self._client.api.v2.retirement.tracking_id(learner['original_username']).get()
+            return result['ecommerce_tracking_id']
+
+    async def replace_usernames(self, username_mappings):
+        """
+        Calls the ecommerce API to replace usernames.
+        Param:
+            username_mappings: list of dicts where key is current username and value is new unique username
+            [{current_un_1: new_un_1}, {current_un_2: new_un_2}]
+        """
+        request_data = {"username_mappings": username_mappings}
+        with correct_exception():
+            return await self._client.api.v2.user_management.replace_usernames.post(data=request_data)
+
+
+class AsyncCredentialsApi(AsyncBaseApiClient):
+    """
+    asyncio Credentials API client with convenience methods for making API calls.
+    """
+    @_retry_lms_api()
+    async def retire_learner(self, learner):
+        """
+        Performs the learner retirement step for Credentials
+        """
+        params = {'data': {'username': learner['original_username']}}
+        with correct_exception():
+            return await self._client.user.retire.post(**params)
+
+    async def replace_usernames(self, username_mappings):
+        """
+        Calls the credentials API to replace usernames.
+        Param:
+            username_mappings: list of dicts where key is current username and value is new unique username
+            [{current_un_1: new_un_1}, {current_un_2: new_un_2}]
+        """
+        request_data = {"username_mappings": username_mappings}
+        with correct_exception():
+            return await self._client.api.v2.replace_usernames.post(data=request_data)
+
+
+class AsyncDemographicsApi(AsyncBaseApiClient):
+    """
+    asyncio Demographics API client.
+    """
+    @_retry_lms_api()
+    async def retire_learner(self, learner):
+        """
+        Performs the learner retirement step for Demographics. Passes the learner's LMS User Id instead of username.
+        """
+        params = {'data': {'lms_user_id': learner['user']['id']}}
+        # If the user we are retiring has no data in the Demographics DB the request will return a 404. We
+        # catch the HttpNotFoundError and return True in order to prevent this error getting raised and
+        # incorrectly causing the learner to enter an ERROR state during retirement.
+        try:
+            with correct_exception(log_404_as_error=False):
+                return await self._client.demographics.api.v1.retire_demographics.post(**params)
+        except HttpNotFoundError:
+            LOG.info("No demographics data found for user")
+            return True
+
+
+class AsyncLicenseManagerApi(AsyncBaseApiClient):
+    """
+    asyncio License Manager API client.
+    """
+    @_retry_lms_api()
+    async def retire_learner(self, learner):
+        """
+        Performs the learner retirement step for License manager. Passes the learner's LMS User Id in addition to
+        username.
+        """
+        params = {
+            'data': {
+                'lms_user_id': learner['user']['id'],
+                'original_username': learner['original_username'],
+            },
+        }
+        # If the user we are retiring has no data in the License Manager DB the request will return a 404. We
+        # catch the HttpNotFoundError and return True in order to prevent this error getting raised and
+        # incorrectly causing the learner to enter an ERROR state during retirement.
+        try:
+            with correct_exception(log_404_as_error=False):
+                return await self._client.api.v1.retire_user.post(**params)
+        except HttpNotFoundError:
+            LOG.info("No license manager data found for user")
+            return True
@@ -21,12 +21,18 @@ from six import text_type
 # Add top-level module path to sys.path before importing tubular code.
 sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
 
-from tubular.edx_api import CredentialsApi, DemographicsApi, EcommerceApi, LicenseManagerApi, \
+from tubular.edx_api import AccessTokenCache, CredentialsApi, DemographicsApi, EcommerceApi, LicenseManagerApi, \
     LmsApi  # pylint: disable=wrong-import-position
 from tubular.braze_api import BrazeApi  # pylint: disable=wrong-import-position
 from tubular.segment_api import SegmentApi  # pylint: disable=wrong-import-position
 from tubular.salesforce_api import SalesforceApi  # pylint: disable=wrong-import-position
 from tubular.hubspot_api import HubspotAPI  # pylint: disable=wrong-import-position
+from tubular.utils.rate_limit import RateLimitedClient, ServiceLimiter  # pylint: disable=wrong-import-position
+
+# Config keys of the API clients set up by _setup_all_apis_or_exit
+RETIREMENT_SERVICES = (
+    'LMS', 'ECOMMERCE', 'CREDENTIALS', 'DEMOGRAPHICS', 'LICENSE_MANAGER', 'SEGMENT', 'BRAZE', 'HUBSPOT', 'SALESFORCE'
+)
 
 
 def _log(kind, message):
@@ -134,7 +140,9 @@ def _setup_lms_api_or_exit(fail_func, fail_code, config):
         client_id = config['client_id']
         client_secret = config['client_secret']
 
-        config['LMS'] = LmsApi(lms_base_url, lms_base_url, client_id, client_secret)
+        token_cache = AccessTokenCache(config['token_cache_file']) if config.get('token_cache_file') else None
+
+        config['LMS'] = LmsApi(lms_base_url, lms_base_url, client_id, client_secret, token_cache=token_cache)
     except Exception as exc:  # pylint: disable=broad-except
         fail_func(fail_code, text_type(exc))
 
@@ -181,7 +189,11 @@ def _setup_all_apis_or_exit(fail_func, fail_code, config):
                 if state[2] == service and service_url is None:
                     fail_func(fail_code, 'Service URL is not configured, but required for state {}'.format(state))
 
-        config['LMS'] = LmsApi(lms_base_url, lms_base_url, client_id, client_secret)
+        # The edX clients all get their access tokens from the LMS with the same credentials, so
+        # they can share one. With token_cache_file, so can every job on this machine.
+        token_cache = AccessTokenCache(config.get('token_cache_file'))
+
+        config['LMS'] = LmsApi(lms_base_url, lms_base_url, client_id, client_secret, token_cache=token_cache)
 
         if braze_api_key:
             config['BRAZE'] = BrazeApi(
@@ -207,13 +219,19 @@ def _setup_all_apis_or_exit(fail_func, fail_code, config):
             )
 
         if ecommerce_base_url:
-            config['ECOMMERCE'] = EcommerceApi(lms_base_url, ecommerce_base_url, client_id, client_secret)
+            config['ECOMMERCE'] = EcommerceApi(
+                lms_base_url, ecommerce_base_url, client_id, client_secret, token_cache=token_cache
+            )
 
         if credentials_base_url:
-            config['CREDENTIALS'] = CredentialsApi(lms_base_url, credentials_base_url, client_id, client_secret)
+            config['CREDENTIALS'] = CredentialsApi(
+                lms_base_url, credentials_base_url, client_id, client_secret, token_cache=token_cache
+            )
 
         if demographics_base_url:
-            config['DEMOGRAPHICS'] = DemographicsApi(lms_base_url, demographics_base_url, client_id, client_secret)
+            config['DEMOGRAPHICS'] = DemographicsApi(
+                lms_base_url, demographics_base_url, client_id, client_secret, token_cache=token_cache
+            )
 
         if license_manager_base_url:
             config['LICENSE_MANAGER'] = LicenseManagerApi(
@@ -221,6 +239,7 @@ def _setup_all_apis_or_exit(fail_func, fail_code, config):
                 license_manager_base_url,
                 client_id,
                 client_secret,
+                token_cache=token_cache,
             )
 
         if segment_base_url:
@@ -229,5 +248,30 @@ def _setup_all_apis_or_exit(fail_func, fail_code, config):
                 segment_auth_token,
                 segment_workspace_slug
             )
+
+        _apply_service_limits(config)
     except Exception as exc:  # pylint: disable=broad-except
         fail_func(fail_code, 'Unexpected error occurred!', exc)
+
+
+def _apply_service_limits(config):
+    """
+    Wraps the API clients named in the config's service_limits so that calls to each service are
+    limited to its requests_per_second and max_in_flight, e.g.:
+
+    service_limits:
+        ECOMMERCE:
+            requests_per_second: 5
+            max_in_flight: 2
+
+    Each client is shared by everything using the config, so the limits hold across all of the
+    learners being retired at once by retire_learners.py.
+    """
+    for service, settings in (config.get('service_limits') or {}).items():
+        if service not in RETIREMENT_SERVICES:
+            raise ValueError('Unknown service {} in service_limits, expected one of {}'.format(
+                service, ', '.join(RETIREMENT_SERVICES)
+            ))
+        if service not in config:
+            raise ValueError('Limits are configured for service {}, but it is not set up'.format(service))
+        config[service] = RateLimitedClient(config[service], ServiceLimiter.from_settings(settings))
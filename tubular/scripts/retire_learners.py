@@ -0,0 +1,241 @@
+#! /usr/bin/env python3
+"""
+Command-line script to drive the user retirement workflow for every learner in the retirement queue
+
+This does the work of get_learners_to_retire.py and one retire_one_learner.py run per learner in a
+single process: the API clients are set up once (getting themselves new access tokens as theirs
+expire), and learners are retired concurrently on a bounded pool of worker threads, with their
+retirement states run on another bounded pool that all of them share (see --state_workers). Each
+learner goes through exactly the same state transitions as with retire_one_learner.py, including
+being moved to ERRORED if a state fails. If a service refuses the access token even so, the rest of
+the queue would fail the same way, so no more learners are started and the run stops with an error.
+
+It takes the same YAML config file as retire_one_learner.py. Since many learners are retired at once,
+the config can also cap the calls made to each service (the third item of each retirement_pipeline
+state), shared by all of the workers:
+
+service_limits:
+    ECOMMERCE:
+        requests_per_second: 5
+        max_in_flight: 2
+    HUBSPOT:
+        requests_per_second: 1
+"""
+
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from os import path
+from time import time
+import logging
+import sys
+import threading
+
+import click
+from slumber.exceptions import HttpNotFoundError
+
+# Add top-level module path to sys.path before importing tubular code.
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from tubular.edx_api import _is_unauthorized
+from tubular.scripts.helpers import _config_or_exit, _fail, _fail_exception, _log, _setup_all_apis_or_exit
+from tubular.scripts.retire_one_learner import (
+    ERR_BAD_CONFIG,
+    ERR_SETUP_FAILED,
+    ERR_USER_AT_END_STATE,
+    ERR_USER_IN_WORKING_STATE,
+    ERR_WHILE_RETIRING,
+    START_STATE,
+    _config_retirement_pipeline,
+    _fetch_ecom_segment_id,
+    _get_learner_state_index,
+    _run_retirement_pipeline
+)
+
+# Return codes for fail cases not shared with retire_one_learner.py
+ERR_TOO_MANY_LEARNERS = -8
+
+SCRIPT_SHORTNAME = 'Learner Retirement'
+LOG = partial(_log, SCRIPT_SHORTNAME)
+FAIL = partial(_fail, SCRIPT_SHORTNAME)
+FAIL_EXCEPTION = partial(_fail_exception, SCRIPT_SHORTNAME)
+CONFIG_OR_EXIT = partial(_config_or_exit, FAIL_EXCEPTION, ERR_BAD_CONFIG)
+SETUP_ALL_APIS_OR_EXIT = partial(_setup_all_apis_or_exit, FAIL_EXCEPTION, ERR_SETUP_FAILED)
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+# What happened to each learner
+RESULT_COMPLETE = 'complete'
+RESULT_ERRORED = 'errored'
+RESULT_SKIPPED = 'skipped'
+RESULT_SETUP_FAILED = 'setup failed'
+RESULT_NOT_STARTED = 'not started'
+RESULTS = (RESULT_COMPLETE, RESULT_ERRORED, RESULT_SKIPPED, RESULT_SETUP_FAILED, RESULT_NOT_STARTED)
+
+
+def _retire_queued_learner(config, username, refused=None, state_executor=None):
+    """
+    Retires one learner from the queue, returning one of RESULTS. As with
+    retire_one_learner.py, the learner's state is checked with LMS again first,
+    and learners that are already in an end or working state (e.g. being
+    retired by another run) are left alone.
+
+    `refused` is a threading.Event that's set when a service refuses the access
+    token, after which learners aren't started. The learner's retirement states
+    are run on `state_executor`, if given.
+    """
+    log = partial(_log, '{} {}'.format(SCRIPT_SHORTNAME, username))
+
+    def check_refused(exc):
+        """
+        Stops the run if `exc` is a refused access token.
+        """
+        if refused is not None and _is_unauthorized(exc):
+            log('Access token refused, not starting any more learners')
+            refused.set()
+
+    if refused is not None and refused.is_set():
+        return RESULT_NOT_STARTED
+
+    try:
+        learner = config['LMS'].get_learner_retirement_state(username)
+    except HttpNotFoundError:
+        log('Learner not found, skipping')
+        return RESULT_SKIPPED
+    except Exception as exc:  # pylint: disable=broad-except
+        log('Unexpected error fetching user state! {}'.format(exc))
+        check_refused(exc)
+        return RESULT_SETUP_FAILED
+
+    learner_state_index, error = _get_learner_state_index(learner, config)
+    if error:
+        code, message = error
+        log(message)
+        return RESULT_SKIPPED if code in (ERR_USER_AT_END_STATE, ERR_USER_IN_WORKING_STATE) else RESULT_SETUP_FAILED
+
+    if config.get('fetch_ecommerce_segment_id', False):
+        try:
+            learner['ecommerce_segment_id'] = _fetch_ecom_segment_id(config, learner, log)
+        except Exception as exc:  # pylint: disable=broad-except
+            log('Unexpected error fetching Ecommerce tracking id! {}'.format(exc))
+            check_refused(exc)
+            return RESULT_SETUP_FAILED
+
+    error = _run_retirement_pipeline(config, username, learner, learner_state_index, log, state_executor)
+    if error:
+        check_refused(error[1])
+        return RESULT_ERRORED
+    return RESULT_COMPLETE
+
+
+@click.command("retire_learners")
+@click.option(
+    '--config_file',
+    help='File in which YAML config exists that overrides all other params.'
+)
+@click.option(
+    '--cool_off_days',
+    help='Number of days a learner should be in the retirement queue before being actually retired.',
+    default=7,
+    type=int
+)
+@click.option(
+    '--workers',
+    help='Maximum number of learners to retire at the same time.',
+    default=4,
+    type=click.IntRange(1, None)
+)
+@click.option(
+    '--state_workers',
+    help='Maximum number of retirement states to run at the same time, across all learners. Defaults to --workers.',
+    type=click.IntRange(1, None)
+)
+@click.option(
+    '--user_count_error_threshold',
+    help="If more users than this number are returned we will error out instead of retiring. This is a failsafe "
+         "against attacks that somehow manage to add users to the retirement queue.",
+    default=200,
+    type=int
+)
+def retire_learners(
+        config_file,
+        cool_off_days,
+        workers,
+        state_workers,
+        user_count_error_threshold
+):
+    """
+    Retrieves a JWT token as the retirement service learner, fetches the learners awaiting
+    retirement, then performs the retirement process for up to `workers` of them at a time,
+    running up to `state_workers` of their retirement states at a time between them.
+    """
+    LOG('Starting retirement of queued learners using config file {}'.format(config_file))
+
+    if not config_file:
+        FAIL(ERR_BAD_CONFIG, 'No config file passed in.')
+
+    config = CONFIG_OR_EXIT(config_file)
+    try:
+        _config_retirement_pipeline(config)
+    except ValueError as exc:
+        FAIL_EXCEPTION(ERR_BAD_CONFIG, 'Bad retirement_pipeline in config file {}'.format(config_file), exc)
+    SETUP_ALL_APIS_OR_EXIT(config)
+
+    states_to_request = [START_STATE] + [state[1] for state in config['retirement_pipeline']]
+    try:
+        learners = config['LMS'].learners_to_retire(states_to_request, cool_off_days)
+    except Exception as exc:  # pylint: disable=broad-except
+        FAIL_EXCEPTION(ERR_SETUP_FAILED, 'Unexpected error fetching the retirement queue!', exc)
+
+    if len(learners) > user_count_error_threshold:
+        FAIL(
+            ERR_TOO_MANY_LEARNERS,
+            'Too many learners to retire! Expected {} or fewer, got {}!'.format(
+                user_count_error_threshold,
+                len(learners)
+            )
+        )
+
+    usernames = [learner['original_username'] for learner in learners]
+    LOG('Retiring {} learners with {} workers and {} state workers'.format(
+        len(usernames), workers, state_workers or workers
+    ))
+
+    refused = threading.Event()
+    start_time = time()
+    # Learners wait on their states in the state executor, so the two can't be the same pool
+    with ThreadPoolExecutor(max_workers=state_workers or workers) as state_executor:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(
+                partial(_retire_queued_learner, config, refused=refused, state_executor=state_executor),
+                usernames
+            ))
+    elapsed = time() - start_time
+
+    counts = {result: results.count(result) for result in RESULTS}
+    LOG('Retirement finished in {:.1f} seconds: {}'.format(
+        elapsed,
+        ', '.join('{} {}'.format(counts[result], result) for result in RESULTS)
+    ))
+    if elapsed > 0:
+        LOG('Throughput: {:.1f} learners/minute'.format(counts[RESULT_COMPLETE] * 60 / elapsed))
+
+    for result, username in zip(results, usernames):
+        if result in (RESULT_ERRORED, RESULT_SETUP_FAILED):
+            LOG('Learner {}: {}'.format(username, result))
+
+    if refused.is_set():
+        FAIL(ERR_WHILE_RETIRING, 'Stopped after an access token was refused, with {} learners not started'.format(
+            counts[RESULT_NOT_STARTED]
+        ))
+    if counts[RESULT_ERRORED]:
+        FAIL(ERR_WHILE_RETIRING, 'Errors encountered retiring {} learners'.format(counts[RESULT_ERRORED]))
+    if counts[RESULT_SETUP_FAILED]:
+        FAIL(ERR_SETUP_FAILED, 'Could not start retiring {} learners'.format(counts[RESULT_SETUP_FAILED]))
+
+
+if __name__ == '__main__':
+    # pylint: disable=unexpected-keyword-arg, no-value-for-parameter
+    # If using env vars to provide params, prefix them with "RETIREMENT_", e.g. RETIREMENT_CLIENT_ID
+    retire_learners(auto_envvar_prefix='RETIREMENT')
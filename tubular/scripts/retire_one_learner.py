@@ -20,9 +20,19 @@ retirement_pipeline:
     - ['RETIRING_EMAIL_LISTS', 'EMAIL_LISTS_COMPLETE', 'LMS', 'retirement_retire_mailings']
     - ['RETIRING_ENROLLMENTS', 'ENROLLMENTS_COMPLETE', 'LMS', 'retirement_unenroll']
     - ['RETIRING_LMS', 'LMS_COMPLETE', 'LMS', 'retirement_lms_retire']
+
+Each state waits for every state before it. To run states at the same time, give a state the list
+of states it depends on as a fifth item, e.g. to retire from the four services above at once (the
+LMS states, having no list, still wait for all four):
+
+    - ['RETIRING_CREDENTIALS', 'CREDENTIALS_COMPLETE', 'CREDENTIALS', 'retire_learner', []]
+    - ['RETIRING_ECOM', 'ECOM_COMPLETE', 'ECOMMERCE', 'retire_learner', []]
+    - ['RETIRING_DEMOGRAPHICS', 'DEMOGRAPHICS_COMPLETE', 'DEMOGRAPHICS', 'retire_learner', []]
+    - ['RETIRING_LICENSE_MANAGER', 'LICENSE_MANAGER_COMPLETE', 'LICENSE_MANAGER', 'retire_learner', []]
 """
 
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from functools import partial
 from os import path
 from time import time
@@ -76,26 +86,38 @@ END_STATES = (ERROR_STATE, ABORTED_STATE, COMPLETE_STATE)
 AUTH_HEADER = {}
 
 
-def _get_learner_state_index_or_exit(learner, config):
+def _get_learner_state_index(learner, config):
     """
-    Returns the index in the ALL_STATES retirement state list, validating that it is in
-    an appropriate state to work on.
+    Returns the index in the ALL_STATES retirement state list and None if the
+    learner is in an appropriate state to work on, or None and an
+    (error code, message) tuple if not.
     """
     try:
         learner_state = learner['current_state']['state_name']
         learner_state_index = config['all_states'].index(learner_state)
 
         if learner_state in END_STATES:
-            FAIL(ERR_USER_AT_END_STATE, 'User already in end state: {}'.format(learner_state))
+            return None, (ERR_USER_AT_END_STATE, 'User already in end state: {}'.format(learner_state))
 
         if learner_state in config['working_states']:
-            FAIL(ERR_USER_IN_WORKING_STATE, 'User is already in a working state! {}'.format(learner_state))
+            return None, (ERR_USER_IN_WORKING_STATE, 'User is already in a working state! {}'.format(learner_state))
 
-        return learner_state_index
+        return learner_state_index, None
     except KeyError:
-        FAIL(ERR_BAD_LEARNER, 'Bad learner response missing current_state or state_name: {}'.format(learner))
+        return None, (ERR_BAD_LEARNER, 'Bad learner response missing current_state or state_name: {}'.format(learner))
     except ValueError:
-        FAIL(ERR_UNKNOWN_STATE, 'Unknown learner retirement state for learner: {}'.format(learner))
+        return None, (ERR_UNKNOWN_STATE, 'Unknown learner retirement state for learner: {}'.format(learner))
+
+
+def _get_learner_state_index_or_exit(learner, config):
+    """
+    Returns the index in the ALL_STATES retirement state list, validating that it is in
+    an appropriate state to work on.
+    """
+    learner_state_index, error = _get_learner_state_index(learner, config)
+    if error:
+        FAIL(*error)
+    return learner_state_index
 
 
 def _config_retirement_pipeline(config):
@@ -114,6 +136,34 @@ def _config_retirement_pipeline(config):
     for end in END_STATES:
         config['all_states'].append(end)
 
+    config['retirement_dependencies'] = _get_retirement_dependencies(retirement_pipeline)
+
+
+def _get_retirement_dependencies(retirement_pipeline):
+    """
+    Returns the set of pipeline indexes that each pipeline state has to wait for.
+
+    A state can list the working states it depends on as an optional fifth item, e.g.
+    ['RETIRING_ECOM', 'ECOM_COMPLETE', 'ECOMMERCE', 'retire_learner', ['RETIRING_CREDENTIALS']],
+    and an empty list means it can start straight away. A state without the fifth item depends
+    on every state before it, as before. Dependencies have to be earlier in the pipeline, so that
+    the pipeline order is still an order the states can be completed in.
+    """
+    dependencies = []
+    indexes = {}
+    for index, state in enumerate(retirement_pipeline):
+        if len(state) > 4:
+            unknown = [name for name in state[4] if name not in indexes]
+            if unknown:
+                raise ValueError('State {} depends on {}, which must be earlier in the retirement_pipeline'.format(
+                    state[0], ', '.join(unknown)
+                ))
+            dependencies.append({indexes[name] for name in state[4]})
+        else:
+            dependencies.append(set(range(index)))
+        indexes[state[0]] = index
+    return dependencies
+
 
 def _get_learner_and_state_index_or_exit(config, username):
     """
@@ -133,21 +183,172 @@ def _get_learner_and_state_index_or_exit(config, username):
         FAIL_EXCEPTION(ERR_SETUP_FAILED, 'Unexpected error fetching user state!', text_type(exc))
 
 
-def _get_ecom_segment_id(config, learner):
+def _fetch_ecom_segment_id(config, learner, log=LOG):
     """
     Calls Ecommerce to get the ecom-specific Segment tracking id that we need to retire.
-    This is only available from Ecommerce, unfortunately, and makes more sense to handle
-    here than to pass all of the config down to SegmentApi.
+    Returns None if the learner isn't in Ecommerce; any other error is raised.
     """
     try:
         return config['ECOMMERCE'].get_tracking_key(learner)
     except HttpNotFoundError:
-        LOG('Learner {} not found in Ecommerce. Setting Ecommerce Segment ID to None'.format(learner))
+        log('Learner {} not found in Ecommerce. Setting Ecommerce Segment ID to None'.format(learner))
         return None
+
+
+def _get_ecom_segment_id(config, learner):
+    """
+    Calls Ecommerce to get the ecom-specific Segment tracking id that we need to retire.
+    This is only available from Ecommerce, unfortunately, and makes more sense to handle
+    here than to pass all of the config down to SegmentApi.
+    """
+    try:
+        return _fetch_ecom_segment_id(config, learner)
     except Exception as exc:  # pylint: disable=broad-except
         FAIL_EXCEPTION(ERR_SETUP_FAILED, 'Unexpected error fetching Ecommerce tracking id!', text_type(exc))
 
 
+def _call_retirement_state(config, state, learner):
+    """
+    Does the actual API call for a pipeline state, returning the response and how long it took.
+    """
+    service, method = state[2], state[3]
+    start_time = time()
+    response = getattr(config[service], method)(learner)
+    return response, time() - start_time
+
+
+def _get_states_to_run(config, learner_state_index, log=LOG):
+    """
+    Returns the pipeline indexes of the states that haven't been done yet for a
+    learner in the state at `learner_state_index`.
+    """
+    to_run = []
+    for index, state in enumerate(config['retirement_pipeline']):
+        # Skip anything that has already been done
+        if config['all_states'].index(state[0]) < learner_state_index:
+            log('State {} completed in previous run, skipping'.format(state[0]))
+        else:
+            to_run.append(index)
+    return to_run
+
+
+def _record_state(config, username, state, response, is_end, log=LOG):
+    """
+    Moves the learner in LMS to the start (working) state of a pipeline state,
+    or to its end state with its response if `is_end`.
+    """
+    if is_end:
+        config['LMS'].update_learner_retirement_state(
+            username,
+            state[1],
+            'Ending: {} with response:\n{}'.format(state[1], response)
+        )
+        log('Progressing to state {}'.format(state[1]))
+    else:
+        config['LMS'].update_learner_retirement_state(username, state[0], 'Starting: {}'.format(state[0]))
+
+
+def _run_retirement_pipeline(config, username, learner, learner_state_index, log=LOG, executor=None):
+    """
+    Runs the retirement pipeline for one learner from `learner_state_index`,
+    moving them through each state in LMS and finally to COMPLETE. If a state
+    fails the learner is moved to ERRORED, and the failed state and exception
+    are returned; otherwise None is returned.
+
+    Each state starts as soon as the states it depends on are complete, so
+    independent states run at the same time, on `executor` if given (so that
+    retire_learners.py can bound the calls in flight for all of its learners
+    with one pool), or else on a thread pool of its own.
+
+    LMS only stores one state per learner though, it only moves learners
+    forward, and resuming relies on every state before the learner's being
+    done. So the learner is moved through the states in pipeline order, and
+    whenever a state is running, the learner is in the working state of the
+    earliest state that's running, recorded before any of them are called. A
+    state that completes while a later one is running isn't recorded as
+    complete on its own: the learner moves on to the next working state.
+
+    Nothing here exits, so retire_learners.py can run it for many learners at
+    once with the same API clients.
+    """
+    pipeline = config['retirement_pipeline']
+    start_state = None
+    running = {}
+    own_executor = None
+    try:
+        to_run = _get_states_to_run(config, learner_state_index, log)
+        done = set(range(len(pipeline))) - set(to_run)
+        started = set()
+        responses = {}
+        # How far the learner has been moved through the start and end states of to_run, in order
+        num_recorded = 0
+
+        def record_progress():
+            """
+            Moves the learner through the states that have started or finished, in pipeline order, as far as they
+            can go while staying in the working state of the earliest state that's running (or about to run).
+            """
+            nonlocal num_recorded
+            first = next((position for position, index in enumerate(to_run) if index not in done), len(to_run))
+            target = 2 * first + (1 if first < len(to_run) and to_run[first] in started else 0)
+            if target <= num_recorded:
+                return
+            if started - done:
+                # Something is running, so only its working state can be recorded
+                if target % 2 == 0:
+                    return
+                num_recorded = target - 1
+
+            while num_recorded < target:
+                position, is_end = divmod(num_recorded, 2)
+                index = to_run[position]
+                _record_state(config, username, pipeline[index], responses.get(index), is_end, log)
+                num_recorded += 1
+
+        if executor is None:
+            executor = own_executor = ThreadPoolExecutor(max_workers=max(len(to_run), 1))
+
+        while len(done) < len(pipeline):
+            ready = [
+                index for index in to_run
+                if index not in started and config['retirement_dependencies'][index] <= done
+            ]
+            for index in ready:
+                log('Starting state {}'.format(pipeline[index][0]))
+                started.add(index)
+            record_progress()
+            for index in ready:
+                running[executor.submit(_call_retirement_state, config, pipeline[index], learner)] = index
+
+            finished, __ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                index = running.pop(future)
+                start_state = pipeline[index][0]
+                responses[index], elapsed = future.result()
+                log('State {} completed in {} seconds'.format(start_state, elapsed))
+                done.add(index)
+            record_progress()
+
+        config['LMS'].update_learner_retirement_state(username, COMPLETE_STATE, 'Learner retirement complete.')
+        log('Retirement complete for learner {}'.format(username))
+        return None
+    except Exception as exc:  # pylint: disable=broad-except
+        exc_msg = _get_error_str_from_exception(exc)
+        # Let the learner's other states finish before moving them to ERRORED
+        wait(running)
+
+        try:
+            log('Error in retirement state {}: {}'.format(start_state, exc_msg))
+            config['LMS'].update_learner_retirement_state(username, ERROR_STATE, exc_msg)
+        except Exception as update_exc:  # pylint: disable=broad-except
+            log('Critical error attempting to change learner state to ERRORED: {}'.format(update_exc))
+
+        return start_state, exc
+    finally:
+        if own_executor is not None:
+            own_executor.shutdown()
+
+
 @click.command("retire_learner")
 @click.option(
     '--username',
@@ -171,7 +372,10 @@ def retire_learner(
         FAIL(ERR_BAD_CONFIG, 'No config file passed in.')
 
     config = CONFIG_OR_EXIT(config_file)
-    _config_retirement_pipeline(config)
+    try:
+        _config_retirement_pipeline(config)
+    except ValueError as exc:
+        FAIL_EXCEPTION(ERR_BAD_CONFIG, 'Bad retirement_pipeline in config file {}'.format(config_file), exc)
     SETUP_ALL_APIS_OR_EXIT(config)
 
     learner, learner_state_index = _get_learner_and_state_index_or_exit(config, username)
@@ -179,46 +383,9 @@ def retire_learner(
     if config.get('fetch_ecommerce_segment_id', False):
         learner['ecommerce_segment_id'] = _get_ecom_segment_id(config, learner)
 
-    start_state = None
-    try:
-        for start_state, end_state, service, method in config['retirement_pipeline']:
-            # Skip anything that has already been done
-            if config['all_states'].index(start_state) < learner_state_index:
-                LOG('State {} completed in previous run, skipping'.format(start_state))
-                continue
-
-            LOG('Starting state {}'.format(start_state))
-
-            config['LMS'].update_learner_retirement_state(username, start_state, 'Starting: {}'.format(start_state))
-
-            # This does the actual API call
-            start_time = time()
-            response = getattr(config[service], method)(learner)
-            end_time = time()
-
-            LOG('State {} completed in {} seconds'.format(start_state, end_time - start_time))
-
-            config['LMS'].update_learner_retirement_state(
-                username,
-                end_state,
-                'Ending: {} with response:\n{}'.format(end_state, response)
-            )
-
-            learner_state_index += 1
-
-            LOG('Progressing to state {}'.format(end_state))
-
-        config['LMS'].update_learner_retirement_state(username, COMPLETE_STATE, 'Learner retirement complete.')
-        LOG('Retirement complete for learner {}'.format(username))
-    except Exception as exc:  # pylint: disable=broad-except
-        exc_msg = _get_error_str_from_exception(exc)
-
-        try:
-            LOG('Error in retirement state {}: {}'.format(start_state, exc_msg))
-            config['LMS'].update_learner_retirement_state(username, ERROR_STATE, exc_msg)
-        except Exception as update_exc:  # pylint: disable=broad-except
-            LOG('Critical error attempting to change learner state to ERRORED: {}'.format(update_exc))
-
+    error = _run_retirement_pipeline(config, username, learner, learner_state_index)
+    if error:
+        start_state, exc = error
         FAIL_EXCEPTION(ERR_WHILE_RETIRING, 'Error encountered in state "{}"'.format(start_state), exc)
 
 
@@ -2,20 +2,31 @@
 """
 Script to detect and prune old Structure documents from the "Split" Modulestore
 MongoDB (edxapp.modulestore.structures by default). See docstring/help for the
-"make_plan" and "prune" commands for more details.
+"make_plan", "prune", "prune_databases", "verify" and "prune_definitions"
+commands for more details.
 """
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import logging
 import os
+import re
 import sys
+import time
 
 import click
 import click_log
+from opaque_keys import InvalidKeyError
+from opaque_keys.edx.keys import CourseKey
+import yaml
 
 # Add top-level module path to sys.path before importing tubular code.
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from tubular.splitmongo import ChangePlan, SplitMongoBackend  # pylint: disable=wrong-import-position
+from tubular.splitmongo import (  # pylint: disable=wrong-import-position
+    AdaptiveThrottle, ChangePlan, IntegrityReport, KeepPolicy, MongoDumpBackend, PruneJournal, ReclamationReport,
+    SplitMongoBackend, StructuresSnapshot, Throttle
+)
 
 LOG = logging.getLogger('structures')
 click_log.basic_config(LOG)
@@ -37,8 +48,16 @@ click_log.basic_config(LOG)
     default='edxapp',
     help='Name of the edX Mongo database containing the course structures to prune.'
 )
+@click.option(
+    '--dump',
+    type=click.Path(exists=True),
+    default=None,
+    help=("Read Structures and Active Versions from this mongodump directory or "
+          "--archive file instead of connecting to the database. Only "
+          "make_plan can be used with a dump.")
+)
 @click.pass_context
-def cli(ctx, connection, database_name):
+def cli(ctx, connection, database_name, dump):
     """
     Recover space on MongoDB for edx-platform by deleting unreachable,
     historical course content data. To use, first make a change plan with the
@@ -59,22 +78,70 @@ def cli(ctx, connection, database_name):
     This code does not address that modulestore in any way. That modulestore
     handles courses that use the old "/" separator, such as
     "MITx/6.002x/2012_Spring", as well as assets starting with "i4x://".
+
+    To avoid scanning the production database, make_plan can read a mongodump
+    of the structures and active_versions collections instead (see --dump).
+    Dump structures before active_versions, and then prune the live database
+    with the plan.
     """
     if ctx.obj is None:
         ctx.obj = dict()
 
-    ctx.obj['BACKEND'] = SplitMongoBackend(connection, database_name)
+    if dump is not None:
+        ctx.obj['BACKEND'] = MongoDumpBackend(dump, database_name)
+    else:
+        ctx.obj['BACKEND'] = SplitMongoBackend(connection, database_name)
+
+
+def live_backend(ctx):
+    """Return the SplitMongoBackend, or fail if we were given a mongodump."""
+    backend = ctx.obj['BACKEND']
+    if isinstance(backend, MongoDumpBackend):
+        raise click.UsageError("{} needs a database connection, not --dump".format(ctx.info_name))
+    return backend
+
+
+def parse_course_keys(ctx, param, values):  # pylint: disable=unused-argument
+    """Click callback to parse course and library key strings."""
+    course_keys = []
+    for value in values:
+        try:
+            course_keys.append(CourseKey.from_string(value))
+        except InvalidKeyError as exc:
+            raise click.BadParameter("{} is not a valid course or library key".format(value)) from exc
+    return course_keys
 
 
 @cli.command("make_plan")
 @click_log.simple_verbosity_option(default='INFO')
-@click.argument('plan_file', type=click.File('w'))
+@click.argument('plan_file', type=click.Path(dir_okay=False, writable=True))
+@click.option(
+    '--plan-format',
+    type=click.Choice(['json', 'binary']),
+    default='json',
+    help=("Format of the Change Plan file. JSON is easy to read and debug. The "
+          "binary format stores IDs as sorted 12-byte ObjectIds in indexed "
+          "blocks, so that prune can stream very large plans.")
+)
+@click.option(
+    '--compression',
+    type=click.Choice(ChangePlan.COMPRESSION_TYPES),
+    default='none',
+    help="Compression for the blocks of a binary Change Plan (zstd requires the zstandard package)."
+)
 @click.option(
     '--details',
     type=click.File('w'),
     default=None,
     help="Name of file to write the human-readable details of the Change Plan."
 )
+@click.option(
+    '--details-summary-only',
+    is_flag=True,
+    default=False,
+    help=("Only write the summary and statistics to the --details file, and "
+          "leave out the list of every Structure in every branch.")
+)
 @click.option(
     '--retain',
     default=2,
@@ -84,6 +151,22 @@ def cli(ctx, connection, database_name):
           "active or original structures (those are always preserved). Defaults "
           "to 2. Put 0 here if you want to prune as much as possible.")
 )
+@click.option(
+    '--keep-days',
+    default=None,
+    type=click.IntRange(0, None),
+    help=("Also keep every Structure in an active version's history that's "
+          "less than this many days old (going by its ObjectId).")
+)
+@click.option(
+    '--thin-factor',
+    default=None,
+    type=click.FloatRange(1, None, min_open=True),
+    help=("With --keep-days, also keep a thinned out sample of older history: "
+          "the newest Structure of each branch in windows of age that are each "
+          "this many times longer than the one before (e.g. 2 keeps about one "
+          "per doubling of age).")
+)
 @click.option(
     '--delay',
     default=15000,
@@ -97,13 +180,85 @@ def cli(ctx, connection, database_name):
     type=click.IntRange(1, None),
     help="How many Structures do we fetch at a time?"
 )
+@click.option(
+    '--compact/--no-compact',
+    default=True,
+    help=("Hold Structures in memory as sorted binary IDs and integer links "
+          "(about 20 bytes per Structure) instead of a dict of strings. The "
+          "resulting Change Plan is the same either way.")
+)
+@click.option(
+    '--partitions',
+    default=1,
+    type=click.IntRange(1, None),
+    help=("Split the Structures scan into this many _id ranges (by ObjectId "
+          "timestamp), each read with its own cursor. The --delay applies to "
+          "each partition separately.")
+)
+@click.option(
+    '--workers',
+    default=4,
+    type=click.IntRange(1, None),
+    help="Maximum number of partitions to scan concurrently."
+)
+@click.option(
+    '--snapshot',
+    type=click.Path(dir_okay=False, writable=True),
+    default=None,
+    help=("File to keep a compact copy of all Structure relationships in, so "
+          "that later runs only read Structures added since the last one. The "
+          "file is created if it doesn't exist, and an interrupted scan resumes "
+          "where it left off. Implies --compact. Not used with --partitions.")
+)
+@click.option(
+    '--org',
+    'orgs',
+    multiple=True,
+    help=("Only prune the courses and libraries in this org. Can be given more "
+          "than once, and combined with --course.")
+)
+@click.option(
+    '--course',
+    'course_keys',
+    multiple=True,
+    callback=parse_course_keys,
+    help=("Only prune this course or library (e.g. course-v1:edX+Demo+2020 or "
+          "library-v1:edX+Lib). Can be given more than once.")
+)
+@click.option(
+    '--sizes/--no-sizes',
+    default=False,
+    help=("Look up the size of every Structure to delete (with $bsonSize, which "
+          "needs MongoDB 4.4+), so that the Change Plan and details file report "
+          "how much space pruning will free, and prune can use --order "
+          "largest-first.")
+)
+@click.option(
+    '--record-ids/--no-record-ids',
+    default=False,
+    help=("Look up where every Structure to delete is stored (its $recordId), "
+          "so that prune can use --order locality.")
+)
+@click.option(
+    '--point-in-time/--no-point-in-time',
+    default=False,
+    help=("Read from a secondary with readConcern snapshot, so the whole scan "
+          "sees the database at one moment (needs MongoDB 5.0+, and "
+          "minSnapshotHistoryWindowInSeconds raised above the scan time). "
+          "Partitions are scanned one at a time.")
+)
 @click.pass_context
-def make_plan(ctx, plan_file, details, retain, delay, batch_size):
+def make_plan(ctx, plan_file, plan_format, compression, details, details_summary_only, retain, keep_days, thin_factor,
+              delay, batch_size, compact, partitions, workers, snapshot, orgs, course_keys, sizes, record_ids,
+              point_in_time):
     """
     Create a Change Plan JSON file describing the operations needed to prune the
     database. This command is read-only and does not alter the database.
 
-    The Change Plan JSON is a dictionary with two keys:
+    Use --plan-format binary for a compact binary file with the same contents,
+    which the "prune" command can read without loading it all into memory.
+
+    The Change Plan JSON is a dictionary with these keys:
 
     "delete" - A sorted array of Structure document IDs to delete. Since MongoDB
     object IDs are created in ascending order by timestamp, this means that the
@@ -114,23 +269,110 @@ def make_plan(ctx, plan_file, details, retain, delay, batch_size):
     the Original Structure, so that we don't leave the database in a state where
     a Structure's "previous_version" points to a deleted Structure.
 
+    "delete_ranges" - A list of [First ID, Last ID] pairs for runs of "delete"
+    with no other Structures in between, which prune deletes with range queries.
+    With --dump, ranges stop short of the recent Structures that are left out.
+
+    "delete_sizes" - With --sizes, the size in bytes of each Structure in
+    "delete" (otherwise empty).
+
+    "delete_record_ids" - With --record-ids, the record ID of each Structure in
+    "delete" (otherwise empty). Record IDs follow the order Structures are
+    stored on disk, which ObjectIds only roughly do.
+
     Specifying a --details file will generate a more verbose, human-readable
     text description of the Change Plan for verification purposes. The details
     file will only display Structures that are reachable from an Active Version,
     so any Structures that are "orphaned" as a result of partial runs of this
     script or Studio race conditions will not be reflected. That being said,
     orphaned Structures are detected and properly noted in the Change Plan JSON.
+    The details file starts with statistics (chain lengths, orphaned Structures,
+    and the courses with the most to delete). Use --details-summary-only to
+    write just those, which is much faster for large databases.
+
+    Use --org and --course to prune only some courses and libraries. Instead of
+    reading every Structure, we only fetch the history of those courses (and of
+    any other courses that share history with them, such as reruns). Orphaned
+    Structures are not pruned in this mode.
+
+    Use --point-in-time to take the scan load off the primary and read a
+    consistent view of the database, instead of going back for Structures that
+    were added while the scan was running.
+
+    --retain keeps the same number of Structures for busy and dormant courses
+    alike. Use --keep-days (and --thin-factor) to keep history by age instead,
+    or as well: e.g. "--retain 0 --keep-days 30 --thin-factor 2" keeps the
+    last month of every course, then one Structure per doubling of age. The
+    kept Structures are re-linked to skip the ones in between.
     """
-    structures_graph = ctx.obj['BACKEND'].structures_graph(delay / 1000.0, batch_size)
+    if thin_factor is not None and keep_days is None:
+        raise click.BadParameter("--thin-factor needs --keep-days", param_hint='--thin-factor')
+    keep_policy = KeepPolicy(keep_days, thin_factor) if keep_days is not None else None
+    if snapshot is not None and partitions > 1:
+        raise click.BadParameter("--snapshot can't be used with --partitions", param_hint='--partitions')
+    if snapshot is not None:
+        snapshot = StructuresSnapshot(snapshot)
+
+    scoped = bool(orgs or course_keys)
+    if scoped and snapshot is not None:
+        raise click.BadParameter("--snapshot can't be used with --org or --course", param_hint='--snapshot')
+    if scoped and point_in_time:
+        raise click.BadParameter("--point-in-time can't be used with --org or --course", param_hint='--point-in-time')
+    if isinstance(ctx.obj['BACKEND'], MongoDumpBackend) and any(
+            [scoped, snapshot is not None, partitions > 1, point_in_time, record_ids]
+    ):
+        raise click.UsageError(
+            "--org, --course, --snapshot, --partitions, --point-in-time and --record-ids can't be used with --dump"
+        )
+
+    if scoped:
+        structures_graph = ctx.obj['BACKEND'].scoped_structures_graph(
+            delay / 1000.0, batch_size, orgs, course_keys
+        )
+    else:
+        try:
+            structures_graph = ctx.obj['BACKEND'].structures_graph(
+                delay / 1000.0, batch_size, compact, partitions, workers, snapshot, point_in_time
+            )
+        except ValueError as err:
+            raise click.ClickException(str(err))
+
+    size_lookup = None
+    if sizes:
+        size_lookup = partial(ctx.obj['BACKEND'].structure_sizes, delay=delay / 1000.0, batch_size=batch_size)
+    record_id_lookup = None
+    if record_ids:
+        record_id_lookup = partial(ctx.obj['BACKEND'].record_ids, delay=delay / 1000.0, batch_size=batch_size)
+
+    # A mongodump doesn't have every recent Structure, so delete ranges have
+    # to stop short of those.
+    ranges_before = None
+    if isinstance(ctx.obj['BACKEND'], MongoDumpBackend):
+        ranges_before = ctx.obj['BACKEND'].complete_before
 
     # This will create the details file as a side-effect, if specified.
-    change_plan = ChangePlan.create(structures_graph, retain, details)
-    change_plan.dump(plan_file)
+    change_plan = ChangePlan.create(
+        structures_graph,
+        retain,
+        details,
+        with_ranges=not scoped,
+        ranges_before=ranges_before,
+        size_lookup=size_lookup,
+        details_summary_only=details_summary_only,
+        record_id_lookup=record_id_lookup,
+        keep_policy=keep_policy,
+    )
+    if plan_format == 'binary':
+        with open(plan_file, 'wb') as binary_plan_file:
+            change_plan.dump_binary(binary_plan_file, compression)
+    else:
+        with open(plan_file, 'w') as json_plan_file:
+            change_plan.dump(json_plan_file)
 
 
 @cli.command()
 @click_log.simple_verbosity_option(default='INFO')
-@click.argument('plan_file', type=click.File('r'))
+@click.argument('plan_file', type=click.Path(exists=True, dir_okay=False))
 @click.option(
     '--delay',
     default=15000,
@@ -152,10 +394,57 @@ def make_plan(ctx, plan_file, details, retain, delay, batch_size):
           "is not in the Change Plan is an error. Specifying a Structure ID that "
           "has already been deleted is NOT an error, so it's safe to re-run.")
 )
+@click.option(
+    '--adaptive/--no-adaptive',
+    default=False,
+    help=("Adjust the batch size and delay while pruning to stay within the "
+          "--target-latency and --max-lag budgets. --batch-size and --delay "
+          "are then only the starting values.")
+)
+@click.option(
+    '--target-latency',
+    default=500,
+    type=click.IntRange(1, None),
+    help=("With --adaptive, the write latency in milliseconds we aim for, both "
+          "per batch and as reported by the server's serverStatus.")
+)
+@click.option(
+    '--max-lag',
+    default=10,
+    type=click.IntRange(0, None),
+    help="With --adaptive, back off if any secondary falls this many seconds behind the primary."
+)
+@click.option(
+    '--journal',
+    type=click.Path(dir_okay=False, writable=True),
+    default=None,
+    help=("File to record finished delete batches in. If prune is interrupted, "
+          "running it again with the same journal skips the batches that were "
+          "already deleted, so --start isn't needed.")
+)
+@click.option(
+    '--concurrency',
+    default=1,
+    type=click.IntRange(1, None),
+    help="How many delete batches to run against the database at the same time."
+)
+@click.option(
+    '--order',
+    type=click.Choice(['id', 'largest-first', 'locality']),
+    default='id',
+    help=("Order to delete Structures in. largest-first frees the most space "
+          "early on, so that a time limited run does the most good. It needs a "
+          "Change Plan made with --sizes. locality deletes in the order "
+          "Structures are stored on disk, so that each batch touches fewer "
+          "pages. It needs a Change Plan made with --record-ids. Neither can be "
+          "used with --start or --journal.")
+)
 @click.pass_context
-def prune(ctx, plan_file, delay, batch_size, start):
+def prune(ctx, plan_file, delay, batch_size, start, adaptive, target_latency, max_lag, journal, concurrency,
+          order):
     """
-    Prune the MongoDB database according to a Change Plan file.
+    Prune the MongoDB database according to a Change Plan file (JSON or
+    binary, which is detected automatically).
 
     This command tries to be as safe as possible. It executes parent updates
     before deletes, so an interruption at any point should be safe in that it
@@ -163,19 +452,444 @@ def prune(ctx, plan_file, delay, batch_size, start):
     be safe to resume pruning with the same Change Plan in the event of an
     interruption.
 
+    Use --journal to record progress, so that re-running an interrupted prune
+    automatically skips the batches that were already deleted (with
+    --concurrency > 1, batches can finish out of order).
+
     It's also safe to run while Studio is still operating, though you should be
     careful to test and tweak the delay and batch_size options to throttle load
-    on your database.
+    on your database, or use --adaptive to have them adjusted automatically
+    based on write latency and replication lag.
     """
-    change_plan = ChangePlan.load(plan_file)
+    backend = live_backend(ctx)
+    change_plan = ChangePlan.load_file(plan_file)
     if start is not None and start not in change_plan.delete:
         raise click.BadParameter(
             "{} is not in the Change Plan {}".format(
-                start, click.format_filename(plan_file.name)
+                start, click.format_filename(plan_file)
             ),
             param_hint='--start'
         )
-    ctx.obj['BACKEND'].update(change_plan, delay / 1000.0, batch_size, start)
+    largest_first = order == 'largest-first'
+    record_order = order == 'locality'
+    if order != 'id' and (start is not None or journal is not None):
+        raise click.BadParameter("{} can't be used with --start or --journal".format(order), param_hint='--order')
+    if largest_first and len(change_plan.delete_sizes) != len(change_plan.delete):
+        raise click.BadParameter(
+            "{} was made without --sizes".format(click.format_filename(plan_file)), param_hint='--order'
+        )
+    if record_order and len(change_plan.delete_record_ids) != len(change_plan.delete):
+        raise click.BadParameter(
+            "{} was made without --record-ids".format(click.format_filename(plan_file)), param_hint='--order'
+        )
+
+    throttle = None
+    if adaptive:
+        throttle = AdaptiveThrottle(
+            delay / 1000.0,
+            batch_size,
+            target_latency / 1000.0,
+            max_lag=max_lag,
+            probe=backend.server_metrics,
+        )
+    prune_journal = None
+    if journal is not None:
+        try:
+            prune_journal = PruneJournal(journal, change_plan.delete)
+        except ValueError as err:
+            raise click.BadParameter(str(err), param_hint='--journal')
+    try:
+        backend.update(
+            change_plan, delay / 1000.0, batch_size, start, throttle, prune_journal, concurrency, largest_first,
+            record_order
+        )
+    finally:
+        if prune_journal is not None:
+            prune_journal.close()
+
+
+# Settings that each target in a prune_databases targets file can override, and
+# their minimum values.
+TARGET_SETTINGS = {
+    'retain': 0,
+    'scan_delay': 0,
+    'scan_batch_size': 1,
+    'delay': 0,
+    'batch_size': 1,
+    'target_latency': 1,
+    'max_lag': 0,
+}
+
+
+def load_targets(targets_file, defaults):
+    """
+    Read a prune_databases targets file: a YAML list of targets, each with a
+    "connection" and "database_name", an optional "name" (used in the report
+    and for the Change Plan file), and optional TARGET_SETTINGS overrides.
+    Return a list of target dicts with every setting filled in.
+    """
+    try:
+        targets = yaml.safe_load(targets_file)
+    except yaml.YAMLError as err:
+        raise click.BadParameter(str(err), param_hint='TARGETS_FILE')
+    if not isinstance(targets, list) or not targets:
+        raise click.BadParameter("must be a non-empty list of targets", param_hint='TARGETS_FILE')
+
+    loaded = []
+    for target in targets:
+        if not isinstance(target, dict) or 'connection' not in target or 'database_name' not in target:
+            raise click.BadParameter(
+                "every target needs a connection and a database_name", param_hint='TARGETS_FILE'
+            )
+        unknown = set(target) - set(TARGET_SETTINGS) - {'name', 'connection', 'database_name'}
+        if unknown:
+            raise click.BadParameter(
+                "unknown target settings: {}".format(", ".join(sorted(unknown))), param_hint='TARGETS_FILE'
+            )
+        for setting, minimum in TARGET_SETTINGS.items():
+            if setting in target and (not isinstance(target[setting], int) or target[setting] < minimum):
+                raise click.BadParameter(
+                    "{} must be an integer of at least {}".format(setting, minimum), param_hint='TARGETS_FILE'
+                )
+        loaded_target = dict(defaults, **target)
+        loaded_target.setdefault('name', target['database_name'])
+        loaded.append(loaded_target)
+
+    names = [target['name'] for target in loaded]
+    if len(set(names)) != len(names):
+        raise click.BadParameter("target names must be unique (add a name to each)", param_hint='TARGETS_FILE')
+    return loaded
+
+
+def prune_target(target, plan_dir, adaptive, sizes, dry_run):
+    """
+    Make a Change Plan for one prune_databases target, write it to
+    `plan_dir`, and (unless `dry_run`) prune with it. Returns a
+    ReclamationReport, with the error if any step failed.
+    """
+    start_time = time.monotonic()
+    num_structures = num_deletions = num_deleted = bytes_to_free = None
+    try:
+        backend = SplitMongoBackend(target['connection'], target['database_name'])
+        structures_graph = backend.structures_graph(
+            target['scan_delay'] / 1000.0, target['scan_batch_size'], compact=True
+        )
+        num_structures = len(structures_graph)
+        size_lookup = None
+        if sizes:
+            size_lookup = partial(
+                backend.structure_sizes, delay=target['scan_delay'] / 1000.0, batch_size=target['scan_batch_size']
+            )
+        change_plan = ChangePlan.create(structures_graph, target['retain'], size_lookup=size_lookup)
+        del structures_graph
+        num_deletions = len(change_plan.delete)
+        if change_plan.delete_sizes:
+            bytes_to_free = sum(change_plan.delete_sizes)
+
+        plan_name = re.sub(r'[^\w.-]', '_', target['name'])
+        with open(os.path.join(plan_dir, '{}.plan'.format(plan_name)), 'wb') as plan_file:
+            change_plan.dump_binary(plan_file)
+
+        if not dry_run:
+            if adaptive:
+                throttle = AdaptiveThrottle(
+                    target['delay'] / 1000.0,
+                    target['batch_size'],
+                    target['target_latency'] / 1000.0,
+                    max_lag=target['max_lag'],
+                    probe=backend.server_metrics,
+                )
+            else:
+                throttle = Throttle(target['delay'] / 1000.0, target['batch_size'])
+            num_deleted = backend.update(change_plan, throttle=throttle)
+    except Exception as err:  # pylint: disable=broad-except
+        LOG.exception("Pruning %s failed", target['name'])
+        return ReclamationReport(
+            target['name'], num_structures, num_deletions, num_deleted, bytes_to_free,
+            time.monotonic() - start_time, str(err) or type(err).__name__
+        )
+    return ReclamationReport(
+        target['name'], num_structures, num_deletions, num_deleted, bytes_to_free, time.monotonic() - start_time, None
+    )
+
+
+@cli.command("prune_databases")
+@click_log.simple_verbosity_option(default='INFO')
+@click.argument('targets_file', type=click.File('r'))
+@click.option(
+    '--plan-dir',
+    type=click.Path(file_okay=False, writable=True),
+    required=True,
+    help="Directory to write each target's binary Change Plan to (as <name>.plan)."
+)
+@click.option(
+    '--retain',
+    default=2,
+    type=click.IntRange(0, None),
+    help="The maximum number of intermediate structures to preserve per branch, as with make_plan."
+)
+@click.option(
+    '--scan-delay',
+    default=15000,
+    type=click.IntRange(0, None),
+    help="Delay in milliseconds between queries to fetch structures (make_plan's --delay)."
+)
+@click.option(
+    '--scan-batch-size',
+    default=10000,
+    type=click.IntRange(1, None),
+    help="How many Structures to fetch at a time (make_plan's --batch-size)."
+)
+@click.option(
+    '--delay',
+    default=15000,
+    type=click.IntRange(0, None),
+    help="Delay in milliseconds between batch deletions, as with prune."
+)
+@click.option(
+    '--batch-size',
+    default=1000,
+    type=click.IntRange(1, None),
+    help="How many Structures to delete at a time, as with prune."
+)
+@click.option(
+    '--adaptive/--no-adaptive',
+    default=False,
+    help=("Adjust each target's batch size and delay while pruning to stay "
+          "within its --target-latency and --max-lag budgets, as with prune.")
+)
+@click.option(
+    '--target-latency',
+    default=500,
+    type=click.IntRange(1, None),
+    help="With --adaptive, the write latency in milliseconds we aim for."
+)
+@click.option(
+    '--max-lag',
+    default=10,
+    type=click.IntRange(0, None),
+    help="With --adaptive, back off if any secondary falls this many seconds behind the primary."
+)
+@click.option(
+    '--parallel',
+    default=4,
+    type=click.IntRange(1, None),
+    help=("How many targets to work on at the same time. Each one holds its "
+          "own Structures graph in memory while its Change Plan is made.")
+)
+@click.option(
+    '--sizes/--no-sizes',
+    default=False,
+    help="Look up the size of every Structure to delete, so the report says how much space was freed."
+)
+@click.option(
+    '--dry-run',
+    is_flag=True,
+    default=False,
+    help="Only make the Change Plans and report what would be deleted."
+)
+@click.option(
+    '--report',
+    type=click.File('w'),
+    default='-',
+    help="File to write the combined report to (standard output by default)."
+)
+@click.pass_context
+def prune_databases(ctx, targets_file, plan_dir, retain, scan_delay, scan_batch_size, delay, batch_size, adaptive,
+                    target_latency, max_lag, parallel, sizes, dry_run, report):
+    """
+    Make a Change Plan for, and prune, several databases at once, and finish
+    with a combined report of what was freed. The top-level --connection and
+    --database-name are ignored. Instead, TARGETS_FILE is a YAML list of
+    databases, e.g.:
+
+    \b
+      - name: tenant-a
+        connection: mongodb://mongo-a.example.com:27017
+        database_name: edxapp
+      - name: tenant-b
+        connection: mongodb://mongo-b.example.com:27017
+        database_name: edxapp
+        delay: 30000
+        max_lag: 5
+
+    Each target gets its own throttle, so a busy database can't slow down
+    (or use up the budget of) another one. Any of --retain, --scan-delay,
+    --scan-batch-size, --delay, --batch-size, --target-latency and --max-lag
+    can be overridden per target, using underscores (e.g. batch_size).
+
+    The Change Plans are kept in --plan-dir, so that an interrupted or failed
+    target can be finished with the "prune" command. A failure in one target
+    doesn't stop the others, and the command exits with status 1 if any
+    target failed.
+    """
+    if isinstance(ctx.obj['BACKEND'], MongoDumpBackend):
+        raise click.UsageError("prune_databases can't be used with --dump")
+    defaults = {
+        'retain': retain,
+        'scan_delay': scan_delay,
+        'scan_batch_size': scan_batch_size,
+        'delay': delay,
+        'batch_size': batch_size,
+        'target_latency': target_latency,
+        'max_lag': max_lag,
+    }
+    targets = load_targets(targets_file, defaults)
+    os.makedirs(plan_dir, exist_ok=True)
+
+    start_time = time.monotonic()
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        reports = list(executor.map(
+            partial(prune_target, plan_dir=plan_dir, adaptive=adaptive, sizes=sizes, dry_run=dry_run), targets
+        ))
+    ReclamationReport.write_combined(reports, report, time.monotonic() - start_time)
+    if any(reclamation.error for reclamation in reports):
+        ctx.exit(1)
+
+
+@cli.command()
+@click_log.simple_verbosity_option(default='INFO')
+@click.option(
+    '--report',
+    type=click.File('w'),
+    default='-',
+    help="File to write the report to (standard output by default)."
+)
+@click.option(
+    '--delay',
+    default=15000,
+    type=click.IntRange(0, None),
+    help=("Delay in milliseconds between queries to fetch structures from MongoDB. "
+          "Tune to adjust load on the database.")
+)
+@click.option(
+    '--batch-size',
+    default=10000,
+    type=click.IntRange(1, None),
+    help="How many Structures do we fetch at a time?"
+)
+@click.option(
+    '--partitions',
+    default=1,
+    type=click.IntRange(1, None),
+    help=("Split the Structures scan into this many _id ranges, each read with "
+          "its own cursor, as with make_plan.")
+)
+@click.option(
+    '--workers',
+    default=4,
+    type=click.IntRange(1, None),
+    help="Maximum number of partitions to scan concurrently."
+)
+@click.option(
+    '--point-in-time/--no-point-in-time',
+    default=False,
+    help="Read a consistent view of the database from a secondary, as with make_plan."
+)
+@click.pass_context
+def verify(ctx, report, delay, batch_size, partitions, workers, point_in_time):
+    """
+    Check that no Structure links to one that doesn't exist, and count the
+    Structures that no Active Version can reach. This command is read-only.
+
+    Run this after prune. It exits with status 1 if an Active Structure is
+    missing, or if any Structure's previous_version or original_version points
+    to a Structure that doesn't exist. Unreachable Structures are reported, but
+    aren't an error (the next Change Plan will delete them).
+
+    Structures are held in the same compact form as make_plan --compact, and
+    the scan can be split with --partitions to make it faster.
+    """
+    backend = ctx.obj['BACKEND']
+    if isinstance(backend, MongoDumpBackend) and (partitions > 1 or point_in_time):
+        raise click.UsageError("--partitions and --point-in-time can't be used with --dump")
+    try:
+        structures_graph = backend.structures_graph(
+            delay / 1000.0, batch_size, True, partitions, workers, point_in_time=point_in_time
+        )
+    except ValueError as err:
+        # e.g. an Active Structure missing from a --dump, or a corrupt dump file
+        raise click.ClickException(str(err)) from err
+    integrity_report = IntegrityReport.create(structures_graph)
+    integrity_report.write(report)
+    if not integrity_report.is_consistent():
+        LOG.error("Found broken links between Structures")
+        ctx.exit(1)
+    LOG.info("All links between Structures are intact")
+
+
+@cli.command("prune_definitions")
+@click_log.simple_verbosity_option(default='INFO')
+@click.option(
+    '--delay',
+    default=15000,
+    type=click.IntRange(0, None),
+    help=("Delay in milliseconds between batches of reads and deletions. Tune "
+          "to adjust load on the database.")
+)
+@click.option(
+    '--batch-size',
+    default=100,
+    type=click.IntRange(1, None),
+    help=("How many Structures do we read at a time? Tune to adjust load on "
+          "the database.")
+)
+@click.option(
+    '--delete-batch-size',
+    default=1000,
+    type=click.IntRange(1, None),
+    help=("How many Definitions do we delete at a time? Tune to adjust load on "
+          "the database.")
+)
+@click.option(
+    '--adaptive/--no-adaptive',
+    default=False,
+    help=("Adjust the delete batch size and delay to stay within the "
+          "--target-latency and --max-lag budgets, as with prune.")
+)
+@click.option(
+    '--target-latency',
+    default=500,
+    type=click.IntRange(1, None),
+    help="With --adaptive, the write latency in milliseconds we aim for."
+)
+@click.option(
+    '--max-lag',
+    default=10,
+    type=click.IntRange(0, None),
+    help="With --adaptive, back off if any secondary falls this many seconds behind the primary."
+)
+@click.option(
+    '--dry-run/--no-dry-run',
+    default=False,
+    help="Only count the unreferenced Definitions, without deleting them."
+)
+@click.pass_context
+def prune_definitions(ctx, delay, batch_size, delete_batch_size, adaptive, target_latency, max_lag, dry_run):
+    """
+    Delete Definition documents that no Structure refers to any more.
+
+    Pruning Structures leaves behind the Definitions that only the deleted
+    Structures used. This command reads the blocks of every remaining
+    Structure to find the Definitions still in use, and then deletes the rest.
+    Definitions created in the last day are never deleted, since Studio saves
+    them before the Structures that use them.
+
+    Run this after prune has finished, and not at the same time, or the
+    Structures being deleted could make their Definitions look referenced.
+    """
+    backend = live_backend(ctx)
+    if adaptive:
+        throttle = AdaptiveThrottle(
+            delay / 1000.0,
+            delete_batch_size,
+            target_latency / 1000.0,
+            max_lag=max_lag,
+            probe=backend.server_metrics,
+        )
+    else:
+        throttle = Throttle(delay / 1000.0, delete_batch_size)
+    backend.prune_definitions(delay / 1000.0, batch_size, throttle, dry_run)
 
 
 if __name__ == '__main__':
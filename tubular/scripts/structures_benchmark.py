@@ -0,0 +1,322 @@
+#! /usr/bin/env python3
+"""
+Script to generate synthetic "Split" Modulestore data and benchmark the
+structures.py code against it. See docstring/help for the "generate" and
+"run" commands for more details.
+"""
+
+import json
+import logging
+import multiprocessing
+import os
+import sys
+
+import click
+import click_log
+from pymongo import MongoClient, monitoring
+
+# Add top-level module path to sys.path before importing tubular code.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tubular.splitmongo import SplitMongoBackend  # pylint: disable=wrong-import-position
+from tubular.splitmongo_synthetic import (  # pylint: disable=wrong-import-position
+    DELETE_ORDERS, SYNTHETIC_ORG, SyntheticModulestore, benchmark_in_memory, delete_throughputs, run_benchmarks
+)
+
+LOG = logging.getLogger('structures')
+click_log.basic_config(LOG)
+
+
+class CommandCounter(monitoring.CommandListener):
+    """Counts the commands sent to MongoDB, i.e. round trips."""
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event):
+        self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def modulestore_options(mean_edits, rerun_fraction, orphan_fraction, seed):
+    """Keyword arguments for SyntheticModulestore."""
+    return {
+        'mean_edits': mean_edits,
+        'rerun_fraction': rerun_fraction,
+        'orphan_fraction': orphan_fraction,
+        'seed': seed,
+    }
+
+
+def is_synthetic(database):
+    """Is everything in this database from SyntheticModulestore?"""
+    return not database.modulestore.active_versions.count_documents({'org': {'$ne': SYNTHETIC_ORG}}, limit=1)
+
+
+def fill_database(database, structures, insert_options, options):
+    """
+    Replace the Structures and Active Versions in `database` with synthetic
+    ones, and record how they were made so that run can make them again.
+    """
+    database.drop_collection('modulestore.structures')
+    database.drop_collection('modulestore.active_versions')
+    SyntheticModulestore(structures, **options).insert_into(database, **insert_options)
+    database.splitmongo_benchmark.replace_one(
+        {'_id': 'generate'},
+        {'structures': structures, 'insert_options': insert_options, 'options': options},
+        upsert=True,
+    )
+    LOG.info("Generated %s Structures in %s", structures, database.name)
+
+
+def regenerate(database):
+    """Generate the same data in `database` as the last generate did."""
+    generated = database.splitmongo_benchmark.find_one({'_id': 'generate'})
+    if generated is None:
+        raise click.UsageError("{} wasn't filled by generate".format(database.name))
+    fill_database(database, generated['structures'], generated['insert_options'], generated['options'])
+
+
+def synthetic_options(func):
+    """Options for the shape of the generated data."""
+    options = [
+        click.option('--mean-edits', default=50, type=click.IntRange(1, None),
+                     help="Mean number of draft edits per course (lognormally distributed)."),
+        click.option('--rerun-fraction', default=0.1, type=click.FloatRange(0, 1),
+                     help="Fraction of courses that are reruns of an earlier course."),
+        click.option('--orphan-fraction', default=0.02, type=click.FloatRange(0, 1),
+                     help="Fraction of courses that have been deleted, leaving orphaned Structures."),
+        click.option('--seed', default=0, type=int, help="Random seed. The same seed gives the same data."),
+    ]
+    for option in reversed(options):
+        func = option(func)
+    return func
+
+
+@click.group()
+def cli():
+    """
+    Generate realistic looking Split Modulestore data, and measure how long
+    making and applying a Change Plan takes with it, how much memory it needs,
+    and how many queries it makes.
+    """
+
+
+@cli.command()
+@click_log.simple_verbosity_option(default='INFO')
+@click.option(
+    '--connection',
+    default="mongodb://localhost:27017",
+    help="Connection string to a local, scratch MongoDB database."
+)
+@click.option(
+    '--database-name',
+    default='splitmongo_benchmark',
+    help="Name of the database to generate Structures in."
+)
+@click.option(
+    '--structures',
+    default=1000000,
+    type=click.IntRange(1, None),
+    help="How many Structures to generate."
+)
+@click.option(
+    '--blocks',
+    default=10,
+    type=click.IntRange(0, None),
+    help="How many (small) blocks each Structure has."
+)
+@click.option(
+    '--batch-size',
+    default=10000,
+    type=click.IntRange(1, None),
+    help="How many documents to insert at a time."
+)
+@click.option(
+    '--shuffle-window',
+    default=0,
+    type=click.IntRange(0, None),
+    help=("Insert each run of this many Structures in a random order, so that "
+          "they aren't stored in ID order (as with many Studio processes, or "
+          "after a resync). 0 inserts them in ID order.")
+)
+@click.option(
+    '--replace/--no-replace',
+    default=False,
+    help="Drop the Structures and Active Versions that are already there (they must be synthetic)."
+)
+@synthetic_options
+def generate(connection, database_name, structures, blocks, batch_size, shuffle_window, replace, mean_edits,
+             rerun_fraction, orphan_fraction, seed):
+    """
+    Fill a MongoDB database with synthetic Structures and Active Versions, to
+    run benchmarks against with "run --backend mongo". Never point this at a
+    real database.
+    """
+    database = MongoClient(connection)[database_name]
+    if database.modulestore.structures.find_one(projection=[]) is not None and not replace:
+        raise click.UsageError("{} already has Structures (use --replace)".format(database_name))
+    if not is_synthetic(database):
+        raise click.UsageError("{} has Active Versions that aren't synthetic".format(database_name))
+
+    fill_database(
+        database,
+        structures,
+        {'batch_size': batch_size, 'blocks_per_structure': blocks, 'shuffle_window': shuffle_window},
+        modulestore_options(mean_edits, rerun_fraction, orphan_fraction, seed),
+    )
+
+
+@cli.command()
+@click_log.simple_verbosity_option(default='INFO')
+@click.option(
+    '--backend',
+    type=click.Choice(['memory', 'mongo']),
+    default='memory',
+    help=("Benchmark against Structures generated in memory for each of "
+          "--structures, or against a database filled by \"generate\".")
+)
+@click.option(
+    '--structures',
+    multiple=True,
+    type=click.IntRange(1, None),
+    default=[1000000],
+    help=("With --backend memory, how many Structures to generate. Can be given "
+          "more than once (e.g. 1000000, 10000000 and 50000000), and each size "
+          "runs in its own process so that peak memory use is comparable.")
+)
+@click.option(
+    '--connection',
+    default="mongodb://localhost:27017",
+    help="With --backend mongo, connection string to the database."
+)
+@click.option(
+    '--database-name',
+    default='splitmongo_benchmark',
+    help="With --backend mongo, name of the database that \"generate\" filled."
+)
+@click.option(
+    '--retain',
+    default=2,
+    type=click.IntRange(0, None),
+    help="Intermediate Structures to keep per branch, as with make_plan."
+)
+@click.option(
+    '--batch-size',
+    default=10000,
+    type=click.IntRange(1, None),
+    help="How many Structures to read or write at a time."
+)
+@click.option(
+    '--compact/--no-compact',
+    default=True,
+    help="Build a CompactStructuresGraph, as with make_plan."
+)
+@click.option(
+    '--prune/--no-prune',
+    default=True,
+    help=("Apply the Change Plan too. With --backend mongo this deletes "
+          "Structures, so run \"generate\" again before the next run.")
+)
+@click.option(
+    '--order',
+    'orders',
+    multiple=True,
+    type=click.Choice(DELETE_ORDERS),
+    default=['id'],
+    help=("Order to delete Structures in, as with prune --order (locality looks "
+          "up record IDs while making the Change Plan). Give it more than once "
+          "to compare their throughput. With --backend mongo and --prune, the "
+          "database is generated again before each order after the first.")
+)
+@click.option(
+    '--output',
+    type=click.File('w'),
+    default=None,
+    help="JSON file to write the results to, for comparing runs."
+)
+@synthetic_options
+def run(backend, structures, connection, database_name, retain, batch_size, compact, prune, orders, output,
+        mean_edits, rerun_fraction, orphan_fraction, seed):
+    """
+    Time structures_graph, ChangePlan.create, ChangePlan dump and load (JSON
+    and binary), and update (prune), and report the wall time, peak resident
+    memory, and round trips to the database for each step. With more than one
+    --order, also report how the delete throughput of each order compares with
+    the first.
+    """
+    run_options = {'retain': retain, 'batch_size': batch_size, 'compact': compact, 'prune': prune}
+    orders = list(dict.fromkeys(orders))
+    all_results = []  # (num_structures, {order: results})
+    if backend == 'memory':
+        options = modulestore_options(mean_edits, rerun_fraction, orphan_fraction, seed)
+        spawn = multiprocessing.get_context('spawn')
+        for num_structures in structures:
+            results_by_order = {}
+            for order in orders:
+                with spawn.Pool(1) as pool:
+                    results_by_order[order] = pool.apply(
+                        benchmark_in_memory, (num_structures, options), dict(run_options, order=order)
+                    )
+            all_results.append((num_structures, results_by_order))
+    else:
+        counter = CommandCounter()
+        monitoring.register(counter)
+        mongo_backend = SplitMongoBackend(connection, database_name)
+        database = MongoClient(connection)[database_name]
+        if not is_synthetic(database):
+            raise click.UsageError("{} has Active Versions that aren't synthetic".format(database_name))
+        results_by_order = {}
+        for order_num, order in enumerate(orders):
+            if order_num and prune:
+                regenerate(database)
+            results_by_order[order] = run_benchmarks(
+                mongo_backend, lambda: counter.count, order=order, **run_options
+            )
+        all_results.append((None, results_by_order))
+
+    click.echo("{:>12} {:<10} {:<30} {:>10} {:>14} {:>12}".format(
+        'Structures', 'Order', 'Step', 'Seconds', 'Peak RSS (MB)', 'Round Trips'
+    ))
+    for num_structures, results_by_order in all_results:
+        for order, results in results_by_order.items():
+            for result in results:
+                click.echo("{:>12} {:<10} {:<30} {:>10.2f} {:>14.1f} {:>12}".format(
+                    num_structures or '-', order, result.step, result.seconds, result.peak_rss / 2 ** 20,
+                    result.round_trips
+                ))
+
+    for num_structures, results_by_order in all_results:
+        throughputs = delete_throughputs(results_by_order)
+        if not throughputs.get(orders[0]):
+            continue
+        for order in orders[1:]:
+            if order in throughputs:
+                click.echo("{}: {} order deleted {:.0f} Structures/sec, {:+.1f}% vs {} order ({:.0f}/sec)".format(
+                    num_structures or database_name,
+                    order,
+                    throughputs[order],
+                    (throughputs[order] / throughputs[orders[0]] - 1) * 100,
+                    orders[0],
+                    throughputs[orders[0]],
+                ))
+
+    if output is not None:
+        json.dump(
+            [
+                dict(result._asdict(), structures=num_structures, order=order)
+                for num_structures, results_by_order in all_results
+                for order, results in results_by_order.items()
+                for result in results
+            ],
+            output,
+            indent=2,
+        )
+
+
+if __name__ == '__main__':
+    cli()
@@ -35,23 +35,54 @@ Studio.
 
 This module provides cleanup functionality with various tweakable options for
 how much history to preserve. For simplicity, it reads all Structure IDs into
-memory instead of working on subsets of the data. As a practical matter, this
-means that it will work for databases with up to about 10 million Structures
-before RAM usage starts to become a problem.
+memory instead of working on subsets of the data. With the default dict-based
+StructuresGraph, this means that it will work for databases with up to about 10
+million Structures before RAM usage starts to become a problem. The
+CompactStructuresGraph stores the same information in about 20 bytes per
+Structure, which pushes that limit out past a hundred million Structures.
 """
-from collections import deque, namedtuple
-from itertools import count, takewhile
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, namedtuple
+from collections.abc import Mapping, Sequence
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timedelta, timezone
+from heapq import merge
+from itertools import accumulate, chain, count, islice
+import gzip
 import json
 import logging
+import math
+import mmap
 import os
+import shutil
+import struct
+import sys
+import tempfile
 import time
 
+from bson import BSON
+from bson.errors import InvalidBSON
 from bson.objectid import ObjectId
-from pymongo import MongoClient, UpdateOne
+from pymongo import ASCENDING, DESCENDING, MongoClient, ReadPreference, UpdateOne
+from pymongo.errors import OperationFailure
 from opaque_keys.edx.locator import CourseLocator, LibraryLocator
 
+try:
+    import zstandard
+except ImportError:  # Only needed for zstd compressed binary Change Plans.
+    zstandard = None
+
 LOG = logging.getLogger('structures')
 
+# Link value used by CompactStructuresGraph for "no Structure" (the previous
+# link of an Original Structure).
+NO_STRUCTURE = -1
+
+# Size of a binary ObjectId.
+OBJECT_ID_SIZE = 12
+
 
 class StructuresGraph(namedtuple('DatabaseSummary', 'branches structures')):
     """
@@ -95,6 +126,273 @@ class StructuresGraph(namedtuple('DatabaseSummary', 'branches structures')):
             yield current_id
             i += 1
 
+    def structure_ids(self):
+        """Return all Structure IDs in the graph, in sorted order."""
+        return sorted(self.structures)
+
+    def indexed(self):
+        """
+        Return an index based view of this graph, with the same `index_of`,
+        `id_at`, `original_idxs`, and `previous_idxs` that CompactStructuresGraph
+        has, so that it can be used with a RetentionEngine.
+        """
+        return _IndexedStructures(self.structures)
+
+
+class _IndexedStructures:
+    """
+    Sorted positions and int32 links for a dict of Structures. Links follow the
+    same conventions as CompactStructuresGraph.
+    """
+    def __init__(self, structures):
+        self._ids = sorted(structures)
+        self._positions = {s_id: index for index, s_id in enumerate(self._ids)}
+        self._missing_ids = []
+        missing_positions = {}
+
+        def link(s_id):
+            """Convert a Structure ID into a link value."""
+            if s_id is None:
+                return NO_STRUCTURE
+            if s_id in self._positions:
+                return self._positions[s_id]
+            if s_id not in missing_positions:
+                missing_positions[s_id] = NO_STRUCTURE - 1 - len(self._missing_ids)
+                self._missing_ids.append(s_id)
+            return missing_positions[s_id]
+
+        self.original_idxs = array('i', (link(structures[s_id].original_id) for s_id in self._ids))
+        self.previous_idxs = array('i', (link(structures[s_id].previous_id) for s_id in self._ids))
+
+    def __len__(self):
+        return len(self._ids)
+
+    def index_of(self, structure_id):
+        """Return the index of `structure_id`, raising KeyError if absent."""
+        return self._positions[structure_id]
+
+    def id_at(self, index):
+        """Return the Structure ID for an index or link value."""
+        if index == NO_STRUCTURE:
+            return None
+        if index < NO_STRUCTURE:
+            return self._missing_ids[NO_STRUCTURE - 1 - index]
+        return self._ids[index]
+
+    def unflagged_ids(self, flags):
+        """Return a sorted list of the IDs whose index isn't set in `flags`."""
+        return [self._ids[index] for index, flag in enumerate(flags) if not flag]
+
+    def timestamp_at(self, index):
+        """Return the creation time (from the ObjectId) of the Structure at `index`."""
+        return int(self._ids[index][:8], 16)
+
+
+class KeepPolicy(namedtuple('KeepPolicy', 'keep_days thin_factor now', defaults=(None, None))):
+    """
+    Time based retention of the history of Active Structures, on top of the
+    fixed number of intermediate Structures that RetentionEngine keeps. The
+    age of a Structure comes from the timestamp in its ObjectId.
+
+    * Every Structure in an Active Structure's history that's less than
+      `keep_days` old is kept.
+    * With a `thin_factor` (greater than 1), older history is thinned out
+      exponentially. Ages past `keep_days` are split into windows that are
+      each `thin_factor` times as long as the one before, and the newest
+      Structure of each chain in each window is kept. With a factor of 2,
+      that's about one Structure for every doubling of age.
+
+    Ages are measured from `now` (seconds since the epoch), or from the time
+    the policy is applied if that's None.
+    """
+    SECONDS_PER_DAY = 24 * 60 * 60
+
+    def window(self, age):
+        """
+        Return the window number for an age in seconds: 0 for Structures that
+        are always kept, or None if thinning is off and they're too old.
+        """
+        if age < self.keep_days * self.SECONDS_PER_DAY:
+            return 0
+        if self.thin_factor is None:
+            return None
+        # With keep_days of 0, the first window is the first day.
+        base = max(self.keep_days, 1) * self.SECONDS_PER_DAY
+        if age < base:
+            return 1
+        return 1 + math.floor(math.log(age / base, self.thin_factor))
+
+
+class RetentionEngine:
+    """
+    Works out which Structures to keep and which parent links to rewrite for
+    all branches at once.
+
+    Instead of walking each branch's history one Structure ID at a time, this
+    holds a set of positions (one per distinct branch head) and steps every
+    position in it back through the `previous_idxs` array together. Because
+    it's a set, branches that converge on the same Structure at the same depth
+    collapse into one entry, so shared history is only walked once.
+
+    `graph` is anything with `original_idxs`, `previous_idxs`, `timestamp_at`
+    and a length: a CompactStructuresGraph or the result of
+    StructuresGraph.indexed().
+    """
+    def __init__(self, graph):
+        self.graph = graph
+
+    def retained(self, active_idxs, num_intermediate_structures, keep_policy=None):
+        """
+        Return a `(keep, kept_missing)` tuple, where `keep` is a bytearray with
+        a 1 for every index to keep, and `kept_missing` is a set of link values
+        for kept Structures that aren't in the graph.
+
+        The Active Structure, its Original, and up to
+        `num_intermediate_structures` Structures before it are kept for every
+        branch, as well as whatever an optional KeepPolicy keeps.
+        """
+        previous_idxs = self.graph.previous_idxs
+        keep = bytearray(len(self.graph))
+        kept_missing = set()
+
+        def mark(idxs):
+            """Flag link values as kept."""
+            for index in idxs:
+                if index >= 0:
+                    keep[index] = 1
+                elif index < NO_STRUCTURE:
+                    kept_missing.add(index)
+
+        frontier = set(active_idxs)
+        mark(frontier)
+        mark([self.graph.original_idxs[index] for index in frontier])
+
+        for _ in range(num_intermediate_structures):
+            frontier = {previous_idxs[index] for index in frontier}
+            mark(frontier)
+            frontier = {index for index in frontier if index >= 0}
+            if not frontier:
+                break
+
+        if keep_policy is not None:
+            self._keep_by_age(active_idxs, keep_policy, keep)
+        return keep, kept_missing
+
+    def _keep_by_age(self, active_idxs, keep_policy, keep):
+        """
+        Flag the Structures that `keep_policy` keeps in `keep`.
+
+        A Structure is the newest of its chain in a window if a Structure whose
+        previous link points to it is in a different window. So this only has
+        to look at each link once, stepping a frontier of every Structure we
+        can reach back through the whole history at once, and visiting each
+        Structure only once, however many branches share it.
+        """
+        previous_idxs = self.graph.previous_idxs
+        timestamp_at = self.graph.timestamp_at
+        now = keep_policy.now if keep_policy.now is not None else time.time()
+        windows = {}
+
+        def window_at(index):
+            """The (cached) KeepPolicy window of the Structure at `index`."""
+            if index not in windows:
+                windows[index] = keep_policy.window(now - timestamp_at(index))
+            return windows[index]
+
+        seen = bytearray(len(self.graph))
+        frontier = [index for index in set(active_idxs) if index >= 0]
+        for index in frontier:
+            seen[index] = 1
+        while frontier:
+            next_frontier = []
+            for index in frontier:
+                previous = previous_idxs[index]
+                if previous < 0:
+                    continue
+                window = window_at(previous)
+                if window == 0 or (window is not None and window != window_at(index)):
+                    keep[previous] = 1
+                if not seen[previous]:
+                    seen[previous] = 1
+                    next_frontier.append(previous)
+            windows = {index: windows[index] for index in next_frontier if index in windows}
+            frontier = next_frontier
+
+    def relinks(self, active_idxs, keep):
+        """
+        Return the set of indexes whose previous link should be rewritten to
+        point to their Original.
+
+        For each branch, that's the oldest Structure we can reach from the
+        Active Structure by only stepping through kept, non-Original
+        Structures -- unless its previous link already is the Original.
+        """
+        previous_idxs = self.graph.previous_idxs
+        original_idxs = self.graph.original_idxs
+
+        def can_step_to(index):
+            """Can a lane continue on to this link value?"""
+            return index >= 0 and keep[index] and previous_idxs[index] != NO_STRUCTURE
+
+        frontier = {index for index in active_idxs if can_step_to(index)}
+        oldest_kept = set()
+        while frontier:
+            steps = [(index, previous_idxs[index]) for index in frontier]
+            oldest_kept.update(index for index, previous in steps if not can_step_to(previous))
+            frontier = {previous for _, previous in steps if can_step_to(previous)}
+
+        return {
+            index for index in oldest_kept
+            if original_idxs[index] != previous_idxs[index]
+        }
+
+    def relink_targets(self, active_idxs, keep):
+        """
+        Return a dict of {index: new previous link} for kept Structures whose
+        Previous Structure won't be kept, for when `keep` has gaps in the
+        middle of a history (e.g. from a KeepPolicy).
+
+        Each kept Structure is linked to the next kept Structure in its history
+        (or its Original if there isn't one), so that everything we keep can
+        still be reached from its Active Structure. The next kept Structure can
+        be one that's kept for another branch (e.g. the published Active
+        Structure in the draft's history), so this doesn't give the same links
+        as relinks() even when there are no extra gaps. ChangePlan.create uses
+        relinks() when a KeepPolicy doesn't keep anything extra.
+        """
+        previous_idxs = self.graph.previous_idxs
+        original_idxs = self.graph.original_idxs
+        targets = {}
+        seen = bytearray(len(self.graph))
+
+        # Each lane is (position, the last kept Structure that we passed).
+        lanes = {(index, index) for index in active_idxs if index >= 0}
+        for index in active_idxs:
+            if index >= 0:
+                seen[index] = 1
+        while lanes:
+            next_lanes = set()
+            for index, last_kept in lanes:
+                previous = previous_idxs[index]
+                if previous == NO_STRUCTURE:
+                    continue
+                if previous < 0 or previous == original_idxs[last_kept]:
+                    # The end of the chain, a missing Structure, or the
+                    # Original (which is always kept).
+                    if previous_idxs[last_kept] != original_idxs[last_kept]:
+                        targets[last_kept] = original_idxs[last_kept]
+                    continue
+                if keep[previous]:
+                    if previous_idxs[last_kept] != previous:
+                        targets[last_kept] = previous
+                    if seen[previous]:
+                        continue
+                    seen[previous] = 1
+                    last_kept = previous
+                next_lanes.add((previous, last_kept))
+            lanes = next_lanes
+        return targets
+
 
 class ActiveVersionBranch(namedtuple('ActiveVersionBranch', 'id branch structure_id key edited_on')):
     """
@@ -136,7 +434,606 @@ class Structure(namedtuple('Structure', 'id original_id previous_id')):
         return self.previous_id is None
 
 
-class ChangePlan(namedtuple('ChangePlan', 'delete update_parents')):
+class CompactStructuresGraph:
+    """
+    A memory efficient equivalent of StructuresGraph, for databases with tens or
+    hundreds of millions of Structures.
+
+    Rather than a dict of Structure namedtuples (three 24 character hex strings
+    apiece), this keeps:
+
+    * All Structure IDs as 12-byte binary ObjectIds in one sorted, contiguous
+      buffer. The position of an ID in that buffer is its index.
+
+    * Two int32 arrays, `original_idxs` and `previous_idxs`, with the index of
+      each Structure's Original and Previous Structure.
+
+    That comes to 20 bytes per Structure. Finding the index of an ID is a binary
+    search over the buffer.
+
+    A link value of NO_STRUCTURE means there is no Previous Structure (i.e. it's
+    an Original). Values less than NO_STRUCTURE refer to Structure IDs that are
+    linked to but are not in the graph themselves (e.g. the remains of a
+    partially applied prune). Those few IDs are kept in a side list so that we
+    can still report them.
+
+    `structures` is a read-only Mapping of Structure IDs to Structure objects
+    (created on demand), so that code written for StructuresGraph works with
+    either class.
+    """
+    def __init__(self, branches, ids, original_idxs, previous_idxs, missing_ids=()):
+        self.branches = branches
+        self.original_idxs = original_idxs
+        self.previous_idxs = previous_idxs
+        self.structures = _CompactStructuresView(self)
+        self._ids = _BinaryIds(ids)
+        self._missing_ids = list(missing_ids)
+
+    @classmethod
+    def build(cls, branches, structures):
+        """
+        Create a CompactStructuresGraph from an iterable of Structures.
+
+        Structures are cheapest to add in ID order (e.g. from a cursor sorted by
+        `_id`). Structures that arrive out of order are set aside and merged in
+        at the end, which is fine as long as there aren't too many of them.
+        """
+        return cls.from_partitions(branches, [cls.scan_partition(structures)])
+
+    @classmethod
+    def scan_partition(cls, structures):
+        """
+        Pack an iterable of Structures into binary buffers, to be combined with
+        other partitions by from_partitions(). This is where most of the work
+        of building a graph happens, and it's safe to do in parallel threads.
+        """
+        return _accumulate_records(_pack_structure(structure) for structure in structures)
+
+    @classmethod
+    def from_partitions(cls, branches, partitions):
+        """
+        Create a CompactStructuresGraph from the results of scan_partition().
+
+        Partitions should cover ascending, non-overlapping ranges of IDs, so
+        that they can be concatenated without sorting.
+        """
+        ids = bytearray()
+        original_ids = bytearray()
+        previous_ids = bytearray()
+        out_of_order = []
+        for partition in partitions:
+            out_of_order.extend(partition.out_of_order)
+            if ids and partition.ids and partition.ids[:OBJECT_ID_SIZE] <= ids[-OBJECT_ID_SIZE:]:
+                LOG.warning("Structure partitions overlap, merging them")
+                out_of_order.extend(_unpack_records(partition))
+                continue
+            ids += partition.ids
+            original_ids += partition.original_ids
+            previous_ids += partition.previous_ids
+
+        return cls._from_partition(
+            branches, _PackedStructures(ids, original_ids, previous_ids, out_of_order)
+        )
+
+    def extended(self, branches, structures):
+        """
+        Return a new CompactStructuresGraph with `branches` and all our
+        Structures, plus the extra `structures` passed in.
+        """
+        records = chain(self._records(), (_pack_structure(s) for s in structures))
+        return self._from_partition(branches, _accumulate_records(records))
+
+    def __len__(self):
+        return len(self._ids)
+
+    def index_of(self, structure_id):
+        """Return the index of `structure_id`, raising KeyError if absent."""
+        index = self._find(structure_id)
+        if index is None:
+            raise KeyError(structure_id)
+        return index
+
+    def id_at(self, index):
+        """
+        Return the Structure ID (str) for an index or link value (None for
+        NO_STRUCTURE).
+        """
+        if index == NO_STRUCTURE:
+            return None
+        if index < NO_STRUCTURE:
+            return self._missing_ids[NO_STRUCTURE - 1 - index].hex()
+        return self._ids[index].hex()
+
+    def structure_at(self, index):
+        """Return the Structure at `index`."""
+        return Structure(
+            self.id_at(index),
+            self.id_at(self.original_idxs[index]),
+            self.id_at(self.previous_idxs[index]),
+        )
+
+    def structure_ids(self):
+        """Iterate through all Structure IDs in the graph, in sorted order."""
+        return (binary_id.hex() for binary_id in self._ids)
+
+    def indexed(self):
+        """We're already index based, so this is just for StructuresGraph parity."""
+        return self
+
+    def timestamp_at(self, index):
+        """Return the creation time (from the ObjectId) of the Structure at `index`."""
+        start = index * OBJECT_ID_SIZE
+        return int.from_bytes(self._ids.buffer[start:start + 4], 'big')
+
+    def unflagged_ids(self, flags):
+        """
+        Return StructureIds for all indexes that aren't set in `flags` (a
+        bytearray with one flag per Structure), copying whole runs at a time.
+        """
+        unflagged = bytearray()
+        for start, end in _unflagged_runs(flags):
+            unflagged += self._ids.buffer[start * OBJECT_ID_SIZE:end * OBJECT_ID_SIZE]
+        return StructureIds.from_buffer(bytes(unflagged))
+
+    def traverse_ids(self, start_id, limit=None, include_start=False):
+        """
+        Same as StructuresGraph.traverse_ids, but following index links.
+        """
+        if include_start:
+            yield start_id
+
+        index = self._find(start_id)
+        i = 0
+        while index is not None and index >= 0:
+            if limit is not None and i >= limit:
+                return
+
+            index = self.previous_idxs[index]
+            if index == NO_STRUCTURE:
+                return
+
+            yield self.id_at(index)
+            i += 1
+
+    @classmethod
+    def _from_partition(cls, branches, partition):
+        """
+        Create a graph from _PackedStructures, merging in any out of order
+        records and resolving binary ID links into indexes.
+        """
+        ids, original_ids, previous_ids, _ = _merge_out_of_order(partition)
+
+        sorted_ids = _BinaryIds(bytes(ids))
+        del ids
+        missing_ids = {}
+
+        def link(binary_id):
+            """Convert a binary ID into a link value."""
+            if binary_id == _NULL_ID:
+                return NO_STRUCTURE
+            index = sorted_ids.find(binary_id)
+            if index is None:
+                index = missing_ids.setdefault(binary_id, NO_STRUCTURE - 1 - len(missing_ids))
+            return index
+
+        def links(binary_ids):
+            """Convert a buffer of binary IDs into an int32 array of links."""
+            return array('i', (
+                link(bytes(binary_ids[i:i + OBJECT_ID_SIZE]))
+                for i in range(0, len(binary_ids), OBJECT_ID_SIZE)
+            ))
+
+        original_idxs = links(original_ids)
+        del original_ids
+        previous_idxs = links(previous_ids)
+        del previous_ids
+
+        if missing_ids:
+            LOG.warning("%s linked Structures are not in the graph", len(missing_ids))
+
+        return cls(branches, sorted_ids.buffer, original_idxs, previous_idxs, missing_ids)
+
+    def _records(self):
+        """Iterate through (id, original_id, previous_id) binary tuples."""
+        def binary_id_at(index):
+            """Binary version of id_at()."""
+            if index == NO_STRUCTURE:
+                return _NULL_ID
+            if index < NO_STRUCTURE:
+                return self._missing_ids[NO_STRUCTURE - 1 - index]
+            return self._ids[index]
+
+        for index, binary_id in enumerate(self._ids):
+            yield (
+                binary_id,
+                binary_id_at(self.original_idxs[index]),
+                binary_id_at(self.previous_idxs[index]),
+            )
+
+    def _find(self, structure_id):
+        """Return the index of `structure_id`, or None if it isn't here."""
+        try:
+            binary_id = bytes.fromhex(structure_id)
+        except (TypeError, ValueError):
+            return None
+        return self._ids.find(binary_id)
+
+
+# Structures packed into binary buffers, while building a CompactStructuresGraph
+# or reading a StructuresSnapshot. The first three are buffers of concatenated
+# 12-byte binary IDs in ascending ID order. `out_of_order` is a list of
+# (id, original_id, previous_id) tuples of binary IDs that still need to be
+# merged in.
+_PackedStructures = namedtuple('_PackedStructures', 'ids original_ids previous_ids out_of_order')
+
+# Stand-in for a previous_id of None when packing Structures. An all-zero
+# ObjectId would have a timestamp in 1970, so it can't be a real Structure.
+_NULL_ID = bytes(OBJECT_ID_SIZE)
+
+
+def _pack_structure(structure):
+    """Convert a Structure to an (id, original_id, previous_id) tuple of binary IDs."""
+    return (
+        bytes.fromhex(structure.id),
+        bytes.fromhex(structure.original_id),
+        _NULL_ID if structure.previous_id is None else bytes.fromhex(structure.previous_id),
+    )
+
+
+def _accumulate_records(records):
+    """
+    Append (id, original_id, previous_id) tuples of binary IDs to three buffers
+    for as long as they arrive in ascending ID order, and return them as
+    _PackedStructures. Duplicates are skipped, and any other records are set
+    aside in `out_of_order`.
+    """
+    ids = bytearray()
+    original_ids = bytearray()
+    previous_ids = bytearray()
+    out_of_order = []
+    last_id = b''
+    for record in records:
+        if record[0] > last_id:
+            ids += record[0]
+            original_ids += record[1]
+            previous_ids += record[2]
+            last_id = record[0]
+        elif record[0] != last_id:
+            out_of_order.append(record)
+    return _PackedStructures(ids, original_ids, previous_ids, out_of_order)
+
+
+def _unpack_records(packed):
+    """Iterate through the in-order records of _PackedStructures."""
+    for i in range(0, len(packed.ids), OBJECT_ID_SIZE):
+        yield (
+            bytes(packed.ids[i:i + OBJECT_ID_SIZE]),
+            bytes(packed.original_ids[i:i + OBJECT_ID_SIZE]),
+            bytes(packed.previous_ids[i:i + OBJECT_ID_SIZE]),
+        )
+
+
+def _merge_out_of_order(packed):
+    """Return _PackedStructures with all `out_of_order` records merged in."""
+    if not packed.out_of_order:
+        return packed
+    LOG.info("Merging %s out of order Structures", len(packed.out_of_order))
+    return _accumulate_records(merge(_unpack_records(packed), sorted(packed.out_of_order)))
+
+
+def _unflagged_runs(flags):
+    """
+    Yield (start, end) index ranges of the maximal runs of unset flags in a
+    bytearray of 0/1 flags.
+    """
+    end = 0
+    while True:
+        start = flags.find(0, end)
+        if start == -1:
+            return
+        end = flags.find(1, start)
+        if end == -1:
+            end = len(flags)
+        yield start, end
+
+
+def _clip_run(indexed_graph, start, end, before_id):
+    """
+    Return the end of the part of the index run `start` to `end` whose IDs
+    are less than `before_id`, by binary search.
+    """
+    while start < end:
+        middle = (start + end) // 2
+        if indexed_graph.id_at(middle) < before_id:
+            start = middle + 1
+        else:
+            end = middle
+    return start
+
+
+class _BinaryIds:
+    """
+    Sequence of the 12-byte IDs in a sorted buffer.
+
+    Lookups binary search a sparse list of every FENCE_INTERVAL-th ID (so that
+    the search runs in C rather than calling back into Python), and then scan
+    the small block of the buffer that the ID would have to be in.
+    """
+    FENCE_INTERVAL = 64
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self._block_size = self.FENCE_INTERVAL * OBJECT_ID_SIZE
+        self._fences = [
+            bytes(buffer[start:start + OBJECT_ID_SIZE])
+            for start in range(0, len(buffer), self._block_size)
+        ]
+
+    def __len__(self):
+        return len(self.buffer) // OBJECT_ID_SIZE
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        start = index * OBJECT_ID_SIZE
+        return self.buffer[start:start + OBJECT_ID_SIZE]
+
+    def bisect_left(self, binary_id):
+        """Return the index where `binary_id` is, or would be inserted."""
+        block = bisect_right(self._fences, binary_id) - 1
+        if block < 0:
+            return 0
+        start = block * self.FENCE_INTERVAL
+        return bisect_left(self, binary_id, start, min(start + self.FENCE_INTERVAL, len(self)))
+
+    def find(self, binary_id):
+        """Return the index of `binary_id`, or None if it isn't here."""
+        block = bisect_right(self._fences, binary_id) - 1
+        if block < 0:
+            return None
+        start = block * self._block_size
+        end = start + self._block_size
+        position = self.buffer.find(binary_id, start, end)
+        # Matches that straddle two IDs don't count.
+        while position != -1 and position % OBJECT_ID_SIZE:
+            position = self.buffer.find(binary_id, position + 1, end)
+        if position == -1:
+            return None
+        return position // OBJECT_ID_SIZE
+
+
+class StructureIds(Sequence):
+    """
+    Sorted, read-only sequence of Structure IDs (str) that are stored as 12-byte
+    binary ObjectIds, for ChangePlans with tens of millions of deletions.
+
+    The IDs are kept in one or more blocks. Each block is a `(first_id, count,
+    load)` tuple, where `first_id` is the first binary ID in the block, and
+    `load` is a callable that returns the block's buffer of IDs. That lets us
+    leave blocks memory mapped or compressed until we actually need them.
+    """
+    def __init__(self, blocks):
+        self._blocks = list(blocks)
+        self._first_ids = [first_id for first_id, _, _ in self._blocks]
+        self._starts = [0] + list(accumulate(num_ids for _, num_ids, _ in self._blocks))
+
+    @classmethod
+    def from_buffer(cls, buffer):
+        """Create StructureIds from a single sorted buffer of binary IDs."""
+        if not buffer:
+            return cls([])
+        return cls([(bytes(buffer[:OBJECT_ID_SIZE]), len(buffer) // OBJECT_ID_SIZE, lambda: buffer)])
+
+    def __len__(self):
+        return self._starts[-1]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        block_num = bisect_right(self._starts, index) - 1
+        _, _, load = self._blocks[block_num]
+        return _BinaryIds(load())[index - self._starts[block_num]].hex()
+
+    def __iter__(self):
+        for _, _, load in self._blocks:
+            for binary_id in _BinaryIds(load()):
+                yield binary_id.hex()
+
+    def __contains__(self, structure_id):
+        try:
+            binary_id = bytes.fromhex(structure_id)
+        except (TypeError, ValueError):
+            return False
+        block_num = bisect_right(self._first_ids, binary_id) - 1
+        if block_num < 0:
+            return False
+        _, _, load = self._blocks[block_num]
+        return _BinaryIds(load()).find(binary_id) is not None
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, tuple, StructureIds)):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    def __repr__(self):
+        return "<StructureIds: {} IDs in {} blocks>".format(len(self), len(self._blocks))
+
+    def iter_from(self, start):
+        """
+        Iterate through the IDs that are >= `start`, using a binary search to
+        find where to begin.
+        """
+        binary_start = bytes.fromhex(start)
+        first_block = max(bisect_right(self._first_ids, binary_start) - 1, 0)
+        for block_num in range(first_block, len(self._blocks)):
+            block_ids = _BinaryIds(self._blocks[block_num][2]())
+            offset = block_ids.bisect_left(binary_start) if block_num == first_block else 0
+            for i in range(offset, len(block_ids)):
+                yield block_ids[i].hex()
+
+    def binary_blocks(self):
+        """Iterate through the buffers of binary IDs, one per block."""
+        for _, _, load in self._blocks:
+            yield load()
+
+
+class _BinaryIdSet:
+    """
+    Set of 12-byte binary IDs that takes about 12 bytes per ID, for when there
+    are far too many IDs for a Python set.
+
+    IDs are kept in one sorted buffer (searched with _BinaryIds), plus a
+    Python set of recently added IDs. When that set reaches MERGE_THRESHOLD,
+    it's merged into the buffer by copying the slices in between the new IDs,
+    so most of the work happens in C.
+    """
+    MERGE_THRESHOLD = 1000000
+
+    def __init__(self):
+        self._ids = _BinaryIds(b'')
+        self._pending = set()
+
+    def __len__(self):
+        return len(self._ids) + len(self._pending)
+
+    def __contains__(self, binary_id):
+        return binary_id in self._pending or self._ids.find(binary_id) is not None
+
+    def add(self, binary_id):
+        """Add a binary ID to the set."""
+        if binary_id not in self:
+            self._pending.add(binary_id)
+            if len(self._pending) >= self.MERGE_THRESHOLD:
+                self._merge()
+
+    def _merge(self):
+        """Merge pending IDs into the sorted buffer."""
+        buffer = self._ids.buffer
+        merged = bytearray()
+        copied_up_to = 0
+        for binary_id in sorted(self._pending):
+            position = self._ids.bisect_left(binary_id) * OBJECT_ID_SIZE
+            merged += buffer[copied_up_to:position]
+            merged += binary_id
+            copied_up_to = position
+        merged += buffer[copied_up_to:]
+        self._ids = _BinaryIds(bytes(merged))
+        self._pending = set()
+
+
+class _CompactStructuresView(Mapping):
+    """Read-only Mapping of Structure IDs to Structures in a CompactStructuresGraph."""
+    def __init__(self, graph):
+        self._graph = graph
+
+    def __getitem__(self, structure_id):
+        return self._graph.structure_at(self._graph.index_of(structure_id))
+
+    def __contains__(self, structure_id):
+        try:
+            self._graph.index_of(structure_id)
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        return self._graph.structure_ids()
+
+    def __len__(self):
+        return len(self._graph)
+
+
+class StructuresSnapshot:
+    """
+    On-disk copy of the (id, original_id, previous_id) triples of every
+    Structure, so that make_plan doesn't need to read the whole structures
+    collection every time it runs.
+
+    The file is a short header followed by fixed size records of three 12-byte
+    binary ObjectIds (an all-zero previous ID means None), in ascending ID
+    order. Structures are only ever appended to the database, so the last
+    record is a high-water mark: the next scan only needs `_id`s after it.
+    Records are appended and flushed to disk as each batch is read, so an
+    interrupted scan resumes from the last complete batch.
+    """
+    MAGIC = b'tubular-structures-snapshot-v1\n'
+    RECORD_SIZE = 3 * OBJECT_ID_SIZE
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        """
+        Return _PackedStructures for all complete records in the snapshot (no
+        records if the file doesn't exist yet).
+        """
+        if not os.path.exists(self.path):
+            return _accumulate_records([])
+
+        with open(self.path, 'rb') as snapshot_file:
+            if snapshot_file.read(len(self.MAGIC)) != self.MAGIC:
+                raise ValueError("{} is not a Structures snapshot file".format(self.path))
+            data = snapshot_file.read()
+
+        partial_size = len(data) % self.RECORD_SIZE
+        if partial_size:
+            LOG.warning("Ignoring incomplete record at the end of %s", self.path)
+            data = data[:-partial_size]
+
+        # Split the records into columns using strided slices, which is much
+        # faster than looping over every record in Python.
+        num_records = len(data) // self.RECORD_SIZE
+        columns = [bytearray(num_records * OBJECT_ID_SIZE) for _ in range(3)]
+        for column_num, column in enumerate(columns):
+            for byte_num in range(OBJECT_ID_SIZE):
+                column[byte_num::OBJECT_ID_SIZE] = data[column_num * OBJECT_ID_SIZE + byte_num::self.RECORD_SIZE]
+
+        return _PackedStructures(columns[0], columns[1], columns[2], [])
+
+    def save(self, packed):
+        """
+        Replace the snapshot with the contents of `packed` (_PackedStructures).
+        Returns the _PackedStructures that were written, with any out of order
+        records merged in.
+        """
+        packed = _merge_out_of_order(packed)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as snapshot_file:
+            snapshot_file.write(self.MAGIC)
+            snapshot_file.write(self._interleave(packed))
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(temp_path, self.path)
+        return packed
+
+    def append(self, records):
+        """
+        Append (id, original_id, previous_id) tuples of binary IDs to the
+        snapshot and flush them to disk. They must come after all the records
+        that are already in the snapshot.
+        """
+        is_new = not os.path.exists(self.path)
+        with open(self.path, 'ab') as snapshot_file:
+            if is_new:
+                snapshot_file.write(self.MAGIC)
+            snapshot_file.write(b''.join(b''.join(record) for record in records))
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+
+    def _interleave(self, packed):
+        """Convert the columns of _PackedStructures into records."""
+        data = bytearray(len(packed.ids) * 3)
+        for column_num, column in enumerate(packed[:3]):
+            for byte_num in range(OBJECT_ID_SIZE):
+                data[column_num * OBJECT_ID_SIZE + byte_num::self.RECORD_SIZE] = column[byte_num::OBJECT_ID_SIZE]
+        return data
+
+
+class ChangePlan(namedtuple('ChangePlan', 'delete update_parents delete_ranges delete_sizes delete_record_ids')):
     """
     Summary of the pruning actions we want a Backend to take.
 
@@ -149,24 +1046,69 @@ class ChangePlan(namedtuple('ChangePlan', 'delete update_parents')):
     `update_parents` is a list of (structure_id, new_previous_id) tuples
     representing the previous_id updates we need to make.
 
+    `delete_ranges` is a sorted list of (first_id, last_id) tuples for runs of
+    two or more IDs in `delete` that had no other Structure between them when
+    we scanned the database. Those runs can be deleted with range queries
+    instead of listing every ID.
+
+    `delete_sizes` is an array of the size in bytes of each Structure in
+    `delete` (in the same order), or empty if we didn't look up sizes.
+
+    `delete_record_ids` is an array of the storage engine's record ID (the
+    `$recordId` from showRecordId) of each Structure in `delete`, or empty if
+    we didn't look them up. Records that are next to each other in this order
+    are next to each other on disk, which ObjectId order doesn't guarantee.
+
     A ChangePlan is just a declarative. It is the responsibility of the
     Backend to figure out how to implement a ChangePlan safely and efficiently
     in order to do the actual updates.
     """
+    # Binary Change Plan format. The file starts with BINARY_MAGIC and a
+    # BINARY_HEADER (compression, flags, IDs per block, number of deletions,
+    # number of parent updates, number of delete ranges, index offset). Next
+    # come the parent updates and the delete ranges as pairs of binary IDs, the
+    # uint32 size of every deletion (if the BINARY_HAS_SIZES flag is set), the
+    # int64 record ID of every deletion (if BINARY_HAS_RECORD_IDS is set), and
+    # then the blocks of sorted binary IDs to delete, each
+    # compressed separately. The file ends with an index of BINARY_INDEX_ENTRY
+    # records (first ID, offset, length, and number of IDs) for every block.
+    BINARY_MAGIC = b'tubular-change-plan-v1\n'
+    BINARY_HEADER = struct.Struct('<BB2xIQQQQ')
+    BINARY_HAS_SIZES = 1
+    BINARY_HAS_RECORD_IDS = 2
+    BINARY_INDEX_ENTRY = struct.Struct('<12sQII')
+    BINARY_IDS_PER_BLOCK = 65536
+    COMPRESSION_TYPES = ('none', 'gzip', 'zstd')
+
+    def __new__(cls, delete, update_parents, delete_ranges=None, delete_sizes=None, delete_record_ids=None):
+        # Each plan gets its own empty containers, rather than sharing mutable defaults.
+        return super().__new__(
+            cls,
+            delete,
+            update_parents,
+            [] if delete_ranges is None else delete_ranges,
+            array('I') if delete_sizes is None else delete_sizes,
+            array('q') if delete_record_ids is None else delete_record_ids,
+        )
+
     def dump(self, file_obj):
         """Serialize ChangePlan to a file (JSON format)."""
         json.dump(
             {
-                "delete": self.delete,
+                "delete": list(self.delete),
                 "update_parents": self.update_parents,
+                "delete_ranges": self.delete_ranges,
+                "delete_sizes": list(self.delete_sizes),
+                "delete_record_ids": list(self.delete_record_ids),
             },
             file_obj,
             indent=2,
         )
         LOG.info(
-            "Wrote Change Plan: %s (%s deletions, %s parent updates)",
+            "Wrote Change Plan: %s (%s deletions in %s ranges, %s parent updates)",
             os.path.realpath(file_obj.name),
             len(self.delete),
+            len(self.delete_ranges),
             len(self.update_parents)
         )
 
@@ -175,21 +1117,170 @@ class ChangePlan(namedtuple('ChangePlan', 'delete update_parents')):
         """Load a ChangePlan from a JSON file. Takes a file object."""
         data = json.load(file_obj)
         return cls(
-            delete=data["delete"], update_parents=data["update_parents"]
+            delete=data["delete"],
+            update_parents=data["update_parents"],
+            # Plans from before we had delete_ranges just delete by ID.
+            delete_ranges=[tuple(delete_range) for delete_range in data.get("delete_ranges", [])],
+            delete_sizes=array('I', data.get("delete_sizes", [])),
+            delete_record_ids=array('q', data.get("delete_record_ids", [])),
+        )
+
+    def dump_binary(self, file_obj, compression='none', ids_per_block=BINARY_IDS_PER_BLOCK):
+        """
+        Serialize ChangePlan to a file in the compact binary format. Takes a
+        seekable file object opened in binary mode.
+
+        `compression` is one of COMPRESSION_TYPES. Each block of
+        `ids_per_block` IDs is compressed separately, so that a reader can
+        decompress one block at a time.
+        """
+        compress, _ = self._codec(compression)
+        file_obj.write(self.BINARY_MAGIC)
+        header_offset = file_obj.tell()
+        file_obj.write(bytes(self.BINARY_HEADER.size))
+        for first_id, second_id in chain(self.update_parents, self.delete_ranges):
+            file_obj.write(bytes.fromhex(first_id) + bytes.fromhex(second_id))
+        file_obj.write(self._little_endian(self.delete_sizes).tobytes())
+        file_obj.write(self._little_endian(self.delete_record_ids).tobytes())
+
+        index = []
+        last_id = b''
+        for structure_ids_batch in SplitMongoBackend.batch(self.delete, ids_per_block):
+            binary_ids = b''.join(bytes.fromhex(s_id) for s_id in structure_ids_batch)
+            if binary_ids[:OBJECT_ID_SIZE] <= last_id or structure_ids_batch != sorted(set(structure_ids_batch)):
+                raise ValueError("Change Plan deletions must be sorted and unique")
+            last_id = binary_ids[-OBJECT_ID_SIZE:]
+            payload = compress(binary_ids)
+            index.append((binary_ids[:OBJECT_ID_SIZE], file_obj.tell(), len(payload), len(structure_ids_batch)))
+            file_obj.write(payload)
+
+        index_offset = file_obj.tell()
+        for entry in index:
+            file_obj.write(self.BINARY_INDEX_ENTRY.pack(*entry))
+        file_obj.seek(header_offset)
+        file_obj.write(
+            self.BINARY_HEADER.pack(
+                self.COMPRESSION_TYPES.index(compression),
+                (self.BINARY_HAS_SIZES if self.delete_sizes else 0) |
+                (self.BINARY_HAS_RECORD_IDS if self.delete_record_ids else 0),
+                ids_per_block,
+                len(self.delete),
+                len(self.update_parents),
+                len(self.delete_ranges),
+                index_offset,
+            )
+        )
+        file_obj.seek(0, os.SEEK_END)
+        LOG.info(
+            "Wrote binary Change Plan: %s (%s deletions in %s ranges, %s parent updates, %s compression)",
+            os.path.realpath(file_obj.name),
+            len(self.delete),
+            len(self.delete_ranges),
+            len(self.update_parents),
+            compression,
         )
 
     @classmethod
-    def create(cls, structures_graph, num_intermediate_structures, details_file=None):
+    def load_binary(cls, file_obj):
+        """
+        Load a ChangePlan from a binary format file object. The file is memory
+        mapped, and `delete` is a StructureIds that only reads (and
+        decompresses) blocks of IDs as they're needed.
+        """
+        data = mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+        if data[:len(cls.BINARY_MAGIC)] != cls.BINARY_MAGIC:
+            raise ValueError("{} is not a binary Change Plan".format(file_obj.name))
+        offset = len(cls.BINARY_MAGIC)
+        (
+            compression_type, flags, _, num_deletions, num_update_parents, num_delete_ranges, index_offset
+        ) = cls.BINARY_HEADER.unpack_from(data, offset)
+        offset += cls.BINARY_HEADER.size
+        _, decompress = cls._codec(cls.COMPRESSION_TYPES[compression_type])
+
+        id_pairs = []
+        for _ in range(num_update_parents + num_delete_ranges):
+            id_pairs.append((
+                data[offset:offset + OBJECT_ID_SIZE].hex(),
+                data[offset + OBJECT_ID_SIZE:offset + 2 * OBJECT_ID_SIZE].hex(),
+            ))
+            offset += 2 * OBJECT_ID_SIZE
+
+        delete_sizes = array('I')
+        if flags & cls.BINARY_HAS_SIZES:
+            delete_sizes.frombytes(data[offset:offset + num_deletions * delete_sizes.itemsize])
+            delete_sizes = cls._little_endian(delete_sizes)
+            offset += num_deletions * delete_sizes.itemsize
+
+        delete_record_ids = array('q')
+        if flags & cls.BINARY_HAS_RECORD_IDS:
+            delete_record_ids.frombytes(data[offset:offset + num_deletions * delete_record_ids.itemsize])
+            delete_record_ids = cls._little_endian(delete_record_ids)
+
+        def loader(block_offset, block_length):
+            """Return a function to read a block of IDs."""
+            return lambda: decompress(data[block_offset:block_offset + block_length])
+
+        blocks = [
+            (first_id, num_ids, loader(block_offset, block_length))
+            for first_id, block_offset, block_length, num_ids
+            in cls.BINARY_INDEX_ENTRY.iter_unpack(data[index_offset:])
+        ]
+        return cls(
+            delete=StructureIds(blocks),
+            update_parents=id_pairs[:num_update_parents],
+            delete_ranges=id_pairs[num_update_parents:],
+            delete_sizes=delete_sizes,
+            delete_record_ids=delete_record_ids,
+        )
+
+    @classmethod
+    def load_file(cls, path):
+        """Load a ChangePlan from a path, in either JSON or binary format."""
+        with open(path, 'rb') as plan_file:
+            if plan_file.read(len(cls.BINARY_MAGIC)) == cls.BINARY_MAGIC:
+                return cls.load_binary(plan_file)
+        with open(path) as plan_file:
+            return cls.load(plan_file)
+
+    @staticmethod
+    def _little_endian(values):
+        """
+        Convert between an array of sizes or record IDs and little endian order
+        (which is what we use in files), in either direction.
+        """
+        if sys.byteorder == 'little':
+            return values
+        swapped = array(values.typecode, values)
+        swapped.byteswap()
+        return swapped
+
+    @staticmethod
+    def _codec(compression):
+        """Return (compress, decompress) functions for a compression type."""
+        if compression == 'none':
+            return bytes, bytes
+        if compression == 'gzip':
+            return gzip.compress, gzip.decompress
+        if compression == 'zstd':
+            if zstandard is None:
+                raise ValueError("zstd compression requires the zstandard package")
+            return zstandard.ZstdCompressor().compress, zstandard.ZstdDecompressor().decompress
+        raise ValueError("Unknown compression type: {}".format(compression))
+
+    @classmethod
+    def create(cls, structures_graph, num_intermediate_structures, details_file=None, with_ranges=True,
+               size_lookup=None, details_summary_only=False, record_id_lookup=None, keep_policy=None,
+               ranges_before=None):
         """
         Given a StructuresGraph and a target number for intermediate Structures
         to preserve, return a ChangePlan that represents the changes needed to
-        prune the database. The overall strategy is to iterate through all
-        Active Structures, walk back through the ancestors, and add all the
-        Structure IDs we should save to a set. After we have our save set, we
-        know that we can delete all other structures without worrying about
-        whether those Structures are reachable or knowing what their
-        relationships are. This keeps things simpler, and means that we should
-        be more resilient to failures when pruning.
+        prune the database. The overall strategy is to start from all Active
+        Structures, walk back through the ancestors (all branches at once, see
+        RetentionEngine), and flag all the Structures we should save. After we
+        have our save set, we know that we can delete all other structures
+        without worrying about whether those Structures are reachable or
+        knowing what their relationships are. This keeps things simpler, and
+        means that we should be more resilient to failures when pruning.
 
         Structure documents exist in chains of parent/child relationships,
         starting with an Original Structure, having some number of Intermediate
@@ -217,68 +1308,104 @@ class ChangePlan(namedtuple('ChangePlan', 'delete update_parents')):
            way, we're not preserving references to the IDs of Structures that
            have been pruned.
 
+        5. With a `keep_policy` (a KeepPolicy), recent history and an
+           exponentially thinned sample of older history are kept as well.
+           Each kept Structure's `previous_id` is then updated to point to the
+           next older Structure we keep, or to the Original if there isn't one.
+
+        `with_ranges` should only be True if `structures_graph` has every
+        Structure in the database, since delete_ranges rely on there being no
+        other Structures between the IDs that we delete. If `structures_graph`
+        only has every Structure with an ID less than some ID (see
+        MongoDumpBackend.complete_before), pass it as `ranges_before`, and
+        delete_ranges are cut off there.
+
+        `size_lookup` is an optional function that takes the sorted Structure
+        IDs to delete, and returns their sizes in bytes (see
+        SplitMongoBackend.structure_sizes). With it, the ChangePlan has
+        `delete_sizes`, and the details file reports how much space we expect
+        to free.
+
+        `details_summary_only` leaves the listing of every branch's Structures
+        out of the details file (see write_details).
+
+        `record_id_lookup` is like `size_lookup`, but returns record IDs (see
+        SplitMongoBackend.record_ids), which give the ChangePlan
+        `delete_record_ids` so that the backend can delete in the order the
+        Structures are stored in.
         """
-        structure_ids_to_save = set()
-        set_parent_to_original = set()
-
-        branches, structures = structures_graph
-
-        # Figure out which Structures to save...
-        for branch in branches:
-            # Anything that's actively being pointed to (is the head of a branch)
-            # must be preserved. This is what's being served by Studio and LMS.
-            active_structure_id = branch.structure_id
-            structure_ids_to_save.add(active_structure_id)
-
-            # All originals will be saved.
-            structure_ids_to_save.add(structures[active_structure_id].original_id)
-
-            # Save up to `num_intermediate_structures` intermediate nodes
-            int_structure_ids_to_save = structures_graph.traverse_ids(
-                active_structure_id, limit=num_intermediate_structures
-            )
-            for int_structure_id in int_structure_ids_to_save:
-                structure_ids_to_save.add(int_structure_id)
+        branches = structures_graph.branches
+        indexed_graph = structures_graph.indexed()
+        retention = RetentionEngine(indexed_graph)
+        active_idxs = [indexed_graph.index_of(branch.structure_id) for branch in branches]
+
+        # Figure out which Structures to save: Active Structures (this is what's
+        # being served by Studio and LMS), their Originals, and up to
+        # `num_intermediate_structures` intermediate nodes in between.
+        keep, kept_missing = retention.retained(active_idxs, num_intermediate_structures, keep_policy)
+        if keep_policy is not None and keep == retention.retained(active_idxs, num_intermediate_structures)[0]:
+            # The policy didn't keep anything extra, so this is a plain plan.
+            keep_policy = None
 
         # Figure out what links to rewrite -- the oldest structure to save that
-        # isn't an original.
-        for branch in branches:
-            rewrite_candidates = takewhile(
-                lambda s: s in structure_ids_to_save and not structures[s].is_original(),
-                structures_graph.traverse_ids(branch.structure_id, include_start=True)
-            )
-            # `last_seen` will have the last structure_id from the
-            # `rewrite_candidates` iterable.
-            last_seen = deque(rewrite_candidates, 1)
-            if last_seen:
-                structure = structures[last_seen.pop()]
-                # Don't do a rewrite if it's just a no-op...
-                if structure.original_id != structure.previous_id:
-                    set_parent_to_original.add(structure.id)
-
-        # Sort the items in the ChangePlan. This might not be helpful, but I'm
-        # hoping that it will keep disk changes more localized and not thrash
-        # things as much as randomly distributed deletes. Mongo ObjectIDs are
-        # ordered (they have a timestamp component).
+        # isn't an original (or, with gaps in what we keep, every structure to
+        # save whose previous structure won't be).
+        if keep_policy is None:
+            relinks = {
+                index: indexed_graph.original_idxs[index] for index in retention.relinks(active_idxs, keep)
+            }
+        else:
+            relinks = retention.relink_targets(active_idxs, keep)
+
+        # The ChangePlan is sorted, because the graph is. Mongo ObjectIDs are
+        # ordered (they have a timestamp component), which roughly follows the
+        # order Structures were inserted in, but not exactly: IDs are made by
+        # clients with their own clocks, and a restore or resync rewrites the
+        # records in whatever order it reads them. For deletes that really do
+        # follow the order on disk, look up `delete_record_ids` as well.
         change_plan = cls(
-            delete=sorted(structures.keys() - structure_ids_to_save),
+            delete=indexed_graph.unflagged_ids(keep),
             update_parents=sorted(
-                (s_id, structures[s_id].original_id)
-                for s_id in set_parent_to_original
-            )
+                (indexed_graph.id_at(index), indexed_graph.id_at(new_previous))
+                for index, new_previous in relinks.items()
+            ),
+            delete_ranges=cls._delete_ranges(indexed_graph, keep, ranges_before) if with_ranges else [],
         )
+        if size_lookup is not None:
+            change_plan = change_plan._replace(delete_sizes=array('I', size_lookup(change_plan.delete)))
+            LOG.info("Change Plan will free about %s bytes", sum(change_plan.delete_sizes))
+        if record_id_lookup is not None:
+            change_plan = change_plan._replace(delete_record_ids=array('q', record_id_lookup(change_plan.delete)))
 
         if details_file:
             change_plan.write_details(
-                details_file, structures_graph, structure_ids_to_save, set_parent_to_original
+                details_file, structures_graph, keep, len(kept_missing), relinks, details_summary_only
             )
 
         return change_plan
 
     @staticmethod
-    def write_details(details_file, structures_graph, structure_ids_to_save, set_parent_to_original):
+    def _delete_ranges(indexed_graph, keep, ranges_before=None):
+        """
+        Return the (first_id, last_id) of each run of two or more Structures
+        that aren't flagged in `keep`, stopping short of `ranges_before`.
+        """
+        delete_ranges = []
+        # Every Structure we scanned has an index, in ID order, so a run of
+        # unflagged indexes has no Structure we're keeping in between.
+        for start, end in _unflagged_runs(keep):
+            if ranges_before is not None:
+                end = _clip_run(indexed_graph, start, end, ranges_before)
+            if end - start > 1:
+                delete_ranges.append((indexed_graph.id_at(start), indexed_graph.id_at(end - 1)))
+        return delete_ranges
+
+    DETAILS_TOP_COURSES = 10
+
+    def write_details(self, details_file, structures_graph, keep, num_kept_missing, relinks, summary_only=False):
         """
-        Simple dump of the changes we're going to make to the database.
+        Simple dump of the changes we're going to make to the database, with
+        some statistics about the Structures graph.
 
         This method requires information that we don't actually keep in the
         ChangePlan file, such as the Course IDs and edit times. Because of this,
@@ -286,44 +1413,512 @@ class ChangePlan(namedtuple('ChangePlan', 'delete update_parents')):
         and cannot be derived from an existing ChangePlan. The goal was to
         provide this debug information while keeping the ChangePlan file format
         as stupidly simple as possible.
+
+        `keep` is the flags from a RetentionEngine, `relinks` is a dict of the
+        new previous link for each index we re-link, and `num_kept_missing` is
+        the number of Structures we keep that weren't in the graph. The
+        statistics are gathered while visiting each Structure at most once per
+        course, and the listing of every branch's Structures is left out if
+        `summary_only` is True (it has a line for every Structure of every
+        branch, which can be huge).
         """
-        branches, structures = structures_graph
-        active_structure_ids = {branch.structure_id for branch in branches}
+        branches = structures_graph.branches
+        indexed_graph = structures_graph.indexed()
+        size_at = self._delete_size_lookup(keep) if self.delete_sizes else None
+        # The listing of each branch comes from the same walk as the
+        # statistics, but goes after them in the file.
+        branch_details = None if summary_only else tempfile.TemporaryFile('w+')  # pylint: disable=consider-using-with
+        reachable, deleted_by_key, bytes_by_key, length_histogram = self._walk_courses(
+            branches, indexed_graph, keep, relinks, size_at, branch_details
+        )
+        num_orphaned, num_orphaned_chains = self._count_orphans(reachable, indexed_graph.previous_idxs)
+
+        num_to_save = sum(keep) + num_kept_missing
+        summary = [
+            "== Summary ==",
+            "Active Version Branches: {}".format(len(branches)),
+            "Total Structures: {}".format(len(indexed_graph)),
+            "Structures to Save: {}".format(num_to_save),
+            "Structures to Delete: {}".format(len(indexed_graph) - num_to_save),
+            "Structures to Rewrite Parent Link: {}".format(len(relinks)),
+        ]
+        if size_at is not None:
+            summary.append("Bytes to Free: {}".format(sum(self.delete_sizes)))
+
+        summary += [
+            "",
+            "== Statistics ==",
+            "Orphaned Structures: {}".format(num_orphaned),
+            "Orphaned Chains: {}".format(num_orphaned_chains),
+            "Active Structure Chain Lengths:",
+        ]
+        for lower in sorted(length_histogram):
+            upper = max(lower * 2 - 1, lower)
+            length_range = str(lower) if upper == lower else "{}-{}".format(lower, upper)
+            summary.append("  {}: {}".format(length_range, length_histogram[lower]))
+
+        summary += self._top_courses("Top Courses by Structures Deleted", deleted_by_key)
+        if size_at is not None:
+            summary += self._top_courses("Top Courses by Bytes Freed", bytes_by_key)
+        details_file.write("\n".join(summary) + "\n")
+
+        if branch_details is not None:
+            details_file.write("\n== Active Versions ==\n")
+            branch_details.seek(0)
+            shutil.copyfileobj(branch_details, details_file)
+            branch_details.close()
 
-        def text_for(s_id):
-            """Helper method to format Structures consistently."""
-            action = "+" if s_id in structure_ids_to_save else "-"
+        LOG.info(
+            "Wrote Change Details File: %s", os.path.realpath(details_file.name)
+        )
+
+    def _walk_courses(self, branches, indexed_graph, keep, relinks, size_at, branch_details):
+        """
+        Gather the statistics for write_details, and write the listing of each
+        branch to `branch_details` if it isn't None. Returns a tuple of the
+        `reachable` flags, the number of Structures deleted and bytes freed by
+        course, and a histogram of Active Structure chain lengths (by power of
+        two).
+        """
+        previous_idxs = indexed_graph.previous_idxs
+        active_idxs = {indexed_graph.index_of(branch.structure_id) for branch in branches}
+        listing = branch_details is not None
+
+        # Walk each course's branches back once, until we reach the end of the
+        # chain or a Structure that we've already seen for that course (or
+        # all the way, if we're listing the branch). Everything we learn about
+        # a Structure is gathered on that one visit.
+        reachable = bytearray(len(indexed_graph))
+        branches_by_key = defaultdict(list)
+        for branch in branches:
+            branches_by_key[branch.key].append(branch)
+        deleted_by_key = {}
+        bytes_by_key = {}
+        length_histogram = defaultdict(int)
+        measured_idxs = set()
+        for key, key_branches in branches_by_key.items():
+            deleted_by_key[key] = bytes_by_key[key] = 0
+            # Number of Structures from each one we've seen for this course
+            # back to the end of its chain.
+            depths = {}
+            for branch in key_branches:
+                path = []
+                index = indexed_graph.index_of(branch.structure_id)
+                while index >= 0 and (listing or index not in depths):
+                    path.append(index)
+                    index = previous_idxs[index]
+                if listing:
+                    branch_details.write(
+                        self._details_for_branch(branch, path, index, indexed_graph, keep, active_idxs, relinks)
+                    )
+
+                depth = depths[index] if index >= 0 else 0
+                for path_index in reversed(path):
+                    depth += 1
+                    if path_index in depths:
+                        continue
+                    depths[path_index] = depth
+                    reachable[path_index] = 1
+                    if not keep[path_index]:
+                        deleted_by_key[key] += 1
+                        if size_at is not None:
+                            bytes_by_key[key] += size_at(path_index)
+
+                # Each Active Structure's chain is only counted once, even if
+                # several branches point to it.
+                if path and path[0] not in measured_idxs:
+                    measured_idxs.add(path[0])
+                    length_histogram[1 << (depth.bit_length() - 1) if depth else 0] += 1
+        return reachable, deleted_by_key, bytes_by_key, length_histogram
+
+    def _top_courses(self, title, counts):
+        """Details file lines for the courses with the highest counts."""
+        top = sorted(counts.items(), key=lambda item: (-item[1], str(item[0])))[:self.DETAILS_TOP_COURSES]
+        return ["", "== {} ==".format(title)] + ["{} {}".format(key, count) for key, count in top]
+
+    @staticmethod
+    def _count_orphans(reachable, previous_idxs):
+        """
+        Return the number of orphaned Structures (the ones not flagged in
+        `reachable`) and the number of orphaned chains. The ends of orphaned
+        chains are the orphaned Structures that no other orphaned Structure
+        links to, so only orphaned Structures need to be visited.
+        """
+        has_orphaned_child = bytearray(len(reachable))
+        num_orphaned = len(reachable) - sum(reachable)
+        index = reachable.find(0)
+        while index >= 0:
+            previous = previous_idxs[index]
+            if previous >= 0 and not reachable[previous]:
+                has_orphaned_child[previous] = 1
+            index = reachable.find(0, index + 1)
+        return num_orphaned, num_orphaned - sum(has_orphaned_child)
+
+    RANK_BLOCK_SIZE = 4096
+
+    def _delete_size_lookup(self, keep):
+        """
+        Return a function that gives the size of the deleted Structure at an
+        index, from `delete_sizes`.
+
+        `delete` has the unflagged indexes of `keep` in order, so a Structure's
+        position in it is the number of unflagged indexes before it. That's
+        counted from the nearest multiple of RANK_BLOCK_SIZE, with a running
+        total for the blocks before it, instead of keeping a mapping of every
+        deleted ID to its size.
+        """
+        block_size = self.RANK_BLOCK_SIZE
+        deleted_before_block = array('q', chain([0], accumulate(
+            keep.count(0, start, start + block_size) for start in range(0, len(keep), block_size)
+        )))
+
+        def size_at(index):
+            """Size of the deleted Structure at `index`."""
+            block_start = index - index % block_size
+            position = deleted_before_block[index // block_size] + keep.count(0, block_start, index)
+            return self.delete_sizes[position]
+        return size_at
+
+    @staticmethod
+    def _details_for_branch(branch, path, end, indexed_graph, keep, active_idxs, relinks):
+        """
+        Return the details text for a branch, with a line for each Structure
+        in `path` (its indexes from the Active Structure back), and `end` the
+        link value that the last one points to.
+        """
+        lines = ["{}".format(branch)]
+        for index in path:
+            action = "+" if keep[index] else "-"
             notes = []
-            if s_id in active_structure_ids:
+            if index in active_idxs:
                 notes.append("(active)")
-            if s_id in set_parent_to_original:
-                notes.append("(re-link to original)")
-            if structures[s_id].is_original():
+            if index in relinks:
+                if relinks[index] == indexed_graph.original_idxs[index]:
+                    notes.append("(re-link to original)")
+                else:
+                    notes.append("(re-link to {})".format(indexed_graph.id_at(relinks[index])))
+            if indexed_graph.original_idxs[index] == index:
                 notes.append("(original)")
+            lines.append(" ".join([action, indexed_graph.id_at(index)] + notes))
+        if end < NO_STRUCTURE:
+            lines.append("+ {} (missing)".format(indexed_graph.id_at(end)))
 
-            if notes:
-                return "{} {} {}".format(action, s_id, " ".join(notes))
+        return "\n".join(lines) + "\n\n"
 
-            return "{} {}".format(action, s_id)
 
-        print("== Summary ==", file=details_file)
-        print("Active Version Branches: {}".format(len(branches)), file=details_file)
-        print("Total Structures: {}".format(len(structures)), file=details_file)
-        print("Structures to Save: {}".format(len(structure_ids_to_save)), file=details_file)
-        print("Structures to Delete: {}".format(len(structures) - len(structure_ids_to_save)), file=details_file)
-        print("Structures to Rewrite Parent Link: {}".format(len(set_parent_to_original)), file=details_file)
-        print("\n== Active Versions ==", file=details_file)
+class IntegrityReport(
+        namedtuple('IntegrityReport', 'num_structures missing_active dangling_previous dangling_original unreachable')
+):
+    """
+    Problems found by checking every link in a Structures graph, e.g. after a
+    prune.
+
+    `missing_active` is a list of ActiveVersionBranches whose Active Structure
+    doesn't exist. `dangling_previous` and `dangling_original` are lists of
+    (Structure ID, linked Structure ID) pairs where the linked Structure
+    doesn't exist. Those mean that a course is broken, or that it will be when
+    someone looks at its history.
+
+    `unreachable` has the IDs of Structures that no Active Version can reach.
+    These are only wasted space (the next Change Plan will delete them), though
+    a lot of them right after a prune means something went wrong.
+    """
+    # How many of each kind of problem we list in the report.
+    MAX_LISTED = 100
 
-        for branch in branches:
-            print("{}".format(branch), file=details_file)
-            for structure_id in structures_graph.traverse_ids(branch.structure_id, include_start=True):
-                print(text_for(structure_id), file=details_file)
-            print("", file=details_file)
+    @classmethod
+    def create(cls, structures_graph):
+        """
+        Check a StructuresGraph or CompactStructuresGraph. This walks each
+        branch back until it reaches a Structure we've already seen, so every
+        Structure is visited at most once.
+        """
+        indexed_graph = structures_graph.indexed()
+        previous_idxs = indexed_graph.previous_idxs
 
-        LOG.info(
-            "Wrote Change Details File: %s", os.path.realpath(details_file.name)
+        missing_active = []
+        reachable = bytearray(len(indexed_graph))
+        for branch in structures_graph.branches:
+            try:
+                index = indexed_graph.index_of(branch.structure_id)
+            except KeyError:
+                missing_active.append(branch)
+                continue
+            while index >= 0 and not reachable[index]:
+                reachable[index] = 1
+                index = previous_idxs[index]
+
+        def dangling(idxs):
+            """(ID, linked ID) pairs for links to Structures that aren't in the graph."""
+            # Finding the smallest link is quick, and they're almost always fine.
+            if not idxs or min(idxs) >= NO_STRUCTURE:
+                return []
+            return [
+                (indexed_graph.id_at(index), indexed_graph.id_at(link))
+                for index, link in enumerate(idxs)
+                if link < NO_STRUCTURE
+            ]
+
+        return cls(
+            len(indexed_graph),
+            missing_active,
+            dangling(previous_idxs),
+            dangling(indexed_graph.original_idxs),
+            indexed_graph.unflagged_ids(reachable),
+        )
+
+    def is_consistent(self):
+        """Are all Active Structures and all links to other Structures there?"""
+        return not (self.missing_active or self.dangling_previous or self.dangling_original)
+
+    def write(self, out_file):
+        """
+        Write a human-readable report, with up to MAX_LISTED examples of each
+        kind of problem.
+        """
+        out_file.write("== Summary ==\n")
+        out_file.write("Total Structures: {}\n".format(self.num_structures))
+        out_file.write("Missing Active Structures: {}\n".format(len(self.missing_active)))
+        out_file.write("Dangling Previous Links: {}\n".format(len(self.dangling_previous)))
+        out_file.write("Dangling Original Links: {}\n".format(len(self.dangling_original)))
+        out_file.write("Unreachable Structures: {}\n".format(len(self.unreachable)))
+
+        sections = [
+            ("Missing Active Structures", ("{}: {}".format(b, b.structure_id) for b in self.missing_active)),
+            ("Dangling Previous Links", ("{} -> {}".format(*pair) for pair in self.dangling_previous)),
+            ("Dangling Original Links", ("{} -> {}".format(*pair) for pair in self.dangling_original)),
+            ("Unreachable Structures", iter(self.unreachable)),
+        ]
+        for (title, lines), total in zip(sections, [len(problems) for problems in self[1:]]):
+            if not total:
+                continue
+            out_file.write("\n== {} ==\n".format(title))
+            for line in islice(lines, self.MAX_LISTED):
+                out_file.write("{}\n".format(line))
+            if total > self.MAX_LISTED:
+                out_file.write("... and {} more\n".format(total - self.MAX_LISTED))
+
+
+class ReclamationReport(
+        namedtuple('ReclamationReport', 'target num_structures num_deletions num_deleted bytes_to_free seconds error')
+):
+    """
+    What making a Change Plan for (and pruning) one database freed, for
+    reporting on several databases at once.
+
+    `num_deletions` is how many Structures the Change Plan would delete, and
+    `num_deleted` how many were actually deleted (None if we didn't prune).
+    `bytes_to_free` is the total size of the deletions, or None if we didn't
+    look up sizes. `error` is the error that stopped us, if there was one, in
+    which case the counts are as far as we got.
+    """
+    @staticmethod
+    def write_combined(reports, out_file, elapsed=None):
+        """
+        Write a table of `reports`, one database per row, with totals.
+        `elapsed` is the wall clock time for all of them (if they were run at
+        the same time), otherwise the total time is the sum of their times.
+        """
+        row_format = "{:<30} {:>12} {:>12} {:>12} {:>16} {:>10}  {}\n"
+        out_file.write(row_format.format(
+            'Target', 'Structures', 'To Delete', 'Deleted', 'Bytes to Free', 'Seconds', 'Status'
+        ))
+
+        def total(values):
+            """Sum of the values we have, or '-' if we don't have any."""
+            values = [value for value in values if value is not None]
+            return sum(values) if values else '-'
+
+        for report in reports:
+            out_file.write(row_format.format(
+                report.target,
+                report.num_structures if report.num_structures is not None else '-',
+                report.num_deletions if report.num_deletions is not None else '-',
+                report.num_deleted if report.num_deleted is not None else '-',
+                report.bytes_to_free if report.bytes_to_free is not None else '-',
+                '{:.1f}'.format(report.seconds),
+                'ERROR: {}'.format(report.error) if report.error else 'OK',
+            ))
+        num_failed = sum(1 for report in reports if report.error)
+        out_file.write(row_format.format(
+            'Total',
+            total(report.num_structures for report in reports),
+            total(report.num_deletions for report in reports),
+            total(report.num_deleted for report in reports),
+            total(report.bytes_to_free for report in reports),
+            '{:.1f}'.format(sum(report.seconds for report in reports) if elapsed is None else elapsed),
+            '{} failed'.format(num_failed) if num_failed else 'OK',
+        ))
+
+
+class PruneJournal:
+    """
+    Durable record of the delete batches that prune has finished, so that a
+    restarted prune can skip them, even if batches finished out of order.
+
+    The journal is a text file. The first line identifies the Change Plan it
+    belongs to, and each line after that is the first and last Structure ID of
+    a finished batch. Every line is flushed to disk as soon as it's written. A
+    line that was cut off part way (because we crashed while writing it) is
+    discarded when the journal is opened again.
+    """
+    HEADER = "# tubular prune journal: {} deletions, {} - {}\n"
+
+    def __init__(self, path, structure_ids):
+        self.path = path
+        self._finished = []
+        first_id, last_id = (structure_ids[0], structure_ids[-1]) if len(structure_ids) else ('', '')
+        header = self.HEADER.format(len(structure_ids), first_id, last_id)
+
+        if os.path.exists(path):
+            with open(path) as journal_file:
+                lines = journal_file.read().split('\n')
+            # Everything after the last newline is incomplete (normally empty).
+            lines.pop()
+            if not lines or lines[0] + '\n' != header:
+                raise ValueError("{} is not a prune journal for this Change Plan".format(path))
+            self._finished = sorted(tuple(line.split()) for line in lines[1:])
+            self._file = open(path, 'r+')  # pylint: disable=consider-using-with
+            self._file.truncate(sum(len(line) + 1 for line in lines))
+            self._file.seek(0, os.SEEK_END)
+        else:
+            self._file = open(path, 'w')  # pylint: disable=consider-using-with
+            self._write(header)
+
+        LOG.info("Prune journal %s has %s finished batches", path, len(self._finished))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close the journal file."""
+        self._file.close()
+
+    def skip_finished(self, structure_ids):
+        """
+        Iterate through sorted `structure_ids`, leaving out any that are in a
+        batch that the journal says is finished.
+        """
+        finished = iter(self._finished)
+        first_id, last_id = next(finished, (None, None))
+        for structure_id in structure_ids:
+            while last_id is not None and last_id < structure_id:
+                first_id, last_id = next(finished, (None, None))
+            if last_id is None or structure_id < first_id:
+                yield structure_id
+
+    def record(self, first_id, last_id):
+        """Record that the batch of Structure IDs from first_id to last_id is finished."""
+        self._write("{} {}\n".format(first_id, last_id))
+
+    def _write(self, line):
+        """Write a line and make sure it's on disk."""
+        self._file.write(line)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+
+class Throttle:
+    """
+    Paces batched writes with a fixed batch size and a fixed delay (in
+    seconds) after every batch, and keeps track of the throughput achieved.
+    """
+    def __init__(self, delay, batch_size):
+        self.delay = delay
+        self.batch_size = batch_size
+        self.num_items = 0
+        self.elapsed = 0.0
+
+    def batches(self, iterable):
+        """
+        Yield lists of items from `iterable`, each one as long as the current
+        `batch_size`, which can change between batches.
+        """
+        iterator = iter(iterable)
+        while True:
+            curr_batch = list(islice(iterator, self.batch_size))
+            if not curr_batch:
+                return
+            yield curr_batch
+
+    def record(self, num_items, elapsed):
+        """Record that a batch of `num_items` took `elapsed` seconds to write."""
+        self.num_items += num_items
+        self.elapsed += elapsed
+
+    def wait(self):
+        """Sleep between batches."""
+        time.sleep(self.delay)
+        self.elapsed += self.delay
+
+    @property
+    def rate(self):
+        """Items written per second so far, including the time spent waiting."""
+        return self.num_items / self.elapsed if self.elapsed else 0.0
+
+
+class AdaptiveThrottle(Throttle):
+    """
+    Throttle that adjusts its batch size and delay to keep the database within
+    a latency budget, instead of relying on hand-tuned values.
+
+    After every batch we compare the time the write took against
+    `target_latency`. Every `probe_interval` seconds we also call `probe()`,
+    which returns a (replication lag, average write latency) tuple in seconds
+    from the server, where either may be None if it's not available (e.g. a
+    standalone mongod has no replication lag). If everything is within budget,
+    batches grow and the delay shrinks a little at a time; if anything is over
+    budget, we back off quickly by halving the batch size and doubling the
+    delay.
+    """
+    GROWTH_FACTOR = 1.25
+    BACKOFF_FACTOR = 2
+
+    def __init__(self, delay, batch_size, target_latency, max_lag=None, probe=None, probe_interval=5.0,
+                 min_batch_size=10, max_batch_size=10000, max_delay=60.0):
+        super().__init__(delay, batch_size)
+        self.target_latency = target_latency
+        self.max_lag = max_lag
+        self.probe = probe
+        self.probe_interval = probe_interval
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max(max_batch_size, batch_size)
+        self.max_delay = max(max_delay, delay)
+        self._last_probe = None
+
+    def record(self, num_items, elapsed):
+        super().record(num_items, elapsed)
+        lag, server_latency = self._probe_server()
+        over_budget = (
+            elapsed > self.target_latency or
+            (server_latency is not None and server_latency > self.target_latency) or
+            (lag is not None and self.max_lag is not None and lag > self.max_lag)
+        )
+        if over_budget:
+            self.batch_size = max(self.min_batch_size, self.batch_size // self.BACKOFF_FACTOR)
+            self.delay = min(self.max_delay, max(self.delay, 0.1) * self.BACKOFF_FACTOR)
+        else:
+            self.batch_size = min(self.max_batch_size, int(self.batch_size * self.GROWTH_FACTOR) or 1)
+            self.delay = self.delay / self.GROWTH_FACTOR
+        LOG.debug(
+            "Batch of %s took %.3fs (replication lag: %s, server write latency: %s), "
+            "next batch size: %s, delay: %.3fs",
+            num_items, elapsed, lag, server_latency, self.batch_size, self.delay
         )
 
+    def _probe_server(self):
+        """Return (lag, latency) from the probe, if it's time to call it again."""
+        if self.probe is None:
+            return None, None
+        now = time.monotonic()
+        if self._last_probe is not None and now - self._last_probe < self.probe_interval:
+            return None, None
+        self._last_probe = now
+        return self.probe()
+
 
 class SplitMongoBackend:
     """
@@ -334,6 +1929,21 @@ class SplitMongoBackend:
     The methods on this class should accept and return backend-agnostic data
     structures, so no BSON details should leak out.
     """
+    # _id-only batches read this many times more documents than Structure
+    # batches do, since they're so much smaller.
+    ID_SCAN_BATCH_FACTOR = 100
+
+    # Delete ranges can be used as long as nothing new has been added inside
+    # them since we scanned. New Structures get ObjectIds with the current
+    # time, so we only use ranges that end well before now, which leaves room
+    # for clock skew between the servers that create Structures.
+    RANGE_DELETE_MIN_AGE = timedelta(days=1)
+
+    # Studio saves new Definitions before the Structure that uses them, so a
+    # recent Definition that no Structure refers to yet may be about to be
+    # used. We never delete Definitions younger than this.
+    DEFINITION_MIN_AGE = timedelta(days=1)
+
     def __init__(self, mongo_connection_str, db_name):
         self._db = MongoClient(
             mongo_connection_str,
@@ -343,13 +1953,30 @@ class SplitMongoBackend:
         )
         self._active_versions = self._db[db_name].modulestore.active_versions
         self._structures = self._db[db_name].modulestore.structures
+        self._definitions = self._db[db_name].modulestore.definitions
+        self._last_write_latencies = None
+        # Session that reads use, if any (see _point_in_time_reads).
+        self._session = None
 
-    def structures_graph(self, delay, batch_size):
+    def structures_graph(self, delay, batch_size, compact=False, partitions=1, workers=1, snapshot=None,
+                         point_in_time=False):
         """
         Return StructuresGraph for the entire modulestore.
 
         `batch_size` is the number of structure documents we pull at a time.
         `delay` is the delay in seconds between batch queries.
+        `compact` will return a CompactStructuresGraph instead, for databases
+        that are too large to comfortably fit a StructuresGraph in memory.
+        `partitions` splits the scan into that many `_id` ranges (by ObjectId
+        timestamp), which are read concurrently by up to `workers` threads.
+        Each partition has its own cursor, and its own `delay` between batches.
+        `snapshot` is an optional StructuresSnapshot. If it's given, we only
+        read Structures from the database that aren't already in the snapshot
+        (and add them to it), and return a CompactStructuresGraph. Partitions
+        aren't used in this case.
+        `point_in_time` reads everything from a secondary at a single point in
+        time (see _point_in_time_reads). Partitions are then scanned one after
+        the other, since a session can't be shared between threads.
 
         This has one slight complication. A StructuresGraph is expected to be a
         consistent view of the database, but MongoDB doesn't offer a "repeatable
@@ -394,65 +2021,404 @@ class SplitMongoBackend:
         long as it's internally consistent. We only ever delete Structures that
         are in the `structures` doc, so a new Active Version that we're
         completely unaware of will be left alone.
-        """
-        structures = self._all_structures(delay, batch_size)
-        branches = self._all_branches()
 
-        # Guard against the race condition that branch.structure_id or its
-        # ancestors are not in `structures`. Make sure that we add those.
-        LOG.info(
-            "Checking for missing Structures (a small number are expected "
-            "unless edits are disabled during change plan creation)."
-        )
-        missing_count = 0
+        With `point_in_time`, none of this applies: the Branches and Structures
+        are read from the same snapshot of the database, so every Active
+        Structure and its ancestors are there, and we skip the extra fetches.
+        """
+        if point_in_time:
+            workers = 1
+        with self._point_in_time_reads() if point_in_time else nullcontext():
+            if snapshot is not None:
+                compact = True
+                scanned_graph = self._all_structures_from_snapshot(snapshot, delay, batch_size)
+                structures = scanned_graph.structures
+            elif compact:
+                scanned_graph = self._all_structures_compact(delay, batch_size, partitions, workers)
+                structures = scanned_graph.structures
+            else:
+                structures = self._all_structures(delay, batch_size, partitions, workers)
+            branches = self._all_branches()
+
+        missing_structures = {}
         for branch in branches:
-            structure_id = branch.structure_id
-            while structure_id and (structure_id not in structures):
-                structures[structure_id] = self._get_structure(structure_id)
-                missing_count += 1
-                LOG.warning(
-                    "Structure %s linked from Active Structure %s (%s) fetched.",
-                    structure_id,
-                    branch.structure_id,
-                    branch.key,
-                )
-                structure_id = structures[structure_id].previous_id
+            if branch.structure_id not in structures:
+                LOG.warning("Active Structure %s (%s) was not in the scan.", branch.structure_id, branch.key)
+        if not point_in_time:
+            # Guard against the race condition that branch.structure_id or its
+            # ancestors are not in `structures`. Make sure that we add those.
+            LOG.info(
+                "Checking for missing Structures (a small number are expected "
+                "unless edits are disabled during change plan creation)."
+            )
+            missing_structures = self._fetch_chains(
+                {branch.structure_id for branch in branches}, 0, batch_size, structures
+            )
+            LOG.info("Finished checking for missing Structures, found %s", len(missing_structures))
 
-        LOG.info("Finished checking for missing Structures, found %s", missing_count)
+        if compact:
+            return scanned_graph.extended(branches, missing_structures.values())
 
+        structures.update(missing_structures)
         return StructuresGraph(branches, structures)
 
-    def _all_structures(self, delay, batch_size):
+    @contextmanager
+    def _point_in_time_reads(self):
+        """
+        Make reads go to a secondary (if there is one), in a session with
+        readConcern "snapshot", so that they all see the database as it was at
+        the cluster time of the first read.
+
+        This needs MongoDB 5.0 or later. The server only keeps snapshot history
+        for minSnapshotHistoryWindowInSeconds (five minutes by default), so for
+        long scans that must be raised on the secondaries we read from, or reads
+        fail with SnapshotTooOld.
+        """
+        active_versions, structures = self._active_versions, self._structures
+        self._active_versions = active_versions.with_options(read_preference=ReadPreference.SECONDARY_PREFERRED)
+        self._structures = structures.with_options(read_preference=ReadPreference.SECONDARY_PREFERRED)
+        try:
+            with self._db.start_session(snapshot=True) as session:
+                self._session = session
+                yield
+        finally:
+            self._session = None
+            self._active_versions, self._structures = active_versions, structures
+
+    def scoped_structures_graph(self, delay, batch_size, orgs=(), keys=()):
+        """
+        Return StructuresGraph for just the branches of some courses and
+        libraries, without reading the whole structures collection.
+
+        `orgs` is a collection of org names, and `keys` is a collection of
+        CourseLocators and LibraryLocators. Branches that match either are in
+        scope. We walk back from their Active Structures through
+        `previous_version` links, fetching one level of every chain at a time,
+        `batch_size` Structures per query and with `delay` seconds between
+        queries.
+
+        Structures can be shared between courses (e.g. a course rerun starts
+        from the Active Structure of the original course), and we must not
+        delete a Structure that some other branch relies on. Shared Structures
+        always have the same Original, so any other branch whose Active
+        Structure has an Original that's in scope is included as well. That
+        costs one small lookup per Active Version in the database, which is
+        still far less than reading every Structure.
+
+        The graph has only these chains, so it does not have every Structure
+        in the database (see the `with_ranges` argument to ChangePlan.create).
+        """
+        all_branches = self._all_branches()
+        orgs, keys = set(orgs), set(keys)
+        branches = [branch for branch in all_branches if branch.key in keys or branch.key.org in orgs]
+        LOG.info("Found %s Active Version Branches in scope", len(branches))
+
+        structures = self._fetch_chains({branch.structure_id for branch in branches}, delay, batch_size)
+
+        # Add branches that share history with the ones in scope, and keep
+        # going until there aren't any more.
+        other_branches = [branch for branch in all_branches if branch not in branches]
+        other_active_ids = sorted({branch.structure_id for branch in other_branches})
+        other_actives = {
+            structure.id: structure for structure in self._get_structures(other_active_ids, batch_size)
+        }
+        while True:
+            original_ids = {structure.original_id for structure in structures.values()}
+            sharing_branches = [
+                branch for branch in other_branches
+                if branch.structure_id in other_actives
+                and other_actives[branch.structure_id].original_id in original_ids
+            ]
+            if not sharing_branches:
+                break
+            LOG.info("Adding %s Active Version Branches that share history", len(sharing_branches))
+            branches.extend(sharing_branches)
+            other_branches = [branch for branch in other_branches if branch not in sharing_branches]
+            structures.update(
+                self._fetch_chains({branch.structure_id for branch in sharing_branches}, delay, batch_size, structures)
+            )
+
+        return StructuresGraph(sorted(branches), structures)
+
+    def _fetch_chains(self, structure_ids, delay, batch_size, known_structures=None):
+        """
+        Return a dict of the Structures for `structure_ids` and all of their
+        ancestors, leaving out any that are in `known_structures`. Each query
+        fetches up to `batch_size` Structures, and we fetch a whole generation
+        of every chain before moving on to the next.
+        """
+        if known_structures is None:
+            known_structures = {}
+        structures = {}
+        num_queried = num_queries = 0
+        to_fetch = {s_id for s_id in structure_ids if s_id not in known_structures}
+        while to_fetch:
+            for structure in self._get_structures(sorted(to_fetch), batch_size):
+                structures[structure.id] = structure
+            num_queried += len(to_fetch)
+            num_queries += (len(to_fetch) + batch_size - 1) // batch_size
+            previous_ids = {structures[s_id].previous_id for s_id in to_fetch if s_id in structures}
+            to_fetch = {
+                s_id for s_id in previous_ids
+                if s_id is not None and s_id not in structures and s_id not in known_structures
+            }
+            time.sleep(delay)
+        LOG.info(
+            "Fetched %s Structures in %s queries (%s fewer round trips than one query per Structure)",
+            len(structures),
+            num_queries,
+            num_queried - num_queries,
+        )
+        return structures
+
+    def _all_structures(self, delay, batch_size, partitions=1, workers=1):
         """
         Return a dict mapping Structure IDs to Structures for all Structures in
         the database.
 
         `batch_size` is the number of structure documents we pull at a time.
         `delay` is the delay in seconds between batch queries.
+        `partitions` and `workers` control parallel scanning (see
+        structures_graph).
         """
         LOG.info("Fetching all known Structures (this might take a while)...")
         LOG.info("Delay in seconds: %s, Batch size: %s", delay, batch_size)
 
-        # Important to keep this as a generator to limit memory usage.
-        parsed_docs = (
-            self.parse_structure_doc(doc)
-            for doc
-            in self._structures_from_db(delay, batch_size)
+        structures = {}
+        partition_results = self._scan_partitions(
+            delay,
+            batch_size,
+            partitions,
+            workers,
+            lambda parsed_docs: {structure.id: structure for structure in parsed_docs},
         )
-        structures = {structure.id: structure for structure in parsed_docs}
+        for partition_structures in partition_results:
+            structures.update(partition_structures)
         LOG.info("Fetched %s Structures", len(structures))
 
         return structures
 
-    def _structures_from_db(self, delay, batch_size):
+    def _all_structures_compact(self, delay, batch_size, partitions=1, workers=1):
+        """
+        Return a CompactStructuresGraph (with no branches) for all Structures in
+        the database.
+
+        `batch_size` is the number of structure documents we pull at a time.
+        `delay` is the delay in seconds between batch queries.
+        `partitions` and `workers` control parallel scanning (see
+        structures_graph).
+        """
+        LOG.info("Fetching all known Structures in ID order (this might take a while)...")
+        LOG.info("Delay in seconds: %s, Batch size: %s", delay, batch_size)
+
+        partition_results = self._scan_partitions(
+            delay,
+            batch_size,
+            partitions,
+            workers,
+            CompactStructuresGraph.scan_partition,
+            sort_by_id=True,
+        )
+        graph = CompactStructuresGraph.from_partitions([], partition_results)
+        LOG.info("Fetched %s Structures", len(graph))
+
+        return graph
+
+    def _all_structures_from_snapshot(self, snapshot, delay, batch_size):
+        """
+        Return a CompactStructuresGraph (with no branches) for all Structures in
+        the database, using `snapshot` (a StructuresSnapshot) for Structures
+        we've seen before and only reading newer ones from the database. New
+        Structures are appended to the snapshot after each batch.
+
+        `batch_size` is the number of structure documents we pull at a time.
+        `delay` is the delay in seconds between batch queries.
+        """
+        packed = snapshot.load()
+        LOG.info(
+            "Loaded %s Structures from snapshot %s",
+            len(packed.ids) // OBJECT_ID_SIZE,
+            os.path.realpath(snapshot.path),
+        )
+        high_water = None
+        if packed.ids:
+            high_water = ObjectId(bytes(packed.ids[-OBJECT_ID_SIZE:]))
+            packed = snapshot.save(self._recheck_snapshot(packed, high_water, delay, batch_size))
+
+        LOG.info("Fetching Structures after %s (this might take a while)...", high_water)
+        LOG.info("Delay in seconds: %s, Batch size: %s", delay, batch_size)
+
+        def checkpointed(records):
+            """Pass through records, appending each batch to the snapshot."""
+            for records_batch in self.batch(records, batch_size):
+                snapshot.append(records_batch)
+                yield from records_batch
+
+        new_docs = self._structures_from_db(delay, batch_size, True, (high_water, None))
+        new_packed = _accumulate_records(checkpointed(
+            _pack_structure(self.parse_structure_doc(doc))
+            for doc in new_docs
+            if doc['_id'] != high_water
+        ))
+        LOG.info("Fetched %s new Structures", len(new_packed.ids) // OBJECT_ID_SIZE)
+
+        graph = CompactStructuresGraph.from_partitions([], [packed, new_packed])
+        LOG.info("Structures total: %s", len(graph))
+
+        return graph
+
+    def _recheck_snapshot(self, packed, high_water, delay, batch_size):
+        """
+        Reconcile Structures loaded from a snapshot with the database, reading
+        only the `_id` index for Structures up to `high_water`. Returns updated
+        _PackedStructures.
+
+        Structures can't change, but they can be deleted (by `prune`), and
+        Structures with IDs older than our high-water mark can still show up
+        if clocks on Studio servers are skewed. Pruning also re-links the
+        previous_version of the oldest retained Structures, so any Structure
+        whose previous link points to a deleted Structure is fetched again.
+        """
+        LOG.info("Checking snapshot against the database (up to %s)...", high_water)
+        db_ids = (doc['_id'].binary for doc in self._ids_from_db(high_water, delay, batch_size))
+        ids = bytearray()
+        original_ids = bytearray()
+        previous_ids = bytearray()
+        deleted_ids = bytearray()
+        unknown_ids = []
+
+        db_id = next(db_ids, None)
+        for record in _unpack_records(packed):
+            while db_id is not None and db_id < record[0]:
+                unknown_ids.append(db_id)
+                db_id = next(db_ids, None)
+            if db_id == record[0]:
+                ids += record[0]
+                original_ids += record[1]
+                previous_ids += record[2]
+                db_id = next(db_ids, None)
+            else:
+                deleted_ids += record[0]
+        while db_id is not None:
+            unknown_ids.append(db_id)
+            db_id = next(db_ids, None)
+
+        relinked_ids = []
+        if deleted_ids:
+            deleted = _BinaryIds(bytes(deleted_ids))
+            for start in range(0, len(previous_ids), OBJECT_ID_SIZE):
+                previous_id = bytes(previous_ids[start:start + OBJECT_ID_SIZE])
+                if previous_id != _NULL_ID and deleted.find(previous_id) is not None:
+                    relinked_ids.append(bytes(ids[start:start + OBJECT_ID_SIZE]))
+
+        out_of_order = []
+        unknown_ids = set(unknown_ids)
+        kept_ids = _BinaryIds(ids)
+        fetch_ids = [binary_id.hex() for binary_id in chain(relinked_ids, unknown_ids)]
+        for structure in self._get_structures(fetch_ids, batch_size):
+            record = _pack_structure(structure)
+            if record[0] in unknown_ids:
+                out_of_order.append(record)
+            else:
+                position = kept_ids.find(record[0]) * OBJECT_ID_SIZE
+                previous_ids[position:position + OBJECT_ID_SIZE] = record[2]
+
+        LOG.info(
+            "Snapshot check found %s deleted, %s added, and %s re-linked Structures",
+            len(deleted_ids) // OBJECT_ID_SIZE,
+            len(out_of_order),
+            len(relinked_ids),
+        )
+        return _PackedStructures(ids, original_ids, previous_ids, out_of_order)
+
+    def _ids_from_db(self, high_water, delay, batch_size, collection=None):
+        """
+        Iterate through `_id`-only Structure documents (or documents from
+        another `collection`) up to `high_water`, in ascending order. This is
+        answered from the `_id` index, so it reads far less than a normal scan.
+        Batches are ID_SCAN_BATCH_FACTOR times `batch_size`, since each result
+        is tiny compared to a Structure.
+        """
+        if collection is None:
+            collection = self._structures
+        id_batch_size = batch_size * self.ID_SCAN_BATCH_FACTOR
+        cursor = collection.find(
+            {'_id': {'$lte': high_water}},
+            projection={'_id': True},
+            sort=[('_id', ASCENDING)],
+            session=self._session,
+        )
+        cursor.batch_size(id_batch_size)
+        for i, id_doc in enumerate(cursor, start=1):
+            yield id_doc
+            if i % id_batch_size == 0:
+                LOG.info("ID Cursor for %s at %s (%s)", collection.name, i, id_doc['_id'])
+                time.sleep(delay)
+
+    def _scan_partitions(self, delay, batch_size, partitions, workers, scan_fn, sort_by_id=False):
+        """
+        Split the structures collection into `_id` ranges and return a list of
+        `scan_fn(parsed_docs)` results, one per range, in ascending `_id` order.
+
+        Ranges are scanned by up to `workers` threads at a time, each with its
+        own cursor. `scan_fn` should consume the iterable of Structures it's
+        given, since that's what actually reads from the database.
+        """
+        id_ranges = self._id_ranges(partitions)
+
+        def scan(id_range):
+            """Read and parse one range."""
+            return scan_fn(
+                self.parse_structure_doc(doc)
+                for doc
+                in self._structures_from_db(delay, batch_size, sort_by_id, id_range)
+            )
+
+        if len(id_ranges) == 1:
+            return [scan(id_ranges[0])]
+
+        LOG.info("Scanning %s partitions with %s workers", len(id_ranges), workers)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(scan, id_ranges))
+
+    def _id_ranges(self, partitions):
+        """
+        Return a list of (lower, upper) ObjectId pairs that split the Structure
+        `_id` space into `partitions` ranges of equal ObjectId timestamp width.
+        Lower bounds are inclusive, upper bounds are exclusive, and None means
+        unbounded (so that the outermost ranges catch everything).
+        """
+        if partitions <= 1:
+            return [(None, None)]
+
+        first_doc = self._structures.find_one(sort=[('_id', ASCENDING)], projection=[], session=self._session)
+        last_doc = self._structures.find_one(sort=[('_id', DESCENDING)], projection=[], session=self._session)
+        if first_doc is None:
+            return [(None, None)]
+
+        start = first_doc['_id'].generation_time
+        step = (last_doc['_id'].generation_time - start) / partitions
+        boundaries = sorted({
+            ObjectId.from_datetime(start + step * i) for i in range(1, partitions)
+        })
+        return list(zip([None] + boundaries, boundaries + [None]))
+
+    def _structures_from_db(self, delay, batch_size, sort_by_id=False, id_range=(None, None)):
         """
         Iterate through all Structure documents in the database.
 
         `batch_size` is the number of structure documents we pull at a time.
         `delay` is the delay in seconds between batch queries.
+        `sort_by_id` returns documents in `_id` order, which is what lets us
+        build a CompactStructuresGraph without re-sorting everything.
+        `id_range` is a (lower, upper) pair of ObjectIds to restrict the scan
+        to (see _id_ranges).
         """
         cursor = self._structures.find(
-            projection=['original_version', 'previous_version']
+            self._id_range_query(*id_range),
+            projection=['original_version', 'previous_version'],
+            sort=[('_id', ASCENDING)] if sort_by_id else None,
+            session=self._session,
         )
         cursor.batch_size(batch_size)
         for i, structure_doc in enumerate(cursor, start=1):
@@ -461,57 +2427,247 @@ class SplitMongoBackend:
                 LOG.info("Structure Cursor at %s (%s)", i, structure_doc['_id'])
                 time.sleep(delay)
 
+    @staticmethod
+    def _id_range_query(lower=None, upper=None):
+        """Query for `_id`s in [lower, upper), where None is unbounded."""
+        bounds = {}
+        if lower is not None:
+            bounds['$gte'] = lower
+        if upper is not None:
+            bounds['$lt'] = upper
+        return {'_id': bounds} if bounds else {}
+
     def _all_branches(self):
         """Retrieve list of all ActiveVersionBranch objects in the database."""
         branches = []
         LOG.info("Fetching all Active Version Branches...")
 
-        for av_doc in self._active_versions.find():
-            for branch, obj_id in av_doc['versions'].items():
-                structure_id = str(obj_id)
-                if branch == 'library':
-                    key = LibraryLocator(av_doc['org'], av_doc['course'])
-                else:
-                    key = CourseLocator(av_doc['org'], av_doc['course'], av_doc['run'])
-
-                branches.append(
-                    ActiveVersionBranch(
-                        str(av_doc['_id']),
-                        branch,
-                        structure_id,
-                        key,
-                        av_doc['edited_on'],
-                    )
-                )
+        for av_doc in self._active_versions.find(session=self._session):
+            branches.extend(self.parse_active_version_doc(av_doc))
 
         LOG.info("Fetched %s Active Version Branches", len(branches))
 
         return sorted(branches)
 
-    def _get_structure(self, structure_id):
-        """Get an individual Structure from the database."""
-        structure_doc = self._structures.find_one(
-            {'_id': ObjectId(structure_id)},
-            projection=['original_version', 'previous_version']
+    def _get_structures(self, structure_ids, batch_size):
+        """
+        Iterate through Structures for a list of Structure IDs, fetching them
+        from the database `batch_size` at a time. Structures that don't exist
+        are skipped.
+        """
+        for structure_ids_batch in self.batch(structure_ids, batch_size):
+            cursor = self._structures.find(
+                {'_id': {'$in': [ObjectId(s_id) for s_id in structure_ids_batch]}},
+                projection=['original_version', 'previous_version'],
+                session=self._session,
+            )
+            for structure_doc in cursor:
+                yield self.parse_structure_doc(structure_doc)
+
+    def structure_sizes(self, structure_ids, delay, batch_size):
+        """
+        Return a list of the sizes in bytes of the Structures in
+        `structure_ids` (in the same order), using the $bsonSize of each
+        document (requires MongoDB 4.4 or later). Structures that don't exist
+        any more have a size of 0.
+        """
+        sizes = []
+        LOG.info("Fetching sizes of %s Structures...", len(structure_ids))
+        for structure_ids_batch in self.batch(structure_ids, batch_size):
+            cursor = self._structures.find(
+                {'_id': {'$in': [ObjectId(s_id) for s_id in structure_ids_batch]}},
+                projection={'size': {'$bsonSize': '$$ROOT'}}
+            )
+            batch_sizes = {str(size_doc['_id']): size_doc['size'] for size_doc in cursor}
+            sizes.extend(batch_sizes.get(s_id, 0) for s_id in structure_ids_batch)
+            time.sleep(delay)
+        return sizes
+
+    def record_ids(self, structure_ids, delay, batch_size):
+        """
+        Return a list of the record IDs of the Structures in `structure_ids`
+        (in the same order), which is where WiredTiger stores them: records
+        with nearby IDs are on the same or neighbouring pages. Structures that
+        don't exist any more have a record ID of 0, which is never used.
+
+        This relies on the collection being a regular (not clustered) one,
+        where record IDs are 64 bit integers.
+        """
+        record_ids = []
+        LOG.info("Fetching record IDs of %s Structures...", len(structure_ids))
+        for structure_ids_batch in self.batch(structure_ids, batch_size):
+            cursor = self._structures.find(
+                {'_id': {'$in': [ObjectId(s_id) for s_id in structure_ids_batch]}},
+                projection=[],
+                show_record_id=True,
+            )
+            batch_record_ids = {str(record_doc['_id']): record_doc['$recordId'] for record_doc in cursor}
+            record_ids.extend(batch_record_ids.get(s_id, 0) for s_id in structure_ids_batch)
+            time.sleep(delay)
+        return record_ids
+
+    def prune_definitions(self, delay, batch_size, throttle, dry_run=False):
+        """
+        Delete the Definitions that no Structure refers to any more, and return
+        how many of those we found.
+
+        This should run after pruning Structures (not at the same time), since
+        that's what leaves Definitions unreferenced. We read the `blocks` of
+        every Structure, `batch_size` documents at a time with `delay` seconds
+        between batches, and keep the referenced Definition IDs in a
+        _BinaryIdSet. Then we scan the Definition IDs (older than
+        DEFINITION_MIN_AGE) and delete the unreferenced ones in batches paced
+        by `throttle`. With `dry_run`, we only count them.
+        """
+        cutoff_id = ObjectId.from_datetime(datetime.now(timezone.utc) - self.DEFINITION_MIN_AGE)
+        referenced = self._referenced_definitions(delay, batch_size)
+
+        unreferenced = bytearray()
+        num_definitions = 0
+        for id_doc in self._ids_from_db(cutoff_id, delay, batch_size, self._definitions):
+            num_definitions += 1
+            if id_doc['_id'].binary not in referenced:
+                unreferenced += id_doc['_id'].binary
+        unreferenced = _BinaryIds(bytes(unreferenced))
+        LOG.info(
+            "Found %s unreferenced Definitions out of %s older than %s",
+            len(unreferenced),
+            num_definitions,
+            cutoff_id.generation_time,
         )
-        return self.parse_structure_doc(structure_doc)
+        if dry_run:
+            return len(unreferenced)
+
+        deleted_count = 0
+        definition_ids = (binary_id.hex() for binary_id in unreferenced)
+        for definition_ids_batch in throttle.batches(definition_ids):
+            batch_start = time.monotonic()
+            result = self._definitions.delete_many(
+                {'_id': {'$in': [ObjectId(d_id) for d_id in definition_ids_batch]}}
+            )
+            throttle.record(len(definition_ids_batch), time.monotonic() - batch_start)
+            deleted_count += result.deleted_count
+            LOG.info(
+                "Deleted %s/%s Definitions: %s - %s",
+                result.deleted_count,
+                len(definition_ids_batch),
+                definition_ids_batch[0],
+                definition_ids_batch[-1],
+            )
+            throttle.wait()
+
+        LOG.info("Deleted %s Definitions", deleted_count)
+        return len(unreferenced)
 
-    def update(self, change_plan, delay=1000, batch_size=1000, start=None):
+    def _referenced_definitions(self, delay, batch_size):
+        """
+        Return a _BinaryIdSet of every Definition ID that a Structure refers
+        to. Only the `definition` field of each block is read, and we only hold
+        one batch of Structures at a time.
+        """
+        referenced = _BinaryIdSet()
+        cursor = self._structures.find({}, projection={'blocks.definition': True})
+        cursor.batch_size(batch_size)
+        num_structures = 0
+        for num_structures, structure_doc in enumerate(cursor, start=1):
+            blocks = structure_doc.get('blocks', [])
+            # Deleting Definitions that we failed to find references to would
+            # break courses, so refuse to go on if the format isn't what we
+            # expect.
+            if not isinstance(blocks, list):
+                raise ValueError(
+                    "Structure {} has blocks in an unsupported format".format(structure_doc['_id'])
+                )
+            for block in blocks:
+                if 'definition' in block:
+                    referenced.add(block['definition'].binary)
+            if num_structures % batch_size == 0:
+                LOG.info("Structure Cursor at %s (%s)", num_structures, structure_doc['_id'])
+                time.sleep(delay)
+
+        LOG.info("Found %s Definitions referenced by %s Structures", len(referenced), num_structures)
+        return referenced
+
+    def update(self, change_plan, delay=1000, batch_size=1000, start=None, throttle=None, journal=None,
+               concurrency=1, largest_first=False, record_order=False):
         """
         Update the backend according to the relinking and deletions specified in
-        the change_plan.
+        the change_plan, and return how many Structures were deleted.
+
+        Writes are paced by `throttle` (see AdaptiveThrottle). If it's None, we
+        use a fixed `delay` (in seconds) after every batch of `batch_size`.
+        Deletions can be recorded in a PruneJournal so that an interrupted run
+        picks up where it left off, and up to `concurrency` delete batches are
+        run at the same time.
+
+        `largest_first` deletes the biggest Structures first (this requires
+        `delete_sizes` in the ChangePlan), so that a time limited run frees as
+        much space as possible. Batches are then no longer ranges of IDs, so
+        this can't be combined with `start` or `journal`.
+
+        `record_order` deletes Structures in the order they're stored on disk
+        (this requires `delete_record_ids` in the ChangePlan), so that each
+        batch touches as few pages as possible. Like `largest_first`, it can't
+        be combined with `start` or `journal`.
         """
+        if largest_first and record_order:
+            raise ValueError("Structures can't be deleted both largest first and in record order")
+        if (largest_first or record_order) and (start is not None or journal is not None):
+            raise ValueError("Deleting out of ID order can't be combined with a start or journal")
+        if throttle is None:
+            throttle = Throttle(delay, batch_size)
+
         # Step 1: Relink - Change the previous pointer for the oldest structure
         # we want to keep, so that it points back to the original. We never
         # delete the original. Relinking happens before deletion so that we
         # never leave our course in a broken state (at worst, parts of it
         # become unreachable).
-        self._update_parents(change_plan.update_parents, delay, batch_size)
+        self._update_parents(change_plan.update_parents, throttle)
 
         # Step 2: Delete unused Structures
-        self._delete(change_plan.delete, delay, batch_size, start)
+        if largest_first:
+            return self._delete(self._largest_first(change_plan), throttle, concurrency=concurrency)
+        if record_order:
+            return self._delete(self._in_record_order(change_plan), throttle, concurrency=concurrency)
+        return self._delete(change_plan.delete, throttle, start, journal, concurrency, change_plan.delete_ranges)
 
-    def _update_parents(self, id_parent_pairs, delay, batch_size):
+    def server_metrics(self):
+        """
+        Return a (replication lag, average write latency) tuple in seconds, for
+        use as an AdaptiveThrottle probe.
+
+        Replication lag is how far the furthest behind secondary is from the
+        primary, and is None if we're not talking to a replica set. Write
+        latency is the average over the writes since the last call, taken from
+        serverStatus, and is None on the first call or if it's unavailable.
+        """
+        lag = None
+        try:
+            status = self._db.admin.command('replSetGetStatus')
+        except OperationFailure:
+            pass
+        else:
+            primary_optimes = [
+                member['optimeDate'] for member in status['members'] if member.get('stateStr') == 'PRIMARY'
+            ]
+            secondary_optimes = [
+                member['optimeDate'] for member in status['members'] if member.get('stateStr') == 'SECONDARY'
+            ]
+            if primary_optimes and secondary_optimes:
+                lag = max((primary_optimes[0] - optime).total_seconds() for optime in secondary_optimes)
+
+        latency = None
+        try:
+            writes = self._db.admin.command('serverStatus')['opLatencies']['writes']
+        except (OperationFailure, KeyError):
+            return lag, latency
+        last_writes, self._last_write_latencies = self._last_write_latencies, writes
+        if last_writes is not None and writes['ops'] > last_writes['ops']:
+            # opLatencies are cumulative and in microseconds.
+            latency = (writes['latency'] - last_writes['latency']) / (writes['ops'] - last_writes['ops']) / 1e6
+        return lag, latency
+
+    def _update_parents(self, id_parent_pairs, throttle):
         """
         Update Structure parent relationships.
 
@@ -519,7 +2675,7 @@ class SplitMongoBackend:
         tuple is a Structure ID (str) to target, and the second element is the
         Structure ID that will be the new parent of the first element.
         """
-        for id_parent_pairs_batch in self.batch(id_parent_pairs, batch_size):
+        for id_parent_pairs_batch in throttle.batches(id_parent_pairs):
             updates = [
                 UpdateOne(
                     {'_id': ObjectId(structure_id)},
@@ -527,39 +2683,163 @@ class SplitMongoBackend:
                 )
                 for structure_id, previous_id in id_parent_pairs_batch
             ]
+            batch_start = time.monotonic()
             result = self._structures.bulk_write(updates)
+            throttle.record(len(updates), time.monotonic() - batch_start)
             LOG.info(
                 "Updated %s/%s parent relationships.",
                 result.bulk_api_result['nModified'],
                 result.bulk_api_result['nMatched'],
             )
-            time.sleep(delay)
+            throttle.wait()
 
-    def _delete(self, structure_ids, delay, batch_size, start=None):
+    def _delete(self, structure_ids, throttle, start=None, journal=None, concurrency=1, delete_ranges=()):
         """
-        Delete old structures in batches.
+        Delete old structures in batches, and return how many were deleted.
 
         `structure_ids` is a list of Structure IDs to delete.
-        `delay` is the delay in seconds (floats are ok) between batch deletes.
-        `batch_size` is how many we try to delete in each batch statement.
+        `throttle` decides how many we try to delete in each batch statement,
+        and how long to wait between batches.
+        `journal` is an optional PruneJournal. Batches that it has recorded as
+        finished are skipped, and every batch that finishes is recorded.
+        `concurrency` is how many batches we can have in flight at once.
+        `delete_ranges` is a sorted list of (first_id, last_id) runs of
+        `structure_ids` that have no other Structures in between, which we can
+        delete with `_id` range queries (see ChangePlan).
         """
+        cutoff_id = str(ObjectId.from_datetime(datetime.now(timezone.utc) - self.RANGE_DELETE_MIN_AGE))
+        delete_ranges = [delete_range for delete_range in delete_ranges if delete_range[1] < cutoff_id]
+        range_firsts = [first_id for first_id, _ in delete_ranges]
         s_ids_with_offset = self.iter_from_start(structure_ids, start)
-        for structure_ids_batch in self.batch(s_ids_with_offset, batch_size):
-            result = self._structures.delete_many(
-                {
-                    '_id': {
-                        '$in': [ObjectId(s_id) for s_id in structure_ids_batch]
-                    }
-                }
-            )
-            LOG.info(
-                "Deleted %s/%s Structures: %s - %s",
-                result.deleted_count,
-                len(structure_ids_batch),
-                structure_ids_batch[0],
-                structure_ids_batch[-1],
-            )
-            time.sleep(delay)
+        if journal is not None:
+            s_ids_with_offset = journal.skip_finished(s_ids_with_offset)
+
+        delete_start = time.monotonic()
+        deleted_count = 0
+        in_flight = set()
+
+        def finish(futures):
+            """Record and log batches that are done (re-raising any errors)."""
+            nonlocal deleted_count
+            for future in futures:
+                structure_ids_batch, result, elapsed = future.result()
+                throttle.record(len(structure_ids_batch), elapsed)
+                if journal is not None:
+                    journal.record(structure_ids_batch[0], structure_ids_batch[-1])
+                deleted_count += result.deleted_count
+                if result.deleted_count > len(structure_ids_batch):
+                    LOG.error(
+                        "Deleted %s Structures from a batch of %s IDs: %s - %s",
+                        result.deleted_count,
+                        len(structure_ids_batch),
+                        structure_ids_batch[0],
+                        structure_ids_batch[-1],
+                    )
+                LOG.info(
+                    "Deleted %s/%s Structures: %s - %s",
+                    result.deleted_count,
+                    len(structure_ids_batch),
+                    structure_ids_batch[0],
+                    structure_ids_batch[-1],
+                )
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for structure_ids_batch in throttle.batches(s_ids_with_offset):
+                if len(in_flight) >= concurrency:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    finish(done)
+                query = self._delete_query(structure_ids_batch, delete_ranges, range_firsts)
+                in_flight.add(executor.submit(self._delete_batch, structure_ids_batch, query))
+                throttle.wait()
+            finish(as_completed(in_flight))
+
+        delete_time = time.monotonic() - delete_start
+        LOG.info(
+            "Deleted %s Structures in %.1f seconds (%.1f deletes/sec, batch size: %s, delay: %.3fs)",
+            deleted_count,
+            delete_time,
+            deleted_count / delete_time if delete_time else 0.0,
+            throttle.batch_size,
+            throttle.delay,
+        )
+        return deleted_count
+
+    @classmethod
+    def _largest_first(cls, change_plan):
+        """Iterate through the deletions of a ChangePlan from largest to smallest."""
+        sizes = change_plan.delete_sizes
+        if len(sizes) != len(change_plan.delete):
+            raise ValueError("Change Plan doesn't have the sizes of the Structures to delete")
+        LOG.info("Deleting the largest of %s Structures (%s bytes) first", len(sizes), sum(sizes))
+        return cls._ordered_deletions(change_plan, sizes, reverse=True)
+
+    @classmethod
+    def _in_record_order(cls, change_plan):
+        """Iterate through the deletions of a ChangePlan in the order they're stored in."""
+        record_ids = change_plan.delete_record_ids
+        if len(record_ids) != len(change_plan.delete):
+            raise ValueError("Change Plan doesn't have the record IDs of the Structures to delete")
+        LOG.info("Deleting %s Structures in record order", len(record_ids))
+        return cls._ordered_deletions(change_plan, record_ids)
+
+    @staticmethod
+    def _ordered_deletions(change_plan, keys, reverse=False):
+        """
+        Iterate through the deletions of a ChangePlan sorted by `keys`, an
+        array with a key for each deletion.
+        """
+        if isinstance(change_plan.delete, StructureIds):
+            # Random access into blocks is slow, so load all the IDs as one
+            # buffer (12 bytes each) first.
+            binary_ids = b''.join(change_plan.delete.binary_blocks())
+
+            def id_at(index):
+                """Return the Structure ID at `index`."""
+                return binary_ids[index * OBJECT_ID_SIZE:(index + 1) * OBJECT_ID_SIZE].hex()
+        else:
+            id_at = change_plan.delete.__getitem__
+        for index in sorted(range(len(keys)), key=keys.__getitem__, reverse=reverse):
+            yield id_at(index)
+
+    def _delete_batch(self, structure_ids_batch, query):
+        """Delete one batch, returning (batch, result, elapsed seconds)."""
+        batch_start = time.monotonic()
+        result = self._structures.delete_many(query)
+        return structure_ids_batch, result, time.monotonic() - batch_start
+
+    @staticmethod
+    def _delete_query(structure_ids_batch, delete_ranges, range_firsts):
+        """
+        Return the query to delete a sorted batch of Structure IDs. Runs of two
+        or more IDs in the batch that fall inside one of `delete_ranges` are
+        deleted with an `_id` range, and everything else is listed with `$in`.
+
+        `range_firsts` is the first ID of each of `delete_ranges`, which the
+        caller builds once and passes in for every batch. Since both the batch
+        and the ranges are sorted, we only look up where the batch starts, and
+        then step through the ranges along with the IDs.
+        """
+        range_index = max(bisect_right(range_firsts, structure_ids_batch[0]) - 1, 0) if structure_ids_batch else 0
+        runs = []  # [first_id, last_id, range_index] for each run of IDs
+        for s_id in structure_ids_batch:
+            while range_index < len(delete_ranges) and s_id > delete_ranges[range_index][1]:
+                range_index += 1
+            in_range = range_index < len(delete_ranges) and s_id >= delete_ranges[range_index][0]
+            if runs and in_range and runs[-1][2] == range_index:
+                runs[-1][1] = s_id
+            else:
+                runs.append([s_id, s_id, range_index if in_range else None])
+
+        in_ids = [ObjectId(first_id) for first_id, last_id, _ in runs if first_id == last_id]
+        clauses = [
+            {'_id': {'$gte': ObjectId(first_id), '$lte': ObjectId(last_id)}}
+            for first_id, last_id, _ in runs if first_id != last_id
+        ]
+        if in_ids:
+            clauses.append({'_id': {'$in': in_ids}})
+        if len(clauses) == 1:
+            return clauses[0]
+        return {'$or': clauses}
 
     @staticmethod
     def parse_structure_doc(structure_doc):
@@ -583,6 +2863,31 @@ class SplitMongoBackend:
             previous_id = str(previous_id)
         return Structure(_id, original_id, previous_id)
 
+    @staticmethod
+    def parse_active_version_doc(av_doc):
+        """
+        Return a list of ActiveVersionBranch objects, one for each branch in an
+        Active Version document.
+        """
+        branches = []
+        for branch, obj_id in av_doc['versions'].items():
+            structure_id = str(obj_id)
+            if branch == 'library':
+                key = LibraryLocator(av_doc['org'], av_doc['course'])
+            else:
+                key = CourseLocator(av_doc['org'], av_doc['course'], av_doc['run'])
+
+            branches.append(
+                ActiveVersionBranch(
+                    str(av_doc['_id']),
+                    branch,
+                    structure_id,
+                    key,
+                    av_doc['edited_on'],
+                )
+            )
+        return branches
+
     @staticmethod
     def batch(iterable, batch_size):
         """Yield lists of up to `batch_size` in length from `iterable`."""
@@ -603,14 +2908,341 @@ class SplitMongoBackend:
     def iter_from_start(structure_ids, start=None):
         """
         Yields from an iterable once it encounters the `start` value. If `start`
-        is None, just yields from the beginning.
+        is None, just yields from the beginning. StructureIds (from binary
+        Change Plans) are sorted, so we binary search those for `start`.
         """
         if start is None:
             for structure_id in structure_ids:
                 yield structure_id
             return
 
+        if isinstance(structure_ids, StructureIds):
+            yield from structure_ids.iter_from(start)
+            return
+
         for structure_id in structure_ids:
             if structure_id < start:
                 continue
             yield structure_id
+
+
+# First four bytes of a `mongodump --archive` file, and the int32 that ends
+# each run of documents in it.
+ARCHIVE_MAGIC = struct.pack('<I', 0x8199e26d)
+_ARCHIVE_TERMINATOR = -1
+
+_INT32 = struct.Struct('<i')
+
+# Sizes of the values of fixed size BSON element types, by type code.
+_BSON_FIXED_SIZES = {
+    0x01: 8,   # double
+    0x06: 0,   # undefined
+    0x07: 12,  # ObjectId
+    0x08: 1,   # boolean
+    0x09: 8,   # UTC datetime
+    0x0A: 0,   # null
+    0x10: 4,   # int32
+    0x11: 8,   # timestamp
+    0x12: 8,   # int64
+    0x13: 16,  # decimal128
+    0x7F: 0,   # max key
+    0xFF: 0,   # min key
+}
+_BSON_OBJECT_ID = 0x07
+_BSON_NULL = 0x0A
+
+_STRUCTURE_ID_FIELDS = (b'_id', b'original_version', b'previous_version')
+
+
+def _open_maybe_gzipped(path):
+    """Open a file for binary reading, decompressing it if it's gzipped."""
+    with open(path, 'rb') as raw_file:
+        is_gzipped = raw_file.read(2) == b'\x1f\x8b'
+    return gzip.open(path, 'rb') if is_gzipped else open(path, 'rb')  # pylint: disable=consider-using-with
+
+
+def _raw_bson_docs(bson_file, in_archive=False):
+    """
+    Iterate through the encoded BSON documents in a file, without decoding
+    them. With `in_archive`, stop at the terminator that ends each run of
+    documents in a mongodump archive.
+    """
+    while True:
+        size_bytes = bson_file.read(4)
+        if not size_bytes:
+            return
+        if len(size_bytes) < 4:
+            raise ValueError("Truncated or corrupt BSON in {}".format(getattr(bson_file, 'name', bson_file)))
+        size = _INT32.unpack(size_bytes)[0]
+        if in_archive and size == _ARCHIVE_TERMINATOR:
+            return
+        raw_doc = size_bytes + bson_file.read(size - 4)
+        if size < 5 or len(raw_doc) != size:
+            raise ValueError("Truncated or corrupt BSON in {}".format(getattr(bson_file, 'name', bson_file)))
+        yield raw_doc
+
+
+def _bson_id_fields(raw_doc, names):
+    """
+    Return a dict of the top level fields in `names` (as bytes) of an encoded
+    BSON document, mapped to their binary ObjectIds (or None for nulls).
+
+    Nothing else is decoded, and we stop as soon as we've found all of them, so
+    this is fast even for large documents.
+    """
+    try:
+        return _find_bson_id_fields(raw_doc, names)
+    except struct.error as err:
+        raise ValueError("Corrupt BSON document") from err
+
+
+def _find_bson_id_fields(raw_doc, names):
+    """
+    Does the work of _bson_id_fields, which see.
+    """
+    found = {}
+    position = 4
+    end = len(raw_doc) - 1
+    while position < end and len(found) < len(names):
+        element_type = raw_doc[position]
+        name_end = raw_doc.index(b'\x00', position + 1)
+        name = raw_doc[position + 1:name_end]
+        position = name_end + 1
+        if element_type in _BSON_FIXED_SIZES:
+            size = _BSON_FIXED_SIZES[element_type]
+        elif element_type in (0x02, 0x0D, 0x0E):  # string, JavaScript, symbol
+            size = 4 + _INT32.unpack_from(raw_doc, position)[0]
+        elif element_type in (0x03, 0x04, 0x0F):  # document, array, code with scope
+            size = _INT32.unpack_from(raw_doc, position)[0]
+        elif element_type == 0x05:  # binary
+            size = 5 + _INT32.unpack_from(raw_doc, position)[0]
+        elif element_type == 0x0B:  # regular expression (two C strings)
+            size = raw_doc.index(b'\x00', raw_doc.index(b'\x00', position) + 1) + 1 - position
+        elif element_type == 0x0C:  # DBPointer
+            size = 4 + _INT32.unpack_from(raw_doc, position)[0] + OBJECT_ID_SIZE
+        else:
+            raise ValueError("Unknown BSON element type {:#x}".format(element_type))
+
+        if name in names:
+            if element_type == _BSON_OBJECT_ID:
+                found[name] = raw_doc[position:position + OBJECT_ID_SIZE]
+            elif element_type == _BSON_NULL:
+                found[name] = None
+        position += size
+    return found
+
+
+def _structure_record(raw_doc):
+    """
+    Return the (id, original_id, previous_id) tuple of binary IDs for an
+    encoded Structure document (see SplitMongoBackend.parse_structure_doc).
+    """
+    fields = _bson_id_fields(raw_doc, _STRUCTURE_ID_FIELDS)
+    missing = [name.decode() for name in _STRUCTURE_ID_FIELDS if name not in fields]
+    if missing:
+        raise ValueError("Structure {} has no {}".format(
+            fields[b'_id'].hex() if b'_id' in fields else 'document', ', '.join(missing)
+        ))
+    previous_id = fields[b'previous_version']
+    return (fields[b'_id'], fields[b'original_version'], _NULL_ID if previous_id is None else previous_id)
+
+
+def _unpack_structure(record):
+    """Convert an (id, original_id, previous_id) tuple of binary IDs to a Structure."""
+    return Structure(
+        record[0].hex(),
+        record[1].hex(),
+        None if record[2] == _NULL_ID else record[2].hex(),
+    )
+
+
+class MongoDumpBackend:
+    """
+    Read-only stand-in for SplitMongoBackend that reads the structures and
+    active_versions collections from a `mongodump` on disk, so that Change
+    Plans can be made away from the production database (and then run with
+    `prune` as usual).
+
+    `dump_path` is either a mongodump output directory (either the top level
+    one or the one for the database, with plain or gzipped .bson files), or a
+    file made with `mongodump --archive` (optionally with --gzip). Documents
+    are streamed, and we only decode the `_id`, `original_version` and
+    `previous_version` of each Structure.
+
+    mongodump doesn't dump collections at the same point in time, so the
+    dump has the same race conditions as a live scan (see
+    SplitMongoBackend.structures_graph), except that we can't go back for
+    missing Structures. New Structures might have become Active after
+    active_versions was dumped, so Structures newer than the most recent Active
+    Version edit (less RECENT_STRUCTURE_MARGIN) are left out of the graph,
+    unless they're part of an Active chain. If an Active Structure is missing
+    from the dump, it's an error. Since the graph doesn't have every Structure
+    past that cutoff, `complete_before` is set to the first ID past it, and
+    Change Plans from the graph mustn't have delete ranges beyond it (see the
+    `ranges_before` argument to ChangePlan.create).
+    """
+    RECENT_STRUCTURE_MARGIN = timedelta(hours=1)
+
+    ACTIVE_VERSIONS = 'modulestore.active_versions'
+    STRUCTURES = 'modulestore.structures'
+
+    def __init__(self, dump_path, db_name):
+        self._dump_path = dump_path
+        self._db_name = db_name
+        self.complete_before = None
+
+    def structures_graph(self, delay, batch_size, compact=False, partitions=1, workers=1, snapshot=None,
+                         point_in_time=False):
+        # pylint: disable=unused-argument
+        """
+        Return StructuresGraph for the entire dump (or a CompactStructuresGraph
+        if `compact` is True). This has the same signature as
+        SplitMongoBackend.structures_graph, but `delay` and `batch_size` don't
+        apply to files, and `partitions`, `workers`, `snapshot` and
+        `point_in_time` aren't supported.
+        """
+        if partitions > 1 or snapshot is not None or point_in_time:
+            raise ValueError("Partitions, snapshots and point in time reads can't be used with a mongodump")
+        LOG.info("Reading Structures and Active Versions from %s...", self._dump_path)
+
+        av_docs = []
+
+        def structure_records():
+            """Yield Structure records, setting aside Active Version docs."""
+            for collection, raw_doc in self._dump_docs():
+                if collection == self.ACTIVE_VERSIONS:
+                    av_docs.append(raw_doc)
+                else:
+                    yield _structure_record(raw_doc)
+
+        packed = _merge_out_of_order(_accumulate_records(structure_records()))
+        branches = sorted(chain.from_iterable(self._parse_active_version(raw_doc) for raw_doc in av_docs))
+        LOG.info(
+            "Read %s Structures and %s Active Version Branches",
+            len(packed.ids) // OBJECT_ID_SIZE,
+            len(branches),
+        )
+
+        packed, recent_packed = self._without_recent(packed, branches)
+        if compact:
+            return CompactStructuresGraph.from_partitions(branches, [packed, recent_packed])
+
+        structures = {}
+        for record in chain(_unpack_records(packed), _unpack_records(recent_packed)):
+            structure = _unpack_structure(record)
+            structures[structure.id] = structure
+        return StructuresGraph(branches, structures)
+
+    def _parse_active_version(self, raw_doc):
+        """
+        Return the ActiveVersionBranch objects of an encoded Active Version
+        document, raising ValueError if it's malformed.
+        """
+        try:
+            return SplitMongoBackend.parse_active_version_doc(BSON(raw_doc).decode())
+        except (InvalidBSON, KeyError, AttributeError) as err:
+            raise ValueError("Malformed Active Version document in {}: {!r}".format(self._dump_path, err)) from err
+
+    def _without_recent(self, packed, branches):
+        """
+        Split sorted _PackedStructures into those at or before the cutoff for
+        recent Structures, and the recent ones that are part of an Active chain
+        (dropping the rest). Raise ValueError if an Active Structure or the
+        recent part of its chain isn't in the dump.
+        """
+        cutoff = datetime.min
+        if branches:
+            cutoff = max(branch.edited_on for branch in branches) - self.RECENT_STRUCTURE_MARGIN
+        cutoff_id = ObjectId.from_datetime(cutoff).binary if branches else b''
+        self.complete_before = cutoff_id.hex()
+        ids = _BinaryIds(packed.ids)
+        split_at = ids.bisect_left(cutoff_id) * OBJECT_ID_SIZE
+        recent = {record[0]: record for record in _unpack_records(_PackedStructures(
+            packed.ids[split_at:], packed.original_ids[split_at:], packed.previous_ids[split_at:], []
+        ))}
+
+        active_recent = {}
+        for branch in branches:
+            binary_id = bytes.fromhex(branch.structure_id)
+            while binary_id in recent:
+                active_recent[binary_id] = recent[binary_id]
+                binary_id = recent[binary_id][2]
+            if binary_id != _NULL_ID and ids.find(binary_id) is None:
+                raise ValueError(
+                    "Structure {} of Active Version {} ({}) is missing from the dump. Dump the "
+                    "structures collection before active_versions.".format(binary_id.hex(), branch.id, branch.key)
+                )
+
+        LOG.info(
+            "Leaving out %s Structures created since %s that aren't Active",
+            len(recent) - len(active_recent),
+            cutoff,
+        )
+        old_packed = _PackedStructures(
+            packed.ids[:split_at], packed.original_ids[:split_at], packed.previous_ids[:split_at], []
+        )
+        return old_packed, _accumulate_records(sorted(active_recent.values()))
+
+    def structure_sizes(self, structure_ids, delay, batch_size):  # pylint: disable=unused-argument
+        """
+        Return a list of the sizes in bytes of the Structures in
+        `structure_ids` (in the same order), from the length of each document
+        in the dump. Structures that aren't in the dump have a size of 0. This
+        reads the Structures in the dump again.
+        """
+        LOG.info("Reading sizes of %s Structures...", len(structure_ids))
+        positions = {bytes.fromhex(s_id): i for i, s_id in enumerate(structure_ids)}
+        sizes = [0] * len(structure_ids)
+        for collection, raw_doc in self._dump_docs(self.STRUCTURES):
+            if collection == self.STRUCTURES:
+                position = positions.get(_bson_id_fields(raw_doc, (b'_id',))[b'_id'])
+                if position is not None:
+                    sizes[position] = len(raw_doc)
+        return sizes
+
+    def _dump_docs(self, *collections):
+        """
+        Iterate through (collection name, encoded document) pairs for the
+        `collections` we're interested in (both, by default). Archives are read
+        in a single pass, since they can be much larger than these two
+        collections.
+        """
+        collections = collections or (self.ACTIVE_VERSIONS, self.STRUCTURES)
+        if os.path.isdir(self._dump_path):
+            for collection in collections:
+                with _open_maybe_gzipped(self._bson_path(collection)) as bson_file:
+                    for raw_doc in _raw_bson_docs(bson_file):
+                        yield collection, raw_doc
+        else:
+            with _open_maybe_gzipped(self._dump_path) as archive_file:
+                yield from self._archive_docs(archive_file, collections)
+
+    def _bson_path(self, collection):
+        """Return the path of the (maybe gzipped) .bson file for `collection`."""
+        for directory in (os.path.join(self._dump_path, self._db_name), self._dump_path):
+            for file_name in (collection + '.bson', collection + '.bson.gz'):
+                path = os.path.join(directory, file_name)
+                if os.path.isfile(path):
+                    return path
+        raise ValueError("Couldn't find {}.bson in mongodump {}".format(collection, self._dump_path))
+
+    def _archive_docs(self, archive_file, collections):
+        """
+        Iterate through (collection name, encoded document) pairs in a
+        mongodump archive.
+
+        An archive starts with a magic number and a run of metadata documents.
+        After that, runs of documents from all collections are interleaved,
+        each one preceded by a header naming the database and collection.
+        """
+        if archive_file.read(4) != ARCHIVE_MAGIC:
+            raise ValueError("{} is not a mongodump archive".format(self._dump_path))
+        for _metadata_doc in _raw_bson_docs(archive_file, in_archive=True):
+            pass
+
+        for raw_header in _raw_bson_docs(archive_file):
+            header = BSON(raw_header).decode()
+            wanted = header['db'] == self._db_name and header['collection'] in collections
+            for raw_doc in _raw_bson_docs(archive_file, in_archive=True):
+                if wanted:
+                    yield header['collection'], raw_doc
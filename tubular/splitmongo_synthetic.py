@@ -0,0 +1,443 @@
+"""
+Synthetic Split Modulestore data, for benchmarking the code in
+tubular.splitmongo at production scale without a copy of a production
+database.
+
+SyntheticModulestore generates Structures and Active Version Branches that look
+like a real modulestore's (long tailed edit histories, draft and published
+branches, libraries, course reruns, and deleted courses). They can be loaded
+into a MongoDB database, or into an InMemoryBackend, which stands in for
+SplitMongoBackend. run_benchmarks() times the main steps of making and
+applying a Change Plan against either one.
+"""
+from collections import namedtuple
+from datetime import datetime, timezone
+from functools import partial
+from heapq import heappop, heappush
+from itertools import count
+import math
+import os
+import random
+import resource
+import struct
+import sys
+import tempfile
+import time
+
+from bson.objectid import ObjectId
+from opaque_keys.edx.locator import CourseLocator, LibraryLocator
+
+from tubular.splitmongo import (
+    ActiveVersionBranch, ChangePlan, CompactStructuresGraph, SplitMongoBackend, Structure, StructuresGraph, Throttle
+)
+
+# All synthetic courses and libraries are in this org, so that we can tell a
+# synthetic database from a real one.
+SYNTHETIC_ORG = 'SynthX'
+
+
+class _Chain:
+    """
+    The state of one branch's history while we generate it. `remaining` is
+    the number of Structures still to create, `gap` the mean number of seconds
+    between them.
+    """
+    __slots__ = ['course', 'branch', 'original_id', 'root_id', 'head_id', 'remaining', 'gap', 'rerun_of']
+
+    def __init__(self, course, branch, remaining, gap, rerun_of=None):
+        self.course = course
+        self.branch = branch
+        self.original_id = None
+        self.root_id = None
+        self.head_id = None
+        self.remaining = remaining
+        self.gap = gap
+        self.rerun_of = rerun_of
+
+
+class SyntheticModulestore:
+    """
+    Generates about `num_structures` Structures and the Active Version Branches
+    that point to them. Everything is derived from `seed`, so the same
+    arguments always give the same data.
+
+    * Courses have a draft-branch and a published-branch, which share an
+      Original. Draft histories have lognormally distributed lengths with a
+      mean of `mean_edits` (most courses are edited a little, and a few are
+      edited thousands of times), and there's one publish for every
+      `edits_per_publish` draft edits.
+    * There's one library (with a single "library" branch) for every
+      `courses_per_library` courses.
+    * `rerun_fraction` of courses are reruns, which start from the draft
+      Structure of an earlier course at the time of the rerun (and so share
+      its Original).
+    * `orphan_fraction` of courses have been deleted, so that nothing can reach
+      their Structures.
+
+    Edits to all courses are interleaved in time between `start` and `end`,
+    and Structure IDs are made from those times, so structures() yields
+    Structures in ascending ID order, like a scan sorted by `_id`.
+    """
+    # Spread of the lognormal distribution of history lengths.
+    HISTORY_SIGMA = 1.2
+
+    def __init__(self, num_structures, mean_edits=50, edits_per_publish=5, courses_per_library=10,
+                 rerun_fraction=0.1, orphan_fraction=0.02, start=datetime(2014, 1, 1, tzinfo=timezone.utc),
+                 end=datetime(2024, 1, 1, tzinfo=timezone.utc), seed=0):
+        self.num_structures = num_structures
+        self.mean_edits = mean_edits
+        self.edits_per_publish = edits_per_publish
+        self.courses_per_library = courses_per_library
+        self.rerun_fraction = rerun_fraction
+        self.orphan_fraction = orphan_fraction
+        self.start = start
+        self.end = end
+        self.seed = seed
+        self._chains = None
+        self._deleted_courses = None
+        self._last_edits = None
+
+    def structures(self):
+        """
+        Iterate through all the Structures, in ascending ID order. This has to
+        be run to the end before calling branches().
+        """
+        rand = random.Random(self.seed)
+        start_time = self.start.timestamp()
+        span = self.end.timestamp() - start_time
+        mu = math.log(self.mean_edits) - self.HISTORY_SIGMA ** 2 / 2
+
+        # Add courses until their histories add up to num_structures. The last
+        # few will be cut short, since we stop when we get there.
+        chains = []
+        events = []
+        total_length = 0
+        for course in count():
+            if total_length >= self.num_structures:
+                break
+            course_start = start_time + rand.random() * span
+            duration = rand.random() * (start_time + span - course_start) + 1
+            is_library = self.courses_per_library and course % (self.courses_per_library + 1) == 0
+            num_edits = max(1, round(rand.lognormvariate(mu, self.HISTORY_SIGMA)))
+            rerun_of = None
+            if course and not is_library and rand.random() < self.rerun_fraction:
+                rerun_of = rand.randrange(course)
+                if chains[rerun_of * 2].branch == 'library':
+                    rerun_of = None
+
+            if is_library:
+                branches = [('library', num_edits)]
+            else:
+                branches = [
+                    ('draft-branch', num_edits),
+                    ('published-branch', max(1, num_edits // self.edits_per_publish)),
+                ]
+            for offset, (branch, length) in enumerate(branches):
+                chain = _Chain(course, branch, length, duration / length, rerun_of)
+                heappush(events, (course_start + offset, len(chains)))
+                chains.append(chain)
+                total_length += length
+            if len(branches) == 1:
+                chains.append(None)
+
+        self._chains = chains
+        self._deleted_courses = {
+            course for course in range(len(chains) // 2) if rand.random() < self.orphan_fraction
+        }
+        self._last_edits = {}
+
+        counter = 0
+        while counter < self.num_structures:
+            event_time, chain_idx = heappop(events)
+            chain = chains[chain_idx]
+            structure_id = self._structure_id(event_time, counter)
+            counter += 1
+
+            if chain.head_id is None:
+                chain.original_id, previous_id = self._start_chain(chain, structure_id)
+                chain.root_id = structure_id
+            else:
+                previous_id = chain.head_id
+            yield Structure(structure_id, chain.original_id, previous_id)
+            chain.head_id = structure_id
+
+            self._last_edits[chain.course] = event_time
+            chain.remaining -= 1
+            if chain.remaining:
+                heappush(events, (event_time + rand.expovariate(1 / chain.gap), chain_idx))
+
+    def _start_chain(self, chain, structure_id):
+        """
+        Return (original ID, previous ID) for `structure_id`, the first
+        Structure of a chain. Published branches start from the first draft
+        Structure, and reruns from the current draft of the course they rerun
+        (if it has been created yet).
+        """
+        if chain.branch == 'published-branch':
+            draft = self._chains[chain.course * 2]
+            return draft.original_id, draft.root_id
+        if chain.rerun_of is not None:
+            source = self._chains[chain.rerun_of * 2]
+            if source.head_id is not None:
+                return source.original_id, source.head_id
+        return structure_id, None
+
+    @staticmethod
+    def _structure_id(event_time, counter):
+        """A Structure ID from a timestamp, made unique by a counter."""
+        return struct.pack('>IQ', int(event_time), counter).hex()
+
+    def branches(self):
+        """
+        Return a sorted list of ActiveVersionBranches for all the courses and
+        libraries that haven't been deleted, and which have Structures.
+        """
+        if self._chains is None:
+            raise ValueError("structures() must be run before branches()")
+        branches = []
+        chains = self._chains
+        for course in range(len(chains) // 2):
+            draft, published = chains[course * 2], chains[course * 2 + 1]
+            if course in self._deleted_courses or draft.head_id is None:
+                continue
+            av_id = struct.pack('>IQ', int(self.end.timestamp()), course).hex()
+            edited_on = datetime.utcfromtimestamp(self._last_edits[course])
+            if published is None:
+                key = LibraryLocator(SYNTHETIC_ORG, 'L{}'.format(course))
+                branches.append(ActiveVersionBranch(av_id, 'library', draft.head_id, key, edited_on))
+                continue
+            key = CourseLocator(SYNTHETIC_ORG, 'C{}'.format(course), 'run')
+            # Until a course is first published, both branches point to the
+            # Structure it was created with.
+            published_id = published.head_id or draft.root_id
+            branches.append(ActiveVersionBranch(av_id, 'draft-branch', draft.head_id, key, edited_on))
+            branches.append(ActiveVersionBranch(av_id, 'published-branch', published_id, key, edited_on))
+        return sorted(branches)
+
+    def insert_into(self, database, batch_size=10000, blocks_per_structure=10, shuffle_window=0):
+        """
+        Insert the Structures and Active Versions into a pymongo Database, in
+        batches of `batch_size` documents. Each Structure gets
+        `blocks_per_structure` small blocks, so that documents aren't
+        unrealistically tiny.
+
+        Structures are inserted in ID order, so they're stored in ID order too.
+        With a `shuffle_window`, each run of that many Structures is inserted
+        in a random order instead, like Structures from many Studio processes
+        (with their own clocks) or a resync would be.
+        """
+        structures = database.modulestore.structures
+        structure_docs = (
+            {
+                '_id': ObjectId(structure.id),
+                'original_version': ObjectId(structure.original_id),
+                'previous_version': None if structure.previous_id is None else ObjectId(structure.previous_id),
+                'blocks': [
+                    {'block_type': 'html', 'block_id': 'block{}'.format(i), 'fields': {}, 'definition': ObjectId()}
+                    for i in range(blocks_per_structure)
+                ],
+            }
+            for structure in self.structures()
+        )
+        if shuffle_window > 1:
+            structure_docs = self._shuffled(structure_docs, shuffle_window)
+        for docs_batch in SplitMongoBackend.batch(structure_docs, batch_size):
+            structures.insert_many(docs_batch, ordered=False)
+
+        av_docs = {}
+        for branch in self.branches():
+            av_doc = av_docs.setdefault(branch.id, {
+                '_id': ObjectId(branch.id),
+                'org': branch.key.org,
+                'course': branch.key.course,
+                'run': getattr(branch.key, 'run', None) or 'library',
+                'edited_on': branch.edited_on,
+                'versions': {},
+            })
+            av_doc['versions'][branch.branch] = ObjectId(branch.structure_id)
+        if av_docs:
+            database.modulestore.active_versions.insert_many(list(av_docs.values()))
+
+    def _shuffled(self, iterable, window):
+        """Shuffle each run of `window` items of `iterable`."""
+        rand = random.Random(self.seed)
+        for items in SplitMongoBackend.batch(iterable, window):
+            rand.shuffle(items)
+            yield from items
+
+
+class InMemoryBackend:
+    """
+    Stand-in for SplitMongoBackend with the Structures in memory, for
+    benchmarking everything but the database. It reads and writes in batches
+    like SplitMongoBackend does, and counts the queries that it would have
+    made in `round_trips`.
+
+    Structures are kept in a CompactStructuresGraph. Deleting one only flags
+    it, so links to deleted Structures show up as missing, like they would in
+    the database.
+    """
+    def __init__(self, graph):
+        self.round_trips = 0
+        self._graph = graph
+        self._deleted = bytearray(len(graph))
+
+    @classmethod
+    def from_modulestore(cls, modulestore):
+        """Create an InMemoryBackend with a SyntheticModulestore's data."""
+        packed = CompactStructuresGraph.scan_partition(modulestore.structures())
+        return cls(CompactStructuresGraph.from_partitions(modulestore.branches(), [packed]))
+
+    def structures_graph(self, delay, batch_size, compact=False, partitions=1, workers=1, snapshot=None):
+        # pylint: disable=unused-argument
+        """
+        Return a StructuresGraph (or CompactStructuresGraph) of the Structures
+        that haven't been deleted. `delay` is ignored, and partitions and
+        snapshots aren't supported.
+        """
+        graph = self._graph
+
+        def scan():
+            """Yield Structures, counting a round trip for each batch."""
+            live = (graph.structure_at(index) for index in range(len(graph)) if not self._deleted[index])
+            for structures_batch in SplitMongoBackend.batch(live, batch_size):
+                self.round_trips += 1
+                yield from structures_batch
+
+        self.round_trips += 1  # For the Active Versions
+        if compact:
+            return CompactStructuresGraph.build(graph.branches, scan())
+        return StructuresGraph(graph.branches, {structure.id: structure for structure in scan()})
+
+    def record_ids(self, structure_ids, delay, batch_size):  # pylint: disable=unused-argument
+        """
+        Return record IDs for `structure_ids`, like SplitMongoBackend does.
+        Structures were "inserted" in ID order, so a record ID is just the
+        position in the graph (starting from 1).
+        """
+        self.round_trips += math.ceil(len(structure_ids) / batch_size)
+        return [self._graph.index_of(structure_id) + 1 for structure_id in structure_ids]
+
+    def update(self, change_plan, delay=0, batch_size=1000, record_order=False, **kwargs):
+        # pylint: disable=unused-argument
+        """
+        Apply a Change Plan: re-link parents, and then delete Structures, in
+        batches of `batch_size` with `delay` seconds in between, and return
+        how many Structures were deleted. With `record_order`, deletions are
+        sorted by record ID first.
+        """
+        graph = self._graph
+        throttle = Throttle(delay, batch_size)
+        for update_batch in throttle.batches(change_plan.update_parents):
+            self.round_trips += 1
+            for structure_id, new_previous_id in update_batch:
+                graph.previous_idxs[graph.index_of(structure_id)] = graph.index_of(new_previous_id)
+            throttle.wait()
+        deletions = change_plan.delete
+        if record_order:
+            deletions = SplitMongoBackend._in_record_order(change_plan)  # pylint: disable=protected-access
+        num_deleted = 0
+        for delete_batch in throttle.batches(deletions):
+            self.round_trips += 1
+            for structure_id in delete_batch:
+                index = graph.index_of(structure_id)
+                num_deleted += not self._deleted[index]
+                self._deleted[index] = 1
+            throttle.wait()
+        return num_deleted
+
+
+# One measurement from run_benchmarks(). `peak_rss` is the peak resident set
+# size of the process so far, in bytes, and `items` how many Structures the
+# step wrote (if it writes any), for working out its throughput.
+BenchmarkResult = namedtuple('BenchmarkResult', 'step seconds peak_rss round_trips items', defaults=(None,))
+
+# Orders that run_benchmarks() can delete Structures in: by ID (the default),
+# or by where they're stored (see SplitMongoBackend.record_ids).
+DELETE_ORDERS = ('id', 'locality')
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes."""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+def run_benchmarks(backend, round_trips, retain=2, batch_size=10000, compact=True, prune=True, order='id'):
+    """
+    Time the steps of making and applying a Change Plan with `backend`, and
+    return a list of BenchmarkResults.
+
+    `round_trips` is a function that returns how many queries have been made
+    so far. Peak RSS only ever goes up, so for memory use of each size to be
+    comparable, run each one in a fresh process. With `prune`, the Change Plan
+    is applied to the backend, which changes its data, deleting Structures in
+    one of the DELETE_ORDERS. The locality order looks up record IDs as part
+    of ChangePlan.create.
+    """
+    if order not in DELETE_ORDERS:
+        raise ValueError("Unknown delete order: {}".format(order))
+    record_order = order == 'locality'
+    results = []
+
+    def measure(step, func, *args, items=None, **kwargs):
+        """Run and time one step."""
+        trips_before = round_trips()
+        start = time.monotonic()
+        result = func(*args, **kwargs)
+        results.append(
+            BenchmarkResult(step, time.monotonic() - start, peak_rss(), round_trips() - trips_before, items)
+        )
+        return result
+
+    graph = measure('structures_graph', backend.structures_graph, 0, batch_size, compact)
+    record_id_lookup = partial(backend.record_ids, delay=0, batch_size=batch_size) if record_order else None
+    plan = measure('ChangePlan.create', ChangePlan.create, graph, retain, record_id_lookup=record_id_lookup)
+    del graph
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        json_path = os.path.join(temp_dir, 'plan.json')
+        binary_path = os.path.join(temp_dir, 'plan.bin')
+        with open(json_path, 'w') as json_file:
+            measure('ChangePlan.dump', plan.dump, json_file)
+        with open(json_path) as json_file:
+            measure('ChangePlan.load', ChangePlan.load, json_file)
+        with open(binary_path, 'wb') as binary_file:
+            measure('ChangePlan.dump_binary', plan.dump_binary, binary_file)
+        measure('ChangePlan.load_file (binary)', ChangePlan.load_file, binary_path)
+
+    if prune:
+        measure(
+            'update', backend.update, plan, delay=0, batch_size=batch_size, record_order=record_order,
+            items=len(plan.delete)
+        )
+
+    return results
+
+
+def delete_throughputs(results):
+    """
+    Return a dict of the Structures deleted per second by the update step of
+    each delete order, from a dict of BenchmarkResults for each order.
+    """
+    throughputs = {}
+    for order, order_results in results.items():
+        for result in order_results:
+            if result.step == 'update' and result.seconds > 0:
+                throughputs[order] = result.items / result.seconds
+    return throughputs
+
+
+def benchmark_in_memory(num_structures, modulestore_options=None, **kwargs):
+    """
+    Generate a SyntheticModulestore with `num_structures` Structures (and
+    `modulestore_options`) into an InMemoryBackend, and return the
+    BenchmarkResults of run_benchmarks() on it (with `kwargs`), starting with
+    the time taken to generate it.
+    """
+    start = time.monotonic()
+    modulestore = SyntheticModulestore(num_structures, **(modulestore_options or {}))
+    backend = InMemoryBackend.from_modulestore(modulestore)
+    generated = BenchmarkResult('generate', time.monotonic() - start, peak_rss(), 0)
+    return [generated] + run_benchmarks(backend, lambda: backend.round_trips, **kwargs)
@@ -41,7 +41,7 @@ def flatten_partner_list(partner_list):
     return [partner for sublist in partner_list for partner in sublist]
 
 
-def fake_config_file(f, orgs=None, fetch_ecom_segment_id=False):
+def fake_config_file(f, orgs=None, fetch_ecom_segment_id=False, service_limits=None, retirement_pipeline=None):
     """
     Create a config file for a single test. Combined with CliRunner.isolated_filesystem() to
     ensure the file lifetime is limited to the test. See _call_script for usage.
@@ -58,7 +58,7 @@ def fake_config_file(f, orgs=None, fetch_ecom_segment_id=False):
             'ecommerce': 'https://ecommerce.stage.edx.invalid/',
             'segment': 'https://segment.invalid/graphql',
         },
-        'retirement_pipeline': TEST_RETIREMENT_PIPELINE,
+        'retirement_pipeline': retirement_pipeline or TEST_RETIREMENT_PIPELINE,
         'partner_report_platform_name': TEST_PLATFORM_NAME,
         'org_partner_mapping': orgs,
         'drive_partners_folder': 'FakeDriveID',
@@ -76,6 +76,9 @@ def fake_config_file(f, orgs=None, fetch_ecom_segment_id=False):
     if fetch_ecom_segment_id:
         config['fetch_ecommerce_segment_id'] = True
 
+    if service_limits:
+        config['service_limits'] = service_limits
+
     yaml.safe_dump(config, f)
 
 
@@ -2,10 +2,14 @@
 Tests for edX API calls.
 """
 
+import os
+import tempfile
 import unittest
+from datetime import datetime, timedelta
+
 from ddt import ddt, data
-from mock import patch
-from slumber.exceptions import HttpServerError
+from mock import Mock, patch
+from slumber.exceptions import HttpClientError, HttpServerError
 import requests
 from requests.exceptions import ConnectionError
 
@@ -54,6 +58,170 @@ class TestBaseApiClient(unittest.TestCase):
                     append_slash=True
                 )
 
+    def test_base_api_client_token_cache(self):
+        """
+        Test that clients sharing an AccessTokenCache share an access token.
+        """
+        with patch('tubular.edx_api.BaseApiClient.get_access_token') as mock:
+            mock.return_value = ('THIS_IS_A_JWT', datetime.utcnow() + timedelta(hours=1))
+            with patch('tubular.edx_api.EdxRestApiClient') as mock_client:
+                token_cache = edx_api.AccessTokenCache()
+                for api_base_url in ('http://localhost:18000', 'http://localhost:18130'):
+                    edx_api.BaseApiClient(
+                        'http://localhost:18000',
+                        api_base_url,
+                        'the_client_id',
+                        'the_client_secret',
+                        token_cache=token_cache
+                    )
+                mock.assert_called_once_with('http://localhost:18000', 'the_client_id', 'the_client_secret')
+                mock_client.assert_called_with('http://localhost:18130', jwt='THIS_IS_A_JWT', append_slash=True)
+
+    def test_expiring_access_token(self):
+        """
+        Test that clients get a new access token before a call once theirs is about to expire.
+        """
+        with patch('tubular.edx_api.BaseApiClient.get_access_token') as mock_get_access_token:
+            mock_get_access_token.side_effect = [
+                ('OLD_JWT', datetime.utcnow() + timedelta(minutes=1)),
+                ('NEW_JWT', datetime.utcnow() + timedelta(hours=1)),
+            ]
+            with patch('tubular.edx_api.EdxRestApiClient') as mock_client:
+                lms_api = edx_api.LmsApi(
+                    'http://localhost:18000',
+                    'http://localhost',
+                    'the_client_id',
+                    'the_client_secret'
+                )
+                lms_api.learners_to_retire(TEST_RETIREMENT_QUEUE_STATES)
+                lms_api.learners_to_retire(TEST_RETIREMENT_QUEUE_STATES)
+        self.assertEqual(mock_get_access_token.call_count, 2)
+        self.assertEqual(
+            [call[1]['jwt'] for call in mock_client.call_args_list],
+            ['OLD_JWT', 'NEW_JWT']
+        )
+
+    def test_refused_access_token(self):
+        """
+        Test that a call refused with a 401 is tried again with a new access token, once.
+        """
+        unauthorized = requests.Response()
+        unauthorized.status_code = 401
+        with patch('tubular.edx_api.BaseApiClient.get_access_token') as mock_get_access_token:
+            mock_get_access_token.side_effect = [
+                ('OLD_JWT', datetime.utcnow() + timedelta(hours=1)),
+                ('NEW_JWT', datetime.utcnow() + timedelta(hours=1)),
+                ('NEWER_JWT', datetime.utcnow() + timedelta(hours=1)),
+            ]
+            with patch('tubular.edx_api.EdxRestApiClient') as mock_client:
+                mock_client.return_value.api.user.v1.accounts.retirement_queue.get.side_effect = [
+                    HttpClientError(response=unauthorized), ['learner'],
+                    HttpClientError(response=unauthorized), HttpClientError(response=unauthorized),
+                ]
+                lms_api = edx_api.LmsApi(
+                    'http://localhost:18000',
+                    'http://localhost',
+                    'the_client_id',
+                    'the_client_secret',
+                    token_cache=edx_api.AccessTokenCache(),
+                )
+                self.assertEqual(lms_api.learners_to_retire(TEST_RETIREMENT_QUEUE_STATES), ['learner'])
+                with self.assertRaises(HttpClientError):
+                    lms_api.learners_to_retire(TEST_RETIREMENT_QUEUE_STATES)
+        self.assertEqual(mock_get_access_token.call_count, 3)
+        self.assertEqual(
+            [call[1]['jwt'] for call in mock_client.call_args_list],
+            ['OLD_JWT', 'NEW_JWT', 'NEWER_JWT']
+        )
+
+
+@ddt
+class TestAccessTokenCache(unittest.TestCase):
+    """
+    Test the access token cache.
+    """
+    def setUp(self):
+        super().setUp()
+        self.now = datetime(2024, 1, 1, 12)
+        self.fetch = Mock(side_effect=self._fetch)
+        temp_dir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(temp_dir.cleanup)
+        self.path = os.path.join(temp_dir.name, 'tokens.json')
+
+    def _fetch(self, oauth_base_url, client_id, client_secret):  # pylint: disable=unused-argument
+        """
+        Mint a new token that expires in an hour.
+        """
+        return 'JWT{}'.format(self.fetch.call_count), self.now + timedelta(hours=1)
+
+    def _cache(self, path=None):
+        return edx_api.AccessTokenCache(path, clock=lambda: self.now)
+
+    def test_cache(self):
+        cache = self._cache()
+        self.assertEqual(cache.get_access_token('http://lms', 'id', 'secret', self.fetch)[0], 'JWT1')
+        self.assertEqual(cache.get_access_token('http://lms', 'id', 'secret', self.fetch)[0], 'JWT1')
+        # Keyed by OAuth URL and client ID.
+        self.assertEqual(cache.get_access_token('http://lms', 'other_id', 'secret', self.fetch)[0], 'JWT2')
+        self.assertEqual(cache.get_access_token('http://other-lms', 'id', 'secret', self.fetch)[0], 'JWT3')
+        self.assertEqual(self.fetch.call_count, 3)
+
+    def test_refresh_early(self):
+        cache = self._cache()
+        cache.get_access_token('http://lms', 'id', 'secret', self.fetch)
+        # Only handed out while at least half of the hour is left.
+        self.now += timedelta(minutes=29)
+        self.assertEqual(cache.get_access_token('http://lms', 'id', 'secret', self.fetch)[0], 'JWT1')
+        self.now += timedelta(minutes=2)
+        self.assertEqual(cache.get_access_token('http://lms', 'id', 'secret', self.fetch)[0], 'JWT2')
+
+    def test_rejected(self):
+        cache = self._cache(self.path)
+        cache.get_access_token('http://lms', 'id', 'secret', self.fetch)
+        self.assertEqual(cache.get_access_token('http://lms', 'id', 'secret', self.fetch, rejected='JWT1')[0], 'JWT2')
+        # Another client refused the old token too, but the new one is shared.
+        self.assertEqual(
+            self._cache(self.path).get_access_token('http://lms', 'id', 'secret', self.fetch, rejected='JWT1')[0],
+            'JWT2'
+        )
+        self.assertEqual(self.fetch.call_count, 2)
+
+    def test_no_expiry(self):
+        cache = self._cache(self.path)
+        fetch = Mock(return_value=('THIS_IS_A_JWT', None))
+        cache.get_access_token('http://lms', 'id', 'secret', fetch)
+        cache.get_access_token('http://lms', 'id', 'secret', fetch)
+        self.assertEqual(fetch.call_count, 2)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_file(self):
+        self._cache(self.path).get_access_token('http://lms', 'id', 'secret', self.fetch)
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+
+        # Another process shares the token...
+        other_cache = self._cache(self.path)
+        self.assertEqual(other_cache.get_access_token('http://lms', 'id', 'secret', self.fetch)[0], 'JWT1')
+        self.assertEqual(self.fetch.call_count, 1)
+
+        # ...and replaces it when it's about to expire, keeping the others.
+        other_cache.get_access_token('http://lms', 'other_id', 'secret', self.fetch)
+        self.now += timedelta(minutes=31)
+        self.assertEqual(other_cache.get_access_token('http://lms', 'id', 'secret', self.fetch)[0], 'JWT3')
+        self.assertEqual(self._cache(self.path).get_access_token('http://lms', 'id', 'secret', self.fetch)[0], 'JWT3')
+        self.assertEqual(self.fetch.call_count, 3)
+
+    @data(
+        'not json',
+        '[]',
+        '{"http://lms id": {"access_token": "JWT"}}',
+        '{"http://lms id": {"access_token": "JWT", "expires_at": "2024-01-01T13:00:00"}}',
+    )
+    def test_unreadable_file(self, contents):
+        with open(self.path, 'w') as tokens_file:
+            tokens_file.write(contents)
+        self.assertEqual(self._cache(self.path).get_access_token('http://lms', 'id', 'secret', self.fetch)[0], 'JWT1')
+        self.assertEqual(self._cache(self.path).get_access_token('http://lms', 'id', 'secret', self.fetch)[0], 'JWT1')
+
 
 class BackoffTriedException(Exception):
     """
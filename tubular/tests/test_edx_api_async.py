@@ -0,0 +1,286 @@
+"""
+Tests for the asyncio edX API classes
+"""
+import asyncio
+import inspect
+import json
+import socket
+import unittest
+from datetime import datetime, timedelta
+
+import aiohttp
+from aiohttp import test_utils, web
+from ddt import ddt, data
+from mock import patch
+from requests.exceptions import ConnectionError  # pylint: disable=redefined-builtin
+from slumber.exceptions import HttpClientError, HttpNotFoundError
+
+import tubular.edx_api as edx_api
+import tubular.edx_api_async as edx_api_async
+from tubular.tests.retirement_helpers import TEST_RETIREMENT_QUEUE_STATES
+from tubular.tests.test_edx_api import BackoffTriedException
+
+FAKE_LEARNER = {'original_username': 'test_user', 'user': {'id': 1234}}
+
+
+def _run(coroutine):
+    """
+    Run a coroutine to completion on a new event loop.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class FakeResponse:
+    """
+    Just enough of an aiohttp ClientResponse, and the context manager it's returned from.
+    """
+    def __init__(self, status, content, content_type):
+        self.status = status
+        self.headers = {'content-type': content_type} if content_type else {}
+        self._content = content
+
+    async def read(self):  # pylint: disable=missing-function-docstring
+        return self._content
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+
+class FakeSession:
+    """
+    Stands in for an aiohttp ClientSession, recording requests and returning `responses` in turn.
+    """
+    def __init__(self, *responses):
+        self.requests = []
+        self._responses = list(responses)
+
+    def request(self, method, url, **kwargs):  # pylint: disable=missing-function-docstring
+        self.requests.append(dict(kwargs, method=method, url=url))
+        response = self._responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        status, body = response
+        if body is None:
+            return FakeResponse(status, b'', None)
+        return FakeResponse(status, json.dumps(body).encode('utf-8'), 'application/json; charset=utf-8')
+
+
+def _lms_api(session):
+    """
+    Create an AsyncLmsApi on `session`, with a fake access token.
+    """
+    with patch('tubular.edx_api.BaseApiClient.get_access_token') as mock_get_access_token:
+        mock_get_access_token.return_value = ('THIS_IS_A_JWT', None)
+        return _run(edx_api_async.AsyncLmsApi.create(
+            'http://localhost:18000',
+            'http://localhost:18000',
+            'the_client_id',
+            'the_client_secret',
+            session
+        ))
+
+
+@ddt
+class TestAsyncApis(unittest.TestCase):
+    """
+    Test the asyncio edX API clients.
+    """
+    @data(
+        (edx_api.LmsApi, edx_api_async.AsyncLmsApi),
+        (edx_api.EcommerceApi, edx_api_async.AsyncEcommerceApi),
+        (edx_api.CredentialsApi, edx_api_async.AsyncCredentialsApi),
+        (edx_api.DemographicsApi, edx_api_async.AsyncDemographicsApi),
+        (edx_api.LicenseManagerApi, edx_api_async.AsyncLicenseManagerApi),
+    )
+    def test_same_methods(self, classes):
+        sync_class, async_class = classes
+
+        def public_methods(cls):
+            return {
+                name: inspect.signature(inspect.unwrap(method))
+                for name, method in vars(cls).items()
+                if inspect.isfunction(method) and not name.startswith('_')
+            }
+
+        self.assertEqual(public_methods(sync_class), public_methods(async_class))
+        for name in public_methods(async_class):
+            self.assertTrue(inspect.iscoroutinefunction(inspect.unwrap(getattr(async_class, name))), name)
+
+    def test_get(self):
+        session = FakeSession((200, [{'original_username': 'test_user'}]))
+        lms_api = _lms_api(session)
+
+        result = _run(lms_api.learners_to_retire(TEST_RETIREMENT_QUEUE_STATES, cool_off_days=365))
+
+        self.assertEqual(result, [{'original_username': 'test_user'}])
+        request = session.requests[0]
+        self.assertEqual(request['method'], 'GET')
+        self.assertEqual(request['url'], 'http://localhost:18000/api/user/v1/accounts/retirement_queue/')
+        self.assertEqual(request['headers']['Authorization'], 'JWT THIS_IS_A_JWT')
+        self.assertEqual(
+            request['params'],
+            [('cool_off_days', '365')] + [('states', state) for state in TEST_RETIREMENT_QUEUE_STATES]
+        )
+        self.assertIsNone(request['data'])
+
+    def test_post(self):
+        session = FakeSession((204, None), (200, None))
+        lms_api = _lms_api(session)
+
+        self.assertIsNone(_run(lms_api.retirement_retire_mailings(FAKE_LEARNER)))
+        self.assertEqual(_run(lms_api.retirement_retire_proctoring_data(FAKE_LEARNER)), b'')
+
+        mailings, proctoring = session.requests[0], session.requests[1]
+        self.assertEqual(mailings['method'], 'POST')
+        self.assertEqual(mailings['url'], 'http://localhost:18000/api/user/v1/accounts/retire_mailings/')
+        self.assertEqual(json.loads(mailings['data']), {'username': 'test_user'})
+        self.assertEqual(proctoring['url'], 'http://localhost:18000/api/edx_proctoring/v1/retire_user/1234/')
+
+    def test_token_cache(self):
+        cache = edx_api.AccessTokenCache()
+        with patch('tubular.edx_api.BaseApiClient.get_access_token') as mock_get_access_token:
+            mock_get_access_token.return_value = ('THIS_IS_A_JWT', None)
+            _run(edx_api_async.AsyncEcommerceApi.create(
+                'http://localhost:18000', 'http://localhost:18130', 'the_client_id', 'the_client_secret',
+                FakeSession(), token_cache=cache
+            ))
+        mock_get_access_token.assert_called_once_with('http://localhost:18000', 'the_client_id', 'the_client_secret')
+
+    def test_refused_access_token(self):
+        session = FakeSession((401, {'detail': 'Expired'}), (200, []), (401, None), (401, None))
+        with patch('tubular.edx_api.BaseApiClient.get_access_token') as mock_get_access_token:
+            mock_get_access_token.side_effect = [
+                ('OLD_JWT', datetime.utcnow() + timedelta(hours=1)),
+                ('NEW_JWT', datetime.utcnow() + timedelta(hours=1)),
+                ('NEWER_JWT', datetime.utcnow() + timedelta(hours=1)),
+            ]
+            lms_api = _run(edx_api_async.AsyncLmsApi.create(
+                'http://localhost:18000', 'http://localhost:18000', 'the_client_id', 'the_client_secret', session
+            ))
+            self.assertEqual(_run(lms_api.learners_to_retire(TEST_RETIREMENT_QUEUE_STATES)), [])
+            with self.assertRaises(HttpClientError):
+                _run(lms_api.learners_to_retire(TEST_RETIREMENT_QUEUE_STATES))
+        self.assertEqual(
+            [request['headers']['Authorization'] for request in session.requests],
+            ['JWT OLD_JWT', 'JWT NEW_JWT', 'JWT NEW_JWT', 'JWT NEWER_JWT']
+        )
+
+    def test_expiring_access_token(self):
+        session = FakeSession((200, []), (200, []))
+        with patch('tubular.edx_api.BaseApiClient.get_access_token') as mock_get_access_token:
+            mock_get_access_token.side_effect = [
+                ('OLD_JWT', datetime.utcnow() + timedelta(minutes=1)),
+                ('NEW_JWT', datetime.utcnow() + timedelta(hours=1)),
+            ]
+            lms_api = _run(edx_api_async.AsyncLmsApi.create(
+                'http://localhost:18000', 'http://localhost:18000', 'the_client_id', 'the_client_secret', session
+            ))
+            _run(lms_api.learners_to_retire(TEST_RETIREMENT_QUEUE_STATES))
+            _run(lms_api.learners_to_retire(TEST_RETIREMENT_QUEUE_STATES))
+        self.assertEqual(
+            [request['headers']['Authorization'] for request in session.requests],
+            ['JWT NEW_JWT', 'JWT NEW_JWT']
+        )
+
+    def test_client_error(self):
+        lms_api = _lms_api(FakeSession((404, {'detail': 'Not found.'}), (404, None), (400, None)))
+
+        with self.assertRaises(HttpNotFoundError) as context:
+            _run(lms_api.get_learner_retirement_state('test_user'))
+        self.assertEqual(context.exception.response.status_code, 404)
+        # Forums have nothing to retire for some learners
+        self.assertTrue(_run(lms_api.retirement_retire_forum(FAKE_LEARNER)))
+        with self.assertRaises(HttpClientError):
+            _run(lms_api.retirement_lms_retire(FAKE_LEARNER))
+
+    @data(504, 500)
+    @patch('tubular.edx_api._backoff_handler')
+    def test_server_error_backoff(self, svr_status_code, mock_backoff_handler):
+        mock_backoff_handler.side_effect = BackoffTriedException
+        lms_api = _lms_api(FakeSession((svr_status_code, None)))
+        with self.assertRaises(BackoffTriedException):
+            _run(lms_api.learners_to_retire(TEST_RETIREMENT_QUEUE_STATES, cool_off_days=365))
+
+    @patch('tubular.edx_api._backoff_handler')
+    def test_connection_error_backoff(self, mock_backoff_handler):
+        mock_backoff_handler.side_effect = BackoffTriedException
+        lms_api = _lms_api(FakeSession(ConnectionError('Connection reset by peer')))
+        with self.assertRaises(BackoffTriedException):
+            _run(lms_api.retirement_partner_cleanup([{'original_username': 'test'}]))
+
+
+class TestAiohttpSession(unittest.TestCase):
+    """
+    The clients on a real aiohttp ClientSession, against a local server.
+    """
+    @staticmethod
+    def serve(test):
+        """
+        Run `test(base_url, session)` with a local server that echoes requests
+        to /api/user/v1/accounts/ back as JSON, and 404s everything else.
+        """
+        async def echo(request):
+            return web.json_response({
+                'method': request.method,
+                'path': request.path,
+                'query': [[key, value] for key, value in request.query.items()],
+                'authorization': request.headers.get('Authorization'),
+                'body': await request.json() if request.can_read_body else None,
+            })
+
+        async def serve_and_test():
+            app = web.Application()
+            app.router.add_route('*', '/api/user/v1/accounts/{path:.*}', echo)
+            async with test_utils.TestServer(app) as server:
+                async with edx_api_async.create_session(limit=2) as session:
+                    return await test(str(server.make_url('/')), session)
+        return _run(serve_and_test())
+
+    def test_requests(self):
+        async def test(base_url, session):
+            lms_api = edx_api_async.AsyncLmsApi(base_url, 'THIS_IS_A_JWT', session)
+            return await asyncio.gather(
+                lms_api.learners_to_retire(['PENDING', 'COMPLETE'], cool_off_days=3),
+                lms_api.retirement_retire_mailings(FAKE_LEARNER),
+                lms_api.retirement_retire_forum(FAKE_LEARNER),
+            )
+
+        queue, mailings, forum = self.serve(test)
+        self.assertEqual(queue, {
+            'method': 'GET',
+            'path': '/api/user/v1/accounts/retirement_queue/',
+            'query': [['cool_off_days', '3'], ['states', 'PENDING'], ['states', 'COMPLETE']],
+            'authorization': 'JWT THIS_IS_A_JWT',
+            'body': None,
+        })
+        self.assertEqual(mailings['method'], 'POST')
+        self.assertEqual(mailings['path'], '/api/user/v1/accounts/retire_mailings/')
+        self.assertEqual(mailings['body'], {'username': 'test_user'})
+        # The forums endpoint isn't served, so it's a 404.
+        self.assertTrue(forum)
+
+    def test_connection_error(self):
+        # Find a port that nothing is listening on.
+        with socket.socket() as unused_socket:
+            unused_socket.bind(('127.0.0.1', 0))
+            port = unused_socket.getsockname()[1]
+        base_url = 'http://127.0.0.1:{}/'.format(port)
+
+        async def test(_, session):
+            with self.assertRaises(ConnectionError) as context:
+                await edx_api_async.AsyncResource(session, base_url, 'THIS_IS_A_JWT').api.get()
+            self.assertIsInstance(context.exception.__cause__, aiohttp.ClientConnectionError)
+
+            with patch('tubular.edx_api._backoff_handler') as mock_backoff_handler:
+                mock_backoff_handler.side_effect = BackoffTriedException
+                with self.assertRaises(BackoffTriedException):
+                    await edx_api_async.AsyncLmsApi(base_url, 'THIS_IS_A_JWT', session).learners_to_retire(['PENDING'])
+
+        self.serve(test)
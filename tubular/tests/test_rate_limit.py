@@ -0,0 +1,142 @@
+"""
+Tests of the code which limits calls to a service.
+"""
+
+import threading
+import time
+import unittest
+
+from ddt import ddt, data
+
+from tubular.utils.rate_limit import RateLimitedClient, ServiceLimiter, TokenBucket
+
+
+class FakeClock:
+    """
+    Clock that only moves when something sleeps.
+    """
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestTokenBucket(unittest.TestCase):
+    """
+    Tests for TokenBucket
+    """
+    def test_burst_then_rate(self):
+        clock = FakeClock()
+        bucket = TokenBucket(4, clock=clock, sleep=clock.sleep)
+        # A full bucket lets a burst of `rate` through at once...
+        self.assertEqual([bucket.acquire() for __ in range(4)], [0.0] * 4)
+        # ...and then one call every 1 / rate seconds.
+        self.assertEqual([bucket.acquire() for __ in range(3)], [0.25] * 3)
+        self.assertEqual(clock.now, 0.75)
+
+    def test_refill(self):
+        clock = FakeClock()
+        bucket = TokenBucket(2, burst=1, clock=clock, sleep=clock.sleep)
+        bucket.acquire()
+        clock.now += 10
+        # Tokens don't pile up past the burst size.
+        self.assertEqual(bucket.acquire(), 0.0)
+        self.assertEqual(bucket.acquire(), 0.5)
+
+    def test_fractional_rate(self):
+        clock = FakeClock()
+        bucket = TokenBucket(0.5, clock=clock, sleep=clock.sleep)
+        self.assertEqual(bucket.acquire(), 0.0)
+        self.assertEqual(bucket.acquire(), 2.0)
+
+    def test_bad_rate(self):
+        with self.assertRaises(ValueError):
+            TokenBucket(0)
+
+
+@ddt
+class TestServiceLimiter(unittest.TestCase):
+    """
+    Tests for ServiceLimiter and RateLimitedClient
+    """
+    def test_max_in_flight(self):
+        limiter = ServiceLimiter(max_in_flight=2)
+        in_flight = []
+        peak = []
+        lock = threading.Lock()
+
+        def call():
+            with limiter.limit():
+                with lock:
+                    in_flight.append(1)
+                    peak.append(len(in_flight))
+                time.sleep(0.01)
+                with lock:
+                    in_flight.pop()
+
+        threads = [threading.Thread(target=call) for __ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(peak), 8)
+        self.assertEqual(max(peak), 2)
+
+    def test_slot_released_on_error(self):
+        limiter = ServiceLimiter(max_in_flight=1)
+        with self.assertRaises(KeyError):
+            with limiter.limit():
+                raise KeyError('boom')
+        with limiter.limit():
+            pass
+
+    def test_no_limits(self):
+        with ServiceLimiter().limit():
+            pass
+
+    @data(
+        {'requests_per_second': 0},
+        {'max_in_flight': -1},
+        {'max_in_flight': 1.5},
+        {'max_in_flight': 'lots'},
+        {'requests_per_second': True},
+        {'requests_per_minute': 10},
+        ['requests_per_second'],
+    )
+    def test_bad_settings(self, settings):
+        with self.assertRaises(ValueError):
+            ServiceLimiter.from_settings(settings)
+
+    def test_from_settings(self):
+        limiter = ServiceLimiter.from_settings({'requests_per_second': 2.5, 'max_in_flight': 3})
+        self.assertEqual((limiter.requests_per_second, limiter.max_in_flight), (2.5, 3))
+
+    def test_rate_limited_client(self):
+        class Client:  # pylint: disable=missing-class-docstring
+            base_url = 'https://example.invalid/'
+
+            def get(self, value):  # pylint: disable=missing-function-docstring
+                return value * 2
+
+            def _private(self):  # pylint: disable=missing-function-docstring
+                return 'private'
+
+        class CountingLimiter(ServiceLimiter):  # pylint: disable=missing-class-docstring
+            calls = 0
+
+            def limit(self):  # pylint: disable=missing-function-docstring
+                self.calls += 1
+                return super().limit()
+
+        limiter = CountingLimiter()
+        client = RateLimitedClient(Client(), limiter)
+        self.assertEqual(client.base_url, 'https://example.invalid/')
+        self.assertEqual(client._private(), 'private')  # pylint: disable=protected-access
+        self.assertEqual(limiter.calls, 0)
+        self.assertEqual(client.get(21), 42)
+        self.assertEqual(client.get.__name__, 'get')
+        self.assertEqual(limiter.calls, 1)
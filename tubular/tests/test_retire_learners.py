@@ -0,0 +1,321 @@
+"""
+Test the retire_learners.py script
+"""
+
+import threading
+import time
+
+import requests
+from mock import patch, DEFAULT
+from slumber.exceptions import HttpClientError
+
+from click.testing import CliRunner
+
+from tubular.scripts.retire_learners import (
+    ERR_BAD_CONFIG,
+    ERR_SETUP_FAILED,
+    ERR_TOO_MANY_LEARNERS,
+    ERR_WHILE_RETIRING,
+    retire_learners
+)
+from tubular.tests.retirement_helpers import fake_config_file, get_fake_user_retirement
+
+
+def _call_script(workers=2, user_count_error_threshold=200, service_limits=None, state_workers=None):
+    """
+    Call the retire learners script with a generic, temporary config file.
+    Returns the CliRunner.invoke results
+    """
+    runner = CliRunner()
+    with runner.isolated_filesystem():
+        with open('test_config.yml', 'w') as f:
+            fake_config_file(f, service_limits=service_limits)
+        args = [
+            '--config_file', 'test_config.yml',
+            '--workers', workers,
+            '--user_count_error_threshold', user_count_error_threshold
+        ]
+        if state_workers:
+            args += ['--state_workers', state_workers]
+        result = runner.invoke(retire_learners, args=args)
+    print(result)
+    print(result.output)
+    return result
+
+
+def _fake_queue(states):
+    """
+    Mock up the retirement queue, and LMS's retirement state for each learner in
+    it, from a dict of username: current state name.
+    """
+    learners = {
+        username: get_fake_user_retirement(original_username=username, current_state_name=state)
+        for username, state in states.items()
+    }
+    return list(learners.values()), learners.get
+
+
+@patch('tubular.edx_api.BaseApiClient.get_access_token')
+@patch.multiple(
+    'tubular.edx_api.LmsApi',
+    learners_to_retire=DEFAULT,
+    get_learner_retirement_state=DEFAULT,
+    update_learner_retirement_state=DEFAULT,
+    retirement_retire_forum=DEFAULT,
+    retirement_retire_mailings=DEFAULT,
+    retirement_unenroll=DEFAULT,
+    retirement_lms_retire=DEFAULT
+)
+def test_successful_retirement(*args, **kwargs):
+    mock_get_access_token = args[0]
+    mock_update_learner_state = kwargs['update_learner_retirement_state']
+
+    mock_get_access_token.return_value = ('THIS_IS_A_JWT', None)
+    kwargs['learners_to_retire'].return_value, kwargs['get_learner_retirement_state'].side_effect = _fake_queue({
+        'test_user1': 'PENDING',
+        'test_user2': 'PENDING',
+        'test_user3': 'EMAIL_LISTS_COMPLETE',
+    })
+
+    result = _call_script()
+
+    # The API clients are shared, so only set up once
+    assert mock_get_access_token.call_count == 3
+    assert kwargs['get_learner_retirement_state'].call_count == 3
+    assert mock_update_learner_state.call_count == 9 + 9 + 5
+
+    for mock_call in (kwargs['retirement_retire_forum'], kwargs['retirement_retire_mailings']):
+        assert mock_call.call_count == 2
+    for mock_call in (kwargs['retirement_unenroll'], kwargs['retirement_lms_retire']):
+        assert mock_call.call_count == 3
+
+    for username in ('test_user1', 'test_user2', 'test_user3'):
+        mock_update_learner_state.assert_any_call(username, 'COMPLETE', 'Learner retirement complete.')
+
+    assert result.exit_code == 0
+    assert '3 complete, 0 errored, 0 skipped, 0 setup failed' in result.output
+    assert 'learners/minute' in result.output
+
+
+@patch('tubular.edx_api.BaseApiClient.get_access_token')
+@patch.multiple(
+    'tubular.edx_api.LmsApi',
+    learners_to_retire=DEFAULT,
+    get_learner_retirement_state=DEFAULT,
+    update_learner_retirement_state=DEFAULT,
+    retirement_retire_forum=DEFAULT,
+    retirement_retire_mailings=DEFAULT,
+    retirement_unenroll=DEFAULT,
+    retirement_lms_retire=DEFAULT
+)
+def test_errored_learner(*args, **kwargs):
+    mock_get_access_token = args[0]
+    mock_update_learner_state = kwargs['update_learner_retirement_state']
+    mock_unenroll = kwargs['retirement_unenroll']
+
+    mock_get_access_token.return_value = ('THIS_IS_A_JWT', None)
+    kwargs['learners_to_retire'].return_value, kwargs['get_learner_retirement_state'].side_effect = _fake_queue({
+        'test_user1': 'PENDING',
+        'test_user2': 'PENDING',
+    })
+
+    def unenroll(learner):
+        if learner['original_username'] == 'test_user2':
+            raise Exception('Test Exception!')
+    mock_unenroll.side_effect = unenroll
+
+    result = _call_script()
+
+    # The failing learner is moved to ERRORED, and the other still completes
+    mock_update_learner_state.assert_any_call('test_user2', 'ERRORED', 'Test Exception!')
+    mock_update_learner_state.assert_any_call('test_user1', 'COMPLETE', 'Learner retirement complete.')
+    kwargs['retirement_lms_retire'].assert_called_once()
+
+    assert result.exit_code == ERR_WHILE_RETIRING
+    assert '1 complete, 1 errored' in result.output
+    assert 'Learner test_user2: errored' in result.output
+
+
+@patch('tubular.edx_api.BaseApiClient.get_access_token')
+@patch.multiple(
+    'tubular.edx_api.LmsApi',
+    learners_to_retire=DEFAULT,
+    get_learner_retirement_state=DEFAULT,
+    update_learner_retirement_state=DEFAULT,
+    retirement_retire_forum=DEFAULT,
+    retirement_retire_mailings=DEFAULT,
+    retirement_unenroll=DEFAULT,
+    retirement_lms_retire=DEFAULT
+)
+def test_refused_access_token(*args, **kwargs):
+    mock_get_access_token = args[0]
+    mock_update_learner_state = kwargs['update_learner_retirement_state']
+
+    mock_get_access_token.return_value = ('THIS_IS_A_JWT', None)
+    kwargs['learners_to_retire'].return_value, kwargs['get_learner_retirement_state'].side_effect = _fake_queue({
+        'test_user{}'.format(i): 'PENDING' for i in range(4)
+    })
+    unauthorized = requests.Response()
+    unauthorized.status_code = 401
+    kwargs['retirement_unenroll'].side_effect = HttpClientError('Client Error 401', response=unauthorized)
+
+    result = _call_script(workers=1)
+
+    # The rest of the queue would fail the same way, so it's left alone
+    mock_update_learner_state.assert_any_call('test_user0', 'ERRORED', 'Client Error 401')
+    assert kwargs['get_learner_retirement_state'].call_count == 1
+    assert result.exit_code == ERR_WHILE_RETIRING
+    assert '0 complete, 1 errored, 0 skipped, 0 setup failed, 3 not started' in result.output
+    assert 'Stopped after an access token was refused' in result.output
+
+
+@patch('tubular.edx_api.BaseApiClient.get_access_token')
+@patch.multiple(
+    'tubular.edx_api.LmsApi',
+    learners_to_retire=DEFAULT,
+    get_learner_retirement_state=DEFAULT,
+    update_learner_retirement_state=DEFAULT,
+    retirement_retire_forum=DEFAULT,
+    retirement_retire_mailings=DEFAULT,
+    retirement_unenroll=DEFAULT,
+    retirement_lms_retire=DEFAULT
+)
+def test_skipping_learners(*args, **kwargs):
+    mock_get_access_token = args[0]
+    mock_update_learner_state = kwargs['update_learner_retirement_state']
+
+    mock_get_access_token.return_value = ('THIS_IS_A_JWT', None)
+    kwargs['learners_to_retire'].return_value, kwargs['get_learner_retirement_state'].side_effect = _fake_queue({
+        'test_user1': 'RETIRING_FORUMS',
+        'test_user2': 'COMPLETE',
+    })
+
+    result = _call_script()
+
+    mock_update_learner_state.assert_not_called()
+    assert result.exit_code == 0
+    assert '0 complete, 0 errored, 2 skipped' in result.output
+    assert 'in a working state' in result.output
+    assert 'already in end state' in result.output
+
+
+@patch('tubular.edx_api.BaseApiClient.get_access_token')
+@patch.multiple(
+    'tubular.edx_api.LmsApi',
+    learners_to_retire=DEFAULT,
+    get_learner_retirement_state=DEFAULT
+)
+def test_too_many_learners(*args, **kwargs):
+    mock_get_access_token = args[0]
+
+    mock_get_access_token.return_value = ('THIS_IS_A_JWT', None)
+    kwargs['learners_to_retire'].return_value, kwargs['get_learner_retirement_state'].side_effect = _fake_queue({
+        'test_user1': 'PENDING',
+        'test_user2': 'PENDING',
+    })
+
+    result = _call_script(user_count_error_threshold=1)
+
+    kwargs['get_learner_retirement_state'].assert_not_called()
+    assert result.exit_code == ERR_TOO_MANY_LEARNERS
+    assert 'Too many learners to retire' in result.output
+
+
+@patch('tubular.edx_api.BaseApiClient.get_access_token')
+@patch.multiple(
+    'tubular.edx_api.LmsApi',
+    learners_to_retire=DEFAULT,
+    get_learner_retirement_state=DEFAULT,
+    update_learner_retirement_state=DEFAULT,
+    retirement_retire_forum=DEFAULT,
+    retirement_retire_mailings=DEFAULT,
+    retirement_unenroll=DEFAULT,
+    retirement_lms_retire=DEFAULT
+)
+def test_service_limits(*args, **kwargs):
+    mock_get_access_token = args[0]
+    mock_get_access_token.return_value = ('THIS_IS_A_JWT', None)
+    kwargs['learners_to_retire'].return_value, kwargs['get_learner_retirement_state'].side_effect = _fake_queue({
+        'test_user{}'.format(i): 'PENDING' for i in range(6)
+    })
+
+    in_flight = []
+    peak = []
+    lock = threading.Lock()
+
+    def slow_call(learner):  # pylint: disable=unused-argument
+        with lock:
+            in_flight.append(1)
+            peak.append(len(in_flight))
+        time.sleep(0.01)
+        with lock:
+            in_flight.pop()
+    kwargs['retirement_retire_forum'].side_effect = slow_call
+
+    result = _call_script(workers=6, service_limits={'LMS': {'max_in_flight': 2, 'requests_per_second': 1000}})
+
+    assert result.exit_code == 0
+    assert '6 complete' in result.output
+    assert len(peak) == 6
+    assert max(peak) <= 2
+
+
+@patch('tubular.edx_api.BaseApiClient.get_access_token')
+@patch.multiple(
+    'tubular.edx_api.LmsApi',
+    learners_to_retire=DEFAULT,
+    get_learner_retirement_state=DEFAULT,
+    update_learner_retirement_state=DEFAULT,
+    retirement_retire_forum=DEFAULT,
+    retirement_retire_mailings=DEFAULT,
+    retirement_unenroll=DEFAULT,
+    retirement_lms_retire=DEFAULT
+)
+def test_state_workers(*args, **kwargs):
+    mock_get_access_token = args[0]
+    mock_get_access_token.return_value = ('THIS_IS_A_JWT', None)
+    kwargs['learners_to_retire'].return_value, kwargs['get_learner_retirement_state'].side_effect = _fake_queue({
+        'test_user{}'.format(i): 'PENDING' for i in range(4)
+    })
+
+    in_flight = []
+    peak = []
+    lock = threading.Lock()
+
+    def slow_call(learner):  # pylint: disable=unused-argument
+        with lock:
+            in_flight.append(1)
+            peak.append(len(in_flight))
+        time.sleep(0.01)
+        with lock:
+            in_flight.pop()
+    for method in ('retirement_retire_forum', 'retirement_retire_mailings', 'retirement_unenroll'):
+        kwargs[method].side_effect = slow_call
+
+    # The learners' states all share the same two threads
+    result = _call_script(workers=4, state_workers=2)
+
+    assert result.exit_code == 0
+    assert '4 complete' in result.output
+    assert len(peak) == 12
+    assert max(peak) <= 2
+
+
+@patch('tubular.edx_api.BaseApiClient.get_access_token')
+def test_bad_service_limits(mock_get_access_token):
+    mock_get_access_token.return_value = ('THIS_IS_A_JWT', None)
+
+    result = _call_script(service_limits={'BRAZE': {'max_in_flight': 2}})
+    assert result.exit_code == ERR_SETUP_FAILED
+    assert 'BRAZE' in result.output
+
+    result = _call_script(service_limits={'LMS': {'requests_per_minute': 2}})
+    assert result.exit_code == ERR_SETUP_FAILED
+    assert 'requests_per_minute' in result.output
+
+
+def test_bad_config():
+    runner = CliRunner()
+    result = runner.invoke(retire_learners, args=['--config_file', 'does_not_exist.yml'])
+    assert result.exit_code == ERR_BAD_CONFIG
+    assert 'does_not_exist.yml' in result.output
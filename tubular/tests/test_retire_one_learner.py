@@ -2,6 +2,9 @@
 Test the retire_one_learner.py script
 """
 
+import threading
+from datetime import datetime, timedelta
+
 from mock import patch, DEFAULT
 
 from click.testing import CliRunner
@@ -15,12 +18,25 @@ from tubular.scripts.retire_one_learner import (
     ERR_UNKNOWN_STATE,
     ERR_USER_AT_END_STATE,
     ERR_USER_IN_WORKING_STATE,
+    ERR_WHILE_RETIRING,
     retire_learner
 )
-from tubular.tests.retirement_helpers import fake_config_file, get_fake_user_retirement
+from tubular.tests.retirement_helpers import (
+    TEST_RETIREMENT_PIPELINE,
+    fake_config_file,
+    get_fake_user_retirement
+)
+
+ALL_STATES = ['PENDING'] + [state for working in TEST_RETIREMENT_PIPELINE for state in working[:2]] + ['COMPLETE']
 
+# The forum and email list states don't depend on anything, so they run at the same time
+CONCURRENT_RETIREMENT_PIPELINE = [
+    TEST_RETIREMENT_PIPELINE[0] + [[]],
+    TEST_RETIREMENT_PIPELINE[1] + [[]],
+] + TEST_RETIREMENT_PIPELINE[2:]
 
-def _call_script(username, fetch_ecom_segment_id=False):
+
+def _call_script(username, fetch_ecom_segment_id=False, retirement_pipeline=None):
     """
     Call the retired learner script with the given username and a generic, temporary config file.
     Returns the CliRunner.invoke results
@@ -28,7 +44,7 @@ def _call_script(username, fetch_ecom_segment_id=False):
     runner = CliRunner()
     with runner.isolated_filesystem():
         with open('test_config.yml', 'w') as f:
-            fake_config_file(f, fetch_ecom_segment_id=fetch_ecom_segment_id)
+            fake_config_file(f, fetch_ecom_segment_id=fetch_ecom_segment_id, retirement_pipeline=retirement_pipeline)
         result = runner.invoke(retire_learner, args=['--username', username, '--config_file', 'test_config.yml'])
     print(result)
     print(result.output)
@@ -80,6 +96,32 @@ def test_successful_retirement(*args, **kwargs):
     assert 'Retirement complete' in result.output
 
 
+@patch('tubular.edx_api.BaseApiClient.get_access_token')
+@patch.multiple(
+    'tubular.edx_api.LmsApi',
+    get_learner_retirement_state=DEFAULT,
+    update_learner_retirement_state=DEFAULT,
+    retirement_retire_forum=DEFAULT,
+    retirement_retire_mailings=DEFAULT,
+    retirement_unenroll=DEFAULT,
+    retirement_lms_retire=DEFAULT
+)
+def test_shared_access_token(*args, **kwargs):
+    username = 'test_username'
+
+    mock_get_access_token = args[0]
+    mock_get_retirement_state = kwargs['get_learner_retirement_state']
+
+    # Tokens with an expiration date are shared between the APIs
+    mock_get_access_token.return_value = ('THIS_IS_A_JWT', datetime.utcnow() + timedelta(hours=1))
+    mock_get_retirement_state.return_value = get_fake_user_retirement(original_username=username)
+
+    result = _call_script(username)
+
+    assert mock_get_access_token.call_count == 1
+    assert result.exit_code == 0
+
+
 @patch('tubular.edx_api.BaseApiClient.get_access_token')
 @patch.multiple(
     'tubular.edx_api.LmsApi',
@@ -411,3 +453,179 @@ def test_get_segment_id_error(*args, **kwargs):
     assert result.exit_code == ERR_SETUP_FAILED
     assert 'Unexpected error fetching Ecommerce tracking id!' in result.output
     assert test_exception_message in result.output
+
+
+@patch('tubular.edx_api.BaseApiClient.get_access_token')
+@patch.multiple(
+    'tubular.edx_api.LmsApi',
+    get_learner_retirement_state=DEFAULT,
+    update_learner_retirement_state=DEFAULT,
+    retirement_retire_forum=DEFAULT,
+    retirement_retire_mailings=DEFAULT,
+    retirement_unenroll=DEFAULT,
+    retirement_lms_retire=DEFAULT
+)
+def test_concurrent_states(*args, **kwargs):
+    username = 'test_username'
+
+    mock_get_access_token = args[0]
+    mock_get_retirement_state = kwargs['get_learner_retirement_state']
+    mock_update_learner_state = kwargs['update_learner_retirement_state']
+    mock_retire_forum = kwargs['retirement_retire_forum']
+    mock_retire_mailings = kwargs['retirement_retire_mailings']
+
+    mock_get_access_token.return_value = ('THIS_IS_A_JWT', None)
+    mock_get_retirement_state.return_value = get_fake_user_retirement(original_username=username)
+
+    # The forum state can only finish while the email list state is running too
+    events = []
+    mailings_started = threading.Event()
+
+    def retire_forum(learner):  # pylint: disable=unused-argument
+        events.append(('call', 'RETIRING_FORUMS'))
+        return mailings_started.wait(5) or 'timed out'
+
+    def retire_mailings(learner):  # pylint: disable=unused-argument
+        events.append(('call', 'RETIRING_EMAIL_LISTS'))
+        mailings_started.set()
+
+    mock_retire_forum.side_effect = retire_forum
+    mock_retire_mailings.side_effect = retire_mailings
+    mock_update_learner_state.side_effect = lambda username, state, message: events.append(('state', state))
+
+    result = _call_script(username, retirement_pipeline=CONCURRENT_RETIREMENT_PIPELINE)
+
+    assert result.exit_code == 0
+    assert 'timed out' not in result.output
+    for mock_call in (mock_retire_forum, mock_retire_mailings, kwargs['retirement_unenroll']):
+        mock_call.assert_called_once_with(mock_get_retirement_state.return_value)
+
+    # LMS still sees the states in pipeline order, and is in the working state of (or before) a state
+    # before it's called
+    states = [state for event, state in events if event == 'state']
+    assert states[0] == 'RETIRING_FORUMS'
+    assert states == sorted(states, key=ALL_STATES.index)
+    assert states[-5:] == ['RETIRING_ENROLLMENTS', 'ENROLLMENTS_COMPLETE', 'RETIRING_LMS', 'LMS_COMPLETE', 'COMPLETE']
+    for position, (event, state) in enumerate(events):
+        if event == 'call':
+            recorded = [recorded_state for event, recorded_state in events[:position] if event == 'state'][-1]
+            assert recorded.startswith('RETIRING_')
+            assert ALL_STATES.index(recorded) <= ALL_STATES.index(state)
+
+
+@patch('tubular.edx_api.BaseApiClient.get_access_token')
+@patch.multiple(
+    'tubular.edx_api.LmsApi',
+    get_learner_retirement_state=DEFAULT,
+    update_learner_retirement_state=DEFAULT,
+    retirement_retire_forum=DEFAULT,
+    retirement_retire_mailings=DEFAULT,
+    retirement_unenroll=DEFAULT,
+    retirement_lms_retire=DEFAULT
+)
+def test_concurrent_states_working_state(*args, **kwargs):
+    username = 'test_username'
+
+    mock_get_access_token = args[0]
+    mock_get_retirement_state = kwargs['get_learner_retirement_state']
+    mock_update_learner_state = kwargs['update_learner_retirement_state']
+
+    mock_get_access_token.return_value = ('THIS_IS_A_JWT', None)
+    mock_get_retirement_state.return_value = get_fake_user_retirement(original_username=username)
+
+    # The email list state is still running when the forum state finishes, and keeps running until
+    # the learner has moved on to its working state
+    mailings_recorded = threading.Event()
+
+    def update_learner_state(username, state, message):  # pylint: disable=unused-argument
+        if state == 'RETIRING_EMAIL_LISTS':
+            mailings_recorded.set()
+    mock_update_learner_state.side_effect = update_learner_state
+    kwargs['retirement_retire_mailings'].side_effect = lambda learner: mailings_recorded.wait(5) or 'timed out'
+
+    result = _call_script(username, retirement_pipeline=CONCURRENT_RETIREMENT_PIPELINE)
+
+    assert result.exit_code == 0
+    assert 'timed out' not in result.output
+    # The learner isn't moved to FORUMS_COMPLETE, which isn't a working state, while the email list state runs
+    assert [call[0][1] for call in mock_update_learner_state.call_args_list] == [
+        'RETIRING_FORUMS',
+        'RETIRING_EMAIL_LISTS', 'EMAIL_LISTS_COMPLETE',
+        'RETIRING_ENROLLMENTS', 'ENROLLMENTS_COMPLETE',
+        'RETIRING_LMS', 'LMS_COMPLETE',
+        'COMPLETE',
+    ]
+
+
+@patch('tubular.edx_api.BaseApiClient.get_access_token')
+@patch.multiple(
+    'tubular.edx_api.LmsApi',
+    get_learner_retirement_state=DEFAULT,
+    update_learner_retirement_state=DEFAULT,
+    retirement_retire_forum=DEFAULT,
+    retirement_retire_mailings=DEFAULT,
+    retirement_unenroll=DEFAULT,
+    retirement_lms_retire=DEFAULT
+)
+def test_concurrent_state_error(*args, **kwargs):
+    username = 'test_username'
+
+    mock_get_access_token = args[0]
+    mock_get_retirement_state = kwargs['get_learner_retirement_state']
+    mock_update_learner_state = kwargs['update_learner_retirement_state']
+
+    mock_get_access_token.return_value = ('THIS_IS_A_JWT', None)
+    mock_get_retirement_state.return_value = get_fake_user_retirement(original_username=username)
+    kwargs['retirement_retire_mailings'].side_effect = Exception('Test Exception!')
+
+    result = _call_script(username, retirement_pipeline=CONCURRENT_RETIREMENT_PIPELINE)
+
+    # The forum state still finishes, but nothing that depends on the failed state runs
+    kwargs['retirement_retire_forum'].assert_called_once()
+    kwargs['retirement_unenroll'].assert_not_called()
+    mock_update_learner_state.assert_called_with(username, 'ERRORED', 'Test Exception!')
+
+    assert result.exit_code == ERR_WHILE_RETIRING
+    assert 'Error encountered in state "RETIRING_EMAIL_LISTS"' in result.output
+
+
+@patch('tubular.edx_api.BaseApiClient.get_access_token')
+@patch.multiple(
+    'tubular.edx_api.LmsApi',
+    get_learner_retirement_state=DEFAULT,
+    update_learner_retirement_state=DEFAULT,
+    retirement_retire_forum=DEFAULT,
+    retirement_retire_mailings=DEFAULT,
+    retirement_unenroll=DEFAULT,
+    retirement_lms_retire=DEFAULT
+)
+def test_resuming_concurrent_states(*args, **kwargs):
+    username = 'test_username'
+
+    mock_get_access_token = args[0]
+    mock_get_retirement_state = kwargs['get_learner_retirement_state']
+    mock_update_learner_state = kwargs['update_learner_retirement_state']
+
+    mock_get_access_token.return_value = ('THIS_IS_A_JWT', None)
+    mock_get_retirement_state.return_value = get_fake_user_retirement(
+        original_username=username,
+        current_state_name='FORUMS_COMPLETE'
+    )
+
+    result = _call_script(username, retirement_pipeline=CONCURRENT_RETIREMENT_PIPELINE)
+
+    assert result.exit_code == 0
+    kwargs['retirement_retire_forum'].assert_not_called()
+    kwargs['retirement_retire_mailings'].assert_called_once()
+    assert mock_update_learner_state.call_count == 7
+    assert 'RETIRING_FORUMS completed in previous run' in result.output
+
+
+def test_bad_dependencies():
+    username = 'test_username'
+    result = _call_script(username, retirement_pipeline=[
+        TEST_RETIREMENT_PIPELINE[0] + [['RETIRING_LMS']],
+    ] + TEST_RETIREMENT_PIPELINE[1:])
+
+    assert result.exit_code == ERR_BAD_CONFIG
+    assert 'RETIRING_FORUMS depends on RETIRING_LMS' in result.output
@@ -5,21 +5,33 @@ IMPORTANT: If you are making changes to this code, please re-enable the
 TestSplitMongoBackend tests and run them locally against the MongoDB instance
 in your Docker Devstack. See the TestSplitMongoBackend docstring for more info.
 """
+from array import array
+from collections import deque
 from datetime import datetime
 from io import StringIO
-from unittest.mock import patch
+from unittest.mock import MagicMock, Mock, patch
 import unittest
 import itertools
+import gzip
+import os
+import random
+import re
+import struct
+import tempfile
 import textwrap
 
+from bson import BSON
 from bson.objectid import ObjectId
 from opaque_keys.edx.locator import CourseLocator, LibraryLocator
-from pymongo import MongoClient
+from pymongo import MongoClient, ReadPreference
 
 import ddt
 
 from tubular.splitmongo import (
-    ActiveVersionBranch, ChangePlan, Structure, SplitMongoBackend, StructuresGraph
+    ActiveVersionBranch, AdaptiveThrottle, ChangePlan, CompactStructuresGraph, IntegrityReport, KeepPolicy,
+    RetentionEngine, ReclamationReport, Structure,
+    MongoDumpBackend, PruneJournal, SplitMongoBackend, StructureIds, StructuresGraph, StructuresSnapshot, Throttle,
+    zstandard, _BinaryIdSet, _bson_id_fields, ARCHIVE_MAGIC
 )
 
 
@@ -88,6 +100,7 @@ class TestCourseChangePlan(unittest.TestCase):
         plan_no_intermediate = ChangePlan.create(graph, 0)
         self.assertEqual(plan_no_intermediate.delete, ["2", "3"])
         self.assertEqual(plan_no_intermediate.update_parents, [("4", "1")])
+        self.assertEqual(plan_no_intermediate.delete_ranges, [("2", "3")])
 
         # Preserve one intermediate structure
         plan_1_intermediate = ChangePlan.create(graph, 1)
@@ -157,6 +170,76 @@ class TestCourseChangePlan(unittest.TestCase):
         self.assertEqual(plan_save_1.delete, ["2", "5"])
         self.assertEqual(plan_save_1.update_parents, [("3", "1"), ("6", "1")])
 
+    @ddt.data(ChangePlan.RANK_BLOCK_SIZE, 1, 2, 3)
+    def test_sizes(self, rank_block_size):
+        """Sizes of the Structures to delete, in the plan and details file."""
+        graph = create_test_graph(
+            ["1", "2", "3", "4"],
+            ["1", "2", "3", "5"],
+            ["6", "7", "8"],
+        )
+        buff = StringIO()
+        buff.name = "test_file.txt"
+        with patch.object(ChangePlan, 'RANK_BLOCK_SIZE', rank_block_size):
+            plan = ChangePlan.create(
+                graph, 0, buff, size_lookup=lambda structure_ids: [int(s_id) * 100 for s_id in structure_ids]
+            )
+        self.assertEqual(plan.delete, ["2", "3", "7"])
+        self.assertEqual(list(plan.delete_sizes), [200, 300, 700])
+        details_txt = buff.getvalue()
+        self.assertIn("Bytes to Free: 1200\n", details_txt)
+        self.assertIn(
+            textwrap.dedent(
+                """
+                == Top Courses by Bytes Freed ==
+                course-v1:edx+splitmongo+3 700
+                course-v1:edx+splitmongo+1 500
+                course-v1:edx+splitmongo+2 500
+                """
+            ),
+            details_txt
+        )
+
+    def test_details_summary_only(self):
+        """Summary and statistics only, with some orphaned Structures."""
+        graph = create_test_graph(["1", "2", "3", "4", "5"], ["1", "2", "6"])
+        for structure in [Structure("7", "7", None), Structure("8", "7", "7"), Structure("9", "7", "7")]:
+            graph.structures[structure.id] = structure
+        buff = StringIO()
+        buff.name = "test_file.txt"
+        ChangePlan.create(graph, 0, buff, details_summary_only=True)
+        expected_output = textwrap.dedent(
+            """
+            == Summary ==
+            Active Version Branches: 2
+            Total Structures: 9
+            Structures to Save: 3
+            Structures to Delete: 6
+            Structures to Rewrite Parent Link: 2
+
+            == Statistics ==
+            Orphaned Structures: 3
+            Orphaned Chains: 2
+            Active Structure Chain Lengths:
+              2-3: 1
+              4-7: 1
+
+            == Top Courses by Structures Deleted ==
+            course-v1:edx+splitmongo+1 3
+            course-v1:edx+splitmongo+2 1
+            """
+        ).lstrip()
+        self.assertEqual(expected_output, buff.getvalue())
+
+    def test_details_missing_structure(self):
+        """Branch listings end with the first Structure that isn't in the graph."""
+        graph = create_test_graph(["1", "2", "3"])
+        del graph.structures["1"]
+        buff = StringIO()
+        buff.name = "test_file.txt"
+        ChangePlan.create(graph, 5, buff)
+        self.assertTrue(buff.getvalue().endswith("+ 3 (active)\n+ 2\n+ 1 (missing)\n\n"))
+
     def test_details_output(self):
         """Test our details file output."""
         graph = create_test_graph(
@@ -179,6 +262,18 @@ class TestCourseChangePlan(unittest.TestCase):
             Structures to Delete: 1
             Structures to Rewrite Parent Link: 1
 
+            == Statistics ==
+            Orphaned Structures: 0
+            Orphaned Chains: 0
+            Active Structure Chain Lengths:
+              1: 1
+              2-3: 2
+
+            == Top Courses by Structures Deleted ==
+            course-v1:edx+splitmongo+3 1
+            course-v1:edx+splitmongo+1 0
+            course-v1:edx+splitmongo+2 0
+
             == Active Versions ==
             Active Version A00000000000000000000001 [2012-05-02 00:00:00] draft-branch for course-v1:edx+splitmongo+1
             + 1 (active) (original)
@@ -205,6 +300,636 @@ class TestCourseChangePlan(unittest.TestCase):
         )
 
 
+def create_compact_test_graph(*version_histories):
+    """
+    Return a (StructuresGraph, CompactStructuresGraph) pair for the same
+    histories, which are lists of ints (CompactStructuresGraph requires IDs that
+    are valid ObjectIds).
+    """
+    graph = create_test_graph(
+        *[[str_id(version) for version in history] for history in version_histories]
+    )
+    # Reverse the input order to exercise the out-of-order merging.
+    compact_graph = CompactStructuresGraph.build(
+        graph.branches, reversed(list(graph.structures.values()))
+    )
+    return graph, compact_graph
+
+
+@ddt.ddt
+class TestCompactStructuresGraph(unittest.TestCase):
+    """
+    CompactStructuresGraph should be interchangeable with StructuresGraph.
+    """
+    def test_structures(self):
+        """Lookups and iteration match the dict based StructuresGraph."""
+        graph, compact_graph = create_compact_test_graph([1, 2, 3], [1, 2, 4], [10])
+        self.assertEqual(len(compact_graph), 5)
+        self.assertEqual(list(compact_graph.structure_ids()), graph.structure_ids())
+        self.assertEqual(compact_graph.structures, graph.structures)
+        self.assertEqual(
+            compact_graph.structures[str_id(4)],
+            Structure(str_id(4), str_id(1), str_id(2))
+        )
+        self.assertIn(str_id(10), compact_graph.structures)
+        self.assertNotIn(str_id(5), compact_graph.structures)
+        self.assertNotIn("not-an-id", compact_graph.structures)
+        with self.assertRaises(KeyError):
+            compact_graph.index_of(str_id(5))
+
+        # 12 bytes per ID, plus two int32 links.
+        self.assertEqual(compact_graph.original_idxs.itemsize, 4)
+        self.assertEqual(compact_graph.previous_idxs.itemsize, 4)
+
+    def test_traverse_ids(self):
+        """Traversal, including links to Structures that aren't in the graph."""
+        graph = create_test_graph([str_id(i) for i in range(1, 6)])
+        del graph.structures[str_id(2)]
+        compact_graph = CompactStructuresGraph.build(graph.branches, graph.structures.values())
+        for limit, include_start in itertools.product([None, 0, 1, 2, 5], [True, False]):
+            self.assertEqual(
+                list(compact_graph.traverse_ids(str_id(5), limit, include_start)),
+                list(graph.traverse_ids(str_id(5), limit, include_start)),
+            )
+        self.assertEqual(
+            list(compact_graph.traverse_ids(str_id(5))),
+            [str_id(4), str_id(3), str_id(2)]
+        )
+
+    def test_extended(self):
+        """Merging in extra Structures (like race condition fetches)."""
+        graph, compact_graph = create_compact_test_graph([1, 2, 3])
+        extra = [Structure(str_id(4), str_id(1), str_id(3)), Structure(str_id(3), str_id(1), str_id(2))]
+        extended_graph = compact_graph.extended(graph.branches, extra)
+        self.assertEqual(len(extended_graph), 4)
+        self.assertEqual(
+            list(extended_graph.traverse_ids(str_id(4))),
+            [str_id(3), str_id(2), str_id(1)]
+        )
+
+    @ddt.data(0, 1, 2, 5)
+    def test_change_plan(self, retain):
+        """ChangePlans and details are identical for both graph types."""
+        graph, compact_graph = create_compact_test_graph(
+            [1],
+            [1, 2, 3],
+            [1, 2, 3, 4, 5],
+            [1, 2, 3, 6],
+            [1, 2, 7, 8, 9, 10],
+            [20, 21, 22, 23, 24, 25, 26, 27],
+        )
+        details, compact_details = StringIO(), StringIO()
+        details.name = compact_details.name = "test_file.txt"
+        self.assertEqual(
+            ChangePlan.create(compact_graph, retain, compact_details),
+            ChangePlan.create(graph, retain, details),
+        )
+        self.assertEqual(compact_details.getvalue(), details.getvalue())
+
+
+def per_branch_change_plan(structures_graph, num_intermediate_structures):
+    """
+    Straightforward one-branch-at-a-time version of ChangePlan.create, used as
+    a reference for the batched RetentionEngine.
+    """
+    branches, structures = structures_graph
+    structure_ids_to_save = set()
+    for branch in branches:
+        structure_ids_to_save.add(branch.structure_id)
+        structure_ids_to_save.add(structures[branch.structure_id].original_id)
+        structure_ids_to_save.update(
+            structures_graph.traverse_ids(branch.structure_id, limit=num_intermediate_structures)
+        )
+
+    set_parent_to_original = set()
+    for branch in branches:
+        last_seen = deque(
+            itertools.takewhile(
+                lambda s: s in structure_ids_to_save and not structures[s].is_original(),
+                structures_graph.traverse_ids(branch.structure_id, include_start=True)
+            ),
+            1
+        )
+        if last_seen:
+            structure = structures[last_seen.pop()]
+            if structure.original_id != structure.previous_id:
+                set_parent_to_original.add(structure.id)
+
+    delete_ranges = []
+    for to_save, run in itertools.groupby(sorted(structures), lambda s_id: s_id in structure_ids_to_save):
+        run = list(run)
+        if not to_save and len(run) > 1:
+            delete_ranges.append((run[0], run[-1]))
+
+    return ChangePlan(
+        delete=sorted(structures.keys() - structure_ids_to_save),
+        update_parents=sorted((s_id, structures[s_id].original_id) for s_id in set_parent_to_original),
+        delete_ranges=delete_ranges,
+    )
+
+
+@ddt.ddt
+class TestRetentionEngine(unittest.TestCase):
+    """
+    The batched RetentionEngine must give the same answers as walking each
+    branch individually.
+    """
+    @staticmethod
+    def random_graph(seed):
+        """Courses with random edit histories, with branches off shared history."""
+        rand = random.Random(seed)
+        next_id = itertools.count(1)
+        histories = []
+        for _ in range(rand.randint(1, 20)):
+            history = [next(next_id) for _ in range(rand.randint(1, 30))]
+            histories.append(history)
+            # Published/draft style branches that share part of their history.
+            for _ in range(rand.randint(0, 2)):
+                fork_point = rand.randint(1, len(history))
+                histories.append(
+                    history[:fork_point] + [next(next_id) for _ in range(rand.randint(0, 5))]
+                )
+        return create_compact_test_graph(*histories)
+
+    @ddt.data(*range(10))
+    def test_matches_per_branch(self, seed):
+        """Compare against the per-branch algorithm on random graphs."""
+        graph, compact_graph = self.random_graph(seed)
+        for retain in [0, 1, 2, 3, 10]:
+            expected = per_branch_change_plan(graph, retain)
+            self.assertEqual(ChangePlan.create(graph, retain), expected)
+            self.assertEqual(ChangePlan.create(compact_graph, retain), expected)
+
+    def test_retained(self):
+        """Keep flags for a single chain."""
+        _, compact_graph = create_compact_test_graph([1, 2, 3, 4, 5])
+        engine = RetentionEngine(compact_graph)
+        keep, kept_missing = engine.retained([compact_graph.index_of(str_id(5))], 1)
+        self.assertEqual(list(keep), [1, 0, 0, 1, 1])
+        self.assertEqual(kept_missing, set())
+        self.assertEqual(engine.relinks([compact_graph.index_of(str_id(5))], keep), {3})
+
+
+@ddt.ddt
+class TestKeepPolicy(unittest.TestCase):
+    """
+    Time based retention, with ages from the ObjectId timestamps.
+    """
+    NOW = 1600000000
+
+    def days_ago_id(self, days, serial=0):
+        """A Structure ID created `days` days before NOW."""
+        return "{:08x}{:016x}".format(self.NOW - days * KeepPolicy.SECONDS_PER_DAY, serial)
+
+    def graph(self, compact, *histories):
+        """A graph of histories given as lists of ages in days, oldest first."""
+        graph = create_test_graph(*[[self.days_ago_id(days) for days in history] for history in histories])
+        if compact:
+            return CompactStructuresGraph.build(graph.branches, graph.structures.values())
+        return graph
+
+    def assert_prunes_cleanly(self, graph, change_plan):
+        """Applying `change_plan` leaves every kept Structure reachable."""
+        structures = dict(graph.structures)
+        for structure_id in change_plan.delete:
+            del structures[structure_id]
+        for structure_id, previous_id in change_plan.update_parents:
+            structures[structure_id] = structures[structure_id]._replace(previous_id=previous_id)
+        report = IntegrityReport.create(StructuresGraph(graph.branches, structures))
+        self.assertTrue(report.is_consistent())
+        self.assertEqual(report.unreachable, [])
+
+    def test_window(self):
+        policy = KeepPolicy(30, 2)
+        self.assertEqual(
+            [policy.window(days * KeepPolicy.SECONDS_PER_DAY) for days in [0, 29, 30, 59, 60, 119, 120, 500]],
+            [0, 0, 1, 1, 2, 2, 3, 5]
+        )
+        self.assertIsNone(KeepPolicy(30).window(30 * KeepPolicy.SECONDS_PER_DAY))
+        self.assertEqual(KeepPolicy(0, 2).window(0), 1)
+
+    @ddt.data(False, True)
+    def test_thinning(self, compact):
+        """Recent history is kept, older history thinned, and the gaps re-linked."""
+        graph = self.graph(compact, [400, 300, 200, 100, 50, 40, 35, 20, 10, 1])
+        change_plan = ChangePlan.create(graph, 0, keep_policy=KeepPolicy(30, 2, now=self.NOW))
+        self.assertEqual(change_plan.delete, [self.days_ago_id(50), self.days_ago_id(40)])
+        self.assertEqual(change_plan.update_parents, [(self.days_ago_id(35), self.days_ago_id(100))])
+        self.assert_prunes_cleanly(graph, change_plan)
+
+        # Without thinning, only the last 30 days (and the Original) are kept.
+        change_plan = ChangePlan.create(graph, 0, keep_policy=KeepPolicy(30, now=self.NOW))
+        self.assertEqual(change_plan.delete, [self.days_ago_id(days) for days in [300, 200, 100, 50, 40, 35]])
+        self.assertEqual(change_plan.update_parents, [(self.days_ago_id(20), self.days_ago_id(400))])
+        self.assert_prunes_cleanly(graph, change_plan)
+
+    @ddt.data(False, True)
+    def test_shared_history(self, compact):
+        """Each branch keeps the newest Structure of each window in its own history."""
+        graph = self.graph(compact, [400, 220, 200, 100, 90], [400, 220, 200, 100, 5])
+        buff = StringIO()
+        buff.name = "test_file.txt"
+        change_plan = ChangePlan.create(graph, 0, buff, keep_policy=KeepPolicy(30, 2, now=self.NOW))
+        # 220 days is in the same window as the 200 day old Structure. 100 days
+        # is in the same window as 90, but it's the newest in its window for
+        # the other branch.
+        self.assertEqual(change_plan.delete, [self.days_ago_id(220)])
+        self.assertEqual(change_plan.update_parents, [(self.days_ago_id(200), self.days_ago_id(400))])
+        self.assertIn("(re-link to original)", buff.getvalue())
+        self.assert_prunes_cleanly(graph, change_plan)
+
+    @ddt.data(False, True)
+    def test_nothing_extra_kept(self, compact):
+        """A policy that keeps nothing extra gives the same plan as no policy."""
+        # The first branch's Active Structure is in the history of the second.
+        graph = self.graph(compact, [400, 300, 200], [400, 300, 200, 100, 50])
+        change_plan = ChangePlan.create(graph, 0)
+        self.assertEqual(
+            change_plan.update_parents,
+            [(self.days_ago_id(200), self.days_ago_id(400)), (self.days_ago_id(50), self.days_ago_id(400))]
+        )
+        for keep_policy in [KeepPolicy(0, now=self.NOW), KeepPolicy(10, now=self.NOW)]:
+            self.assertEqual(ChangePlan.create(graph, 0, keep_policy=keep_policy), change_plan)
+
+        # When the policy does keep more, the gaps are re-linked to the next
+        # kept Structure, which here is the first branch's Active Structure.
+        graph = self.graph(compact, [400, 300, 200], [400, 300, 200, 150, 100, 50])
+        change_plan = ChangePlan.create(graph, 0, keep_policy=KeepPolicy(120, now=self.NOW))
+        self.assertEqual(change_plan.delete, [self.days_ago_id(300), self.days_ago_id(150)])
+        self.assertEqual(
+            change_plan.update_parents,
+            [(self.days_ago_id(200), self.days_ago_id(400)), (self.days_ago_id(100), self.days_ago_id(200))]
+        )
+        self.assert_prunes_cleanly(graph, change_plan)
+
+
+@ddt.ddt
+class TestIntegrityReport(unittest.TestCase):
+    """
+    Finding dangling links and unreachable Structures.
+    """
+    def broken_graph(self, compact):
+        """A graph with one of each kind of problem."""
+        graph = create_test_graph(
+            [str_id(i) for i in [1, 2, 3]],
+            [str_id(i) for i in [10, 11]],
+        )
+        structures = dict(graph.structures)
+        del structures[str_id(2)]
+        structures[str_id(20)] = Structure(str_id(20), str_id(20), None)
+        structures[str_id(30)] = Structure(str_id(30), str_id(99), str_id(20))
+        branches = graph.branches + [graph.branches[0]._replace(branch='published-branch', structure_id=str_id(40))]
+        if compact:
+            return CompactStructuresGraph.build(branches, structures.values())
+        return StructuresGraph(branches, structures)
+
+    @ddt.data(False, True)
+    def test_problems(self, compact):
+        report = IntegrityReport.create(self.broken_graph(compact))
+        self.assertFalse(report.is_consistent())
+        self.assertEqual(report.num_structures, 6)
+        self.assertEqual([branch.structure_id for branch in report.missing_active], [str_id(40)])
+        self.assertEqual(report.dangling_previous, [(str_id(3), str_id(2))])
+        self.assertEqual(report.dangling_original, [(str_id(30), str_id(99))])
+        self.assertEqual(list(report.unreachable), [str_id(i) for i in [1, 20, 30]])
+
+    @ddt.data(False, True)
+    def test_consistent(self, compact):
+        graph, compact_graph = create_compact_test_graph([1, 2, 3], [1, 2, 4], [10])
+        report = IntegrityReport.create(compact_graph if compact else graph)
+        self.assertTrue(report.is_consistent())
+        self.assertEqual(len(report.unreachable), 0)
+
+    @patch.object(IntegrityReport, 'MAX_LISTED', 2)
+    def test_write(self):
+        buff = StringIO()
+        IntegrityReport.create(self.broken_graph(False)).write(buff)
+        # pylint: disable=line-too-long
+        expected_output = textwrap.dedent(
+            """
+            == Summary ==
+            Total Structures: 6
+            Missing Active Structures: 1
+            Dangling Previous Links: 1
+            Dangling Original Links: 1
+            Unreachable Structures: 3
+
+            == Missing Active Structures ==
+            Active Version A00000000000000000000001 [2012-05-02 00:00:00] published-branch for course-v1:edx+splitmongo+1: {0}40
+
+            == Dangling Previous Links ==
+            {0}03 -> {0}02
+
+            == Dangling Original Links ==
+            {0}30 -> {0}99
+
+            == Unreachable Structures ==
+            {0}01
+            {0}20
+            ... and 1 more
+            """
+        ).lstrip().format('0' * 22)
+        self.assertEqual(buff.getvalue(), expected_output)
+
+
+class TestReclamationReport(unittest.TestCase):
+    """
+    Combined report for pruning several databases.
+    """
+    def test_write_combined(self):
+        reports = [
+            ReclamationReport('tenant-a', 1000, 600, 600, 6000, 12.5, None),
+            ReclamationReport('tenant-b', 500, 100, None, None, 3.25, None),
+            ReclamationReport('tenant-c', None, None, None, None, 0.5, 'connection refused'),
+        ]
+        buff = StringIO()
+        ReclamationReport.write_combined(reports, buff)
+        lines = buff.getvalue().splitlines()
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(lines[1].split(), ['tenant-a', '1000', '600', '600', '6000', '12.5', 'OK'])
+        self.assertEqual(lines[2].split(), ['tenant-b', '500', '100', '-', '-', '3.2', 'OK'])
+        self.assertEqual(lines[3].split(), ['tenant-c', '-', '-', '-', '-', '0.5', 'ERROR:', 'connection', 'refused'])
+        self.assertEqual(lines[4].split(), ['Total', '1500', '700', '600', '6000', '16.2', '1', 'failed'])
+
+        buff = StringIO()
+        ReclamationReport.write_combined(reports[:1], buff, elapsed=20)
+        self.assertEqual(
+            buff.getvalue().splitlines()[-1].split(), ['Total', '1000', '600', '600', '6000', '20.0', 'OK']
+        )
+
+
+class TestStructuresSnapshot(unittest.TestCase):
+    """
+    Reading and writing the on-disk Structures snapshot.
+    """
+    def setUp(self):
+        super().setUp()
+        temp_dir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(temp_dir.cleanup)
+        self.snapshot = StructuresSnapshot(os.path.join(temp_dir.name, 'structures.snapshot'))
+
+    @staticmethod
+    def graph_for(packed):
+        """Helper to make the contents of a snapshot easy to compare."""
+        return dict(CompactStructuresGraph.from_partitions([], [packed]).structures)
+
+    def test_missing_file(self):
+        """No file means an empty snapshot."""
+        self.assertEqual(self.graph_for(self.snapshot.load()), {})
+
+    def test_round_trip(self):
+        """Save, append, and load again."""
+        graph, compact_graph = create_compact_test_graph([1, 2, 3], [10, 11])
+        packed = CompactStructuresGraph.scan_partition(compact_graph.structures.values())
+        self.snapshot.save(packed)
+        self.assertEqual(self.graph_for(self.snapshot.load()), graph.structures)
+
+        new_structure = Structure(str_id(12), str_id(10), str_id(11))
+        new_packed = CompactStructuresGraph.scan_partition([new_structure])
+        self.snapshot.append([(new_packed.ids, new_packed.original_ids, new_packed.previous_ids)])
+        expected = dict(graph.structures, **{str_id(12): new_structure})
+        self.assertEqual(self.graph_for(self.snapshot.load()), expected)
+
+        # A partially written record (e.g. from an interrupted scan) is ignored.
+        with open(self.snapshot.path, 'ab') as snapshot_file:
+            snapshot_file.write(b'partial')
+        self.assertEqual(self.graph_for(self.snapshot.load()), expected)
+
+    def test_not_a_snapshot(self):
+        """Refuse to read some other kind of file."""
+        with open(self.snapshot.path, 'w') as snapshot_file:
+            snapshot_file.write('{"delete": []}')
+        with self.assertRaises(ValueError):
+            self.snapshot.load()
+
+
+@ddt.ddt
+class TestBinaryChangePlan(unittest.TestCase):
+    """
+    Reading and writing ChangePlans in the binary format.
+    """
+    def setUp(self):
+        super().setUp()
+        temp_dir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(temp_dir.cleanup)
+        self.plan_path = os.path.join(temp_dir.name, 'plan')
+        self.change_plan = ChangePlan(
+            delete=[str_id(i) for i in range(1, 12)],
+            update_parents=[(str_id(20), str_id(21)), (str_id(22), str_id(23))],
+            delete_ranges=[(str_id(2), str_id(5)), (str_id(8), str_id(9))],
+            delete_sizes=array('I', range(100, 111)),
+            delete_record_ids=array('q', [2 ** 40 + i for i in range(11, 0, -1)]),
+        )
+
+    def dump_and_load(self, change_plan, **dump_kwargs):
+        """Write `change_plan` in the binary format and load it again."""
+        with open(self.plan_path, 'wb') as plan_file:
+            change_plan.dump_binary(plan_file, **dump_kwargs)
+        return ChangePlan.load_file(self.plan_path)
+
+    @ddt.data('none', 'gzip', 'zstd')
+    def test_round_trip(self, compression):
+        if compression == 'zstd' and zstandard is None:
+            self.skipTest("zstandard is not installed")
+        loaded_plan = self.dump_and_load(self.change_plan, compression=compression, ids_per_block=4)
+        self.assertIsInstance(loaded_plan.delete, StructureIds)
+        self.assertEqual(loaded_plan, self.change_plan)
+        self.assertEqual(loaded_plan.delete[5], str_id(6))
+        self.assertEqual(loaded_plan.delete[-1], str_id(11))
+        self.assertEqual(loaded_plan.delete[2:5], [str_id(3), str_id(4), str_id(5)])
+
+    def test_empty(self):
+        loaded_plan = self.dump_and_load(ChangePlan(delete=[], update_parents=[]))
+        self.assertEqual(loaded_plan, ChangePlan(delete=[], update_parents=[]))
+
+    def test_defaults_not_shared(self):
+        first_plan = ChangePlan(delete=[], update_parents=[])
+        second_plan = ChangePlan(delete=[], update_parents=[])
+        for first_value, second_value in zip(first_plan[2:], second_plan[2:]):
+            self.assertIsNot(first_value, second_value)
+        first_plan.delete_sizes.append(1)
+        self.assertEqual(second_plan.delete_sizes, array('I'))
+
+    def test_lookups(self):
+        """Membership and resuming use binary searches across blocks."""
+        structure_ids = self.dump_and_load(self.change_plan, ids_per_block=4).delete
+        self.assertIn(str_id(1), structure_ids)
+        self.assertIn(str_id(8), structure_ids)
+        self.assertNotIn(str_id(12), structure_ids)
+        self.assertNotIn("not an ID", structure_ids)
+        self.assertEqual(list(structure_ids.iter_from(str_id(4))), [str_id(i) for i in range(4, 12)])
+        self.assertEqual(list(structure_ids.iter_from(str_id(0))), [str_id(i) for i in range(1, 12)])
+        self.assertEqual(list(structure_ids.iter_from(str_id(12))), [])
+        self.assertEqual(
+            list(SplitMongoBackend.iter_from_start(structure_ids, str_id(10))),
+            [str_id(10), str_id(11)]
+        )
+
+    def test_unsorted(self):
+        """The binary format relies on deletions being in order."""
+        unsorted_plan = ChangePlan(delete=[str_id(2), str_id(1)], update_parents=[])
+        with open(self.plan_path, 'wb') as plan_file:
+            with self.assertRaises(ValueError):
+                unsorted_plan.dump_binary(plan_file)
+
+    def test_largest_first(self):
+        """Deleting the largest Structures first works for either kind of plan."""
+        change_plan = self.change_plan._replace(delete_sizes=array('I', [5, 1, 9, 3, 3, 0, 0, 0, 0, 0, 7]))
+        expected_order = [str_id(i) for i in [3, 11, 1, 4, 5]]
+        largest_first = SplitMongoBackend._largest_first  # pylint: disable=protected-access
+        self.assertEqual(list(largest_first(change_plan))[:5], expected_order)
+        loaded_plan = self.dump_and_load(change_plan, ids_per_block=4)
+        self.assertEqual(list(largest_first(loaded_plan))[:5], expected_order)
+        with self.assertRaises(ValueError):
+            list(largest_first(change_plan._replace(delete_sizes=array('I'))))
+
+    def test_record_order(self):
+        """Deleting in record order works for either kind of plan."""
+        change_plan = self.change_plan._replace(delete_record_ids=array('q', [9, 2, 8, 3, 7, 4, 6, 5, 1, 11, 10]))
+        expected_order = [str_id(i) for i in [9, 2, 4, 6, 8]]
+        in_record_order = SplitMongoBackend._in_record_order  # pylint: disable=protected-access
+        self.assertEqual(list(in_record_order(change_plan))[:5], expected_order)
+        loaded_plan = self.dump_and_load(change_plan, ids_per_block=4)
+        self.assertEqual(list(in_record_order(loaded_plan))[:5], expected_order)
+        with self.assertRaises(ValueError):
+            in_record_order(change_plan._replace(delete_record_ids=array('q')))
+
+    def test_load_json(self):
+        """load_file still reads the JSON format."""
+        with open(self.plan_path, 'w') as plan_file:
+            self.change_plan.dump(plan_file)
+        loaded_plan = ChangePlan.load_file(self.plan_path)
+        self.assertEqual(loaded_plan.delete, self.change_plan.delete)
+        self.assertEqual([tuple(update) for update in loaded_plan.update_parents], self.change_plan.update_parents)
+        self.assertEqual(loaded_plan.delete_ranges, self.change_plan.delete_ranges)
+        self.assertEqual(loaded_plan.delete_sizes, self.change_plan.delete_sizes)
+        self.assertEqual(loaded_plan.delete_record_ids, self.change_plan.delete_record_ids)
+
+    def test_compact_graph_plan(self):
+        """Plans from a CompactStructuresGraph use StructureIds for deletions."""
+        _, compact_graph = create_compact_test_graph([1, 2, 3, 4, 5], [10, 11, 12, 13])
+        change_plan = ChangePlan.create(compact_graph, 0)
+        self.assertIsInstance(change_plan.delete, StructureIds)
+        self.assertEqual(change_plan.delete, [str_id(i) for i in [2, 3, 4, 11, 12]])
+        self.assertEqual(change_plan.delete_ranges, [(str_id(2), str_id(4)), (str_id(11), str_id(12))])
+        self.assertEqual(self.dump_and_load(change_plan), change_plan)
+
+
+@patch('tubular.splitmongo.time.sleep')
+class TestAdaptiveThrottle(unittest.TestCase):
+    """
+    Feedback control of batch sizes and delays while pruning.
+    """
+    def test_batches_follow_batch_size(self, _sleep):
+        throttle = Throttle(0, 2)
+        batch_sizes = []
+        for batch in throttle.batches(range(10)):
+            batch_sizes.append(len(batch))
+            throttle.batch_size += 1
+        self.assertEqual(batch_sizes, [2, 3, 4, 1])
+
+    def test_rate(self, sleep):
+        throttle = Throttle(0.5, 100)
+        throttle.record(100, 0.5)
+        throttle.wait()
+        sleep.assert_called_once_with(0.5)
+        self.assertEqual(throttle.rate, 100.0)
+
+    def test_latency_feedback(self, _sleep):
+        throttle = AdaptiveThrottle(1.0, 100, target_latency=0.5, min_batch_size=30, max_batch_size=150, max_delay=3)
+        throttle.record(100, 0.1)
+        self.assertEqual(throttle.batch_size, 125)
+        self.assertAlmostEqual(throttle.delay, 0.8)
+        throttle.record(125, 0.1)
+        self.assertEqual(throttle.batch_size, 150)
+
+        # Slow batches back off quickly, within the limits.
+        throttle.record(150, 1.0)
+        self.assertEqual(throttle.batch_size, 75)
+        self.assertAlmostEqual(throttle.delay, 1.28)
+        throttle.record(75, 1.0)
+        throttle.record(37, 1.0)
+        self.assertEqual((throttle.batch_size, throttle.delay), (30, 3))
+
+    def test_probe_feedback(self, _sleep):
+        probe_results = [(20.0, None), (None, 0.01), (1.0, 0.9)]
+        throttle = AdaptiveThrottle(
+            1.0, 100, target_latency=0.5, max_lag=10, probe=lambda: probe_results.pop(0), probe_interval=0
+        )
+        throttle.record(100, 0.1)  # Replication lag is over budget
+        self.assertEqual(throttle.batch_size, 50)
+        throttle.record(50, 0.1)  # No replication lag reported, fast writes
+        self.assertEqual(throttle.batch_size, 62)
+        throttle.record(62, 0.1)  # Server reports slow writes
+        self.assertEqual(throttle.batch_size, 31)
+
+    def test_probe_interval(self, _sleep):
+        probe = Mock(return_value=(None, None))
+        throttle = AdaptiveThrottle(1.0, 100, target_latency=0.5, probe=probe, probe_interval=60)
+        throttle.record(100, 0.1)
+        throttle.record(100, 0.1)
+        self.assertEqual(probe.call_count, 1)
+
+
+class TestPruneJournal(unittest.TestCase):
+    """
+    Recording and skipping finished delete batches.
+    """
+    def setUp(self):
+        super().setUp()
+        temp_dir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(temp_dir.cleanup)
+        self.journal_path = os.path.join(temp_dir.name, 'prune.journal')
+        self.structure_ids = [str_id(i) for i in range(1, 11)]
+
+    def test_skip_finished(self):
+        with PruneJournal(self.journal_path, self.structure_ids) as journal:
+            self.assertEqual(list(journal.skip_finished(self.structure_ids)), self.structure_ids)
+            journal.record(str_id(7), str_id(8))
+            journal.record(str_id(2), str_id(4))
+
+        # A line we were in the middle of writing when interrupted is ignored.
+        with open(self.journal_path, 'a') as journal_file:
+            journal_file.write(str_id(9))
+        with PruneJournal(self.journal_path, self.structure_ids) as journal:
+            self.assertEqual(
+                list(journal.skip_finished(self.structure_ids)),
+                [str_id(i) for i in [1, 5, 6, 9, 10]]
+            )
+            journal.record(str_id(1), str_id(6))
+        with PruneJournal(self.journal_path, self.structure_ids) as journal:
+            self.assertEqual(list(journal.skip_finished(self.structure_ids)), [str_id(9), str_id(10)])
+
+    def test_different_plan(self):
+        PruneJournal(self.journal_path, self.structure_ids).close()
+        with self.assertRaises(ValueError):
+            PruneJournal(self.journal_path, self.structure_ids[1:])
+
+    @patch('tubular.splitmongo.time.sleep')
+    def test_concurrent_delete(self, _sleep):
+        """Batches finish out of order, and only unfinished ones are deleted."""
+        backend = SplitMongoBackend('mongodb://localhost', 'test')
+        backend._structures = Mock()  # pylint: disable=protected-access
+        backend._structures.delete_many.side_effect = (  # pylint: disable=protected-access
+            lambda query: Mock(deleted_count=len(query['_id']['$in']))
+        )
+        with PruneJournal(self.journal_path, self.structure_ids) as journal:
+            journal.record(str_id(1), str_id(3))
+        with PruneJournal(self.journal_path, self.structure_ids) as journal:
+            backend._delete(  # pylint: disable=protected-access
+                self.structure_ids, Throttle(0, 2), journal=journal, concurrency=3
+            )
+
+        deleted_ids = sorted(
+            str(object_id)
+            for call in backend._structures.delete_many.call_args_list  # pylint: disable=protected-access
+            for object_id in call[0][0]['_id']['$in']
+        )
+        self.assertEqual(deleted_ids, self.structure_ids[3:])
+        with PruneJournal(self.journal_path, self.structure_ids) as journal:
+            self.assertEqual(list(journal.skip_finished(self.structure_ids)), [])
+
+
 class TestSplitMongoBackendHelpers(unittest.TestCase):
     """
     Test the static helper methods of SplitMongoBackend.
@@ -241,6 +966,38 @@ class TestSplitMongoBackendHelpers(unittest.TestCase):
         )
         self.assertFalse(other_structure.is_original())
 
+    def test_point_in_time_reads(self):
+        """Point in time scans read in a snapshot session, without extra fetches."""
+        backend = SplitMongoBackend('mongodb://localhost', 'test')
+        # pylint: disable=protected-access
+        backend._db = MagicMock()
+        session = backend._db.start_session.return_value.__enter__.return_value
+        primary_structures = backend._structures = Mock()
+        structures = backend._structures.with_options.return_value
+        structures.find.return_value = MagicMock()
+        structures.find.return_value.__iter__.return_value = iter([
+            {'_id': obj_id(1), 'original_version': obj_id(1), 'previous_version': None},
+        ])
+        active_versions = backend._active_versions = Mock()
+        active_versions.with_options.return_value.find.return_value = [{
+            '_id': obj_id(100),
+            'edited_on': datetime(2012, 5, 2),
+            'org': 'edx',
+            'course': 'split_library',
+            'versions': {'library': obj_id(1)},
+        }]
+
+        with patch.object(backend, '_fetch_chains') as fetch_chains:
+            graph = backend.structures_graph(0, 100, point_in_time=True)
+        fetch_chains.assert_not_called()
+        self.assertEqual(list(graph.structures.keys()), [str_id(1)])
+        backend._db.start_session.assert_called_once_with(snapshot=True)
+        primary_structures.with_options.assert_called_once_with(read_preference=ReadPreference.SECONDARY_PREFERRED)
+        self.assertEqual(structures.find.call_args[1]['session'], session)
+        self.assertEqual(active_versions.with_options.return_value.find.call_args[1]['session'], session)
+        self.assertIs(backend._structures, primary_structures)
+        self.assertIsNone(backend._session)
+
     def test_batch(self):
         """Test the batch helper that breaks up iterables for DB operations."""
         self.assertEqual(
@@ -260,6 +1017,57 @@ class TestSplitMongoBackendHelpers(unittest.TestCase):
             [[1, 2], [3, 4]]
         )
 
+    def test_id_range_query(self):
+        """Test the queries used for partitioned scans."""
+        self.assertEqual(SplitMongoBackend._id_range_query(), {})  # pylint: disable=protected-access
+        self.assertEqual(
+            SplitMongoBackend._id_range_query(obj_id(1), None),  # pylint: disable=protected-access
+            {'_id': {'$gte': obj_id(1)}}
+        )
+        self.assertEqual(
+            SplitMongoBackend._id_range_query(obj_id(1), obj_id(5)),  # pylint: disable=protected-access
+            {'_id': {'$gte': obj_id(1), '$lt': obj_id(5)}}
+        )
+
+    def test_delete_query(self):
+        """Runs inside delete ranges use range queries, everything else $in."""
+        delete_ranges = [(str_id(2), str_id(4)), (str_id(5), str_id(9)), (str_id(12), str_id(13))]
+        range_firsts = [first_id for first_id, _ in delete_ranges]
+
+        def delete_query(structure_ids_batch, delete_ranges):
+            return SplitMongoBackend._delete_query(  # pylint: disable=protected-access
+                structure_ids_batch, delete_ranges, range_firsts
+            )
+
+        self.assertEqual(
+            delete_query([str_id(i) for i in [1, 3, 4, 5, 6, 7, 11]], delete_ranges),
+            {
+                '$or': [
+                    {'_id': {'$gte': obj_id(3), '$lte': obj_id(4)}},
+                    {'_id': {'$gte': obj_id(5), '$lte': obj_id(7)}},
+                    {'_id': {'$in': [obj_id(1), obj_id(11)]}},
+                ]
+            }
+        )
+        self.assertEqual(
+            delete_query([str_id(i) for i in [6, 7, 8]], delete_ranges),
+            {'_id': {'$gte': obj_id(6), '$lte': obj_id(8)}}
+        )
+        self.assertEqual(
+            delete_query([str_id(i) for i in [1, 4, 5]], delete_ranges),
+            {'_id': {'$in': [obj_id(1), obj_id(4), obj_id(5)]}}
+        )
+        self.assertEqual(
+            delete_query([str_id(i) for i in [8, 9, 10, 12, 13]], delete_ranges),
+            {
+                '$or': [
+                    {'_id': {'$gte': obj_id(8), '$lte': obj_id(9)}},
+                    {'_id': {'$gte': obj_id(12), '$lte': obj_id(13)}},
+                    {'_id': {'$in': [obj_id(10)]}},
+                ]
+            }
+        )
+
     def test_iter_from_start(self):
         """Test what we use to resume deletion from a given Structure ID."""
         all_ids = [1, 2, 3]
@@ -285,6 +1093,193 @@ class TestSplitMongoBackendHelpers(unittest.TestCase):
         )
 
 
+class TestBinaryIdSet(unittest.TestCase):
+    """
+    The compact set of referenced Definition IDs.
+    """
+    @patch.object(_BinaryIdSet, 'MERGE_THRESHOLD', 3)
+    def test_add_and_merge(self):
+        id_set = _BinaryIdSet()
+        binary_ids = [obj_id(i).binary for i in [9, 2, 7, 2, 1, 8, 5, 9, 3]]
+        for binary_id in binary_ids:
+            id_set.add(binary_id)
+        self.assertEqual(len(id_set), 7)
+        for i in range(11):
+            self.assertEqual(obj_id(i).binary in id_set, obj_id(i).binary in binary_ids)
+
+
+@ddt.ddt
+class TestMongoDumpBackend(unittest.TestCase):
+    """
+    Reading Structures and Active Versions from mongodump files.
+    """
+    def setUp(self):
+        super().setUp()
+        temp_dir = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(temp_dir.cleanup)
+        self.dump_dir = temp_dir.name
+        # Active Versions were last edited in 2015. Structure 5 was made after
+        # that, but isn't Active, so we leave it out.
+        recent_id = ObjectId.from_datetime(datetime(2016, 1, 1))
+        self.recent_id = str(recent_id)
+        self.structure_docs = [
+            dict(_id=obj_id(1), root=['course', 'course'], previous_version=None, original_version=obj_id(1),
+                 blocks=[{'block_id': 'course', 'fields': {'display_name': 'Course'}}]),
+            dict(_id=obj_id(2), previous_version=obj_id(1), original_version=obj_id(1), schema_version=1),
+            dict(_id=obj_id(3), previous_version=obj_id(2), original_version=obj_id(1)),
+            dict(_id=obj_id(10), original_version=obj_id(10), previous_version=None),
+            dict(_id=recent_id, original_version=obj_id(1), previous_version=obj_id(3)),
+        ]
+        self.active_versions_docs = [
+            {
+                '_id': obj_id(100),
+                'edited_on': datetime(2015, 5, 2),
+                'org': 'edx',
+                'course': 'split_course',
+                'run': '2017',
+                'versions': {'draft-branch': obj_id(3), 'published-branch': obj_id(2)},
+            },
+            {
+                '_id': obj_id(101),
+                'edited_on': datetime(2015, 5, 3),
+                'org': 'edx',
+                'course': 'split_library',
+                'run': 'library',
+                'versions': {'library': obj_id(10)},
+            },
+        ]
+
+    def write_bson(self, file_name, docs, gzipped=False):
+        """Write `docs` to a .bson file in our dump directory, like mongodump does."""
+        os.makedirs(os.path.join(self.dump_dir, 'edxapp'), exist_ok=True)
+        opener = gzip.open if gzipped else open
+        with opener(os.path.join(self.dump_dir, 'edxapp', file_name), 'wb') as bson_file:
+            for doc in docs:
+                bson_file.write(BSON.encode(doc))
+
+    def write_archive(self, segments):
+        """Write a mongodump archive of (db, collection, docs) segments, and return its path."""
+        terminator = struct.pack('<i', -1)
+        archive_path = os.path.join(self.dump_dir, 'edxapp.archive')
+        with open(archive_path, 'wb') as archive_file:
+            archive_file.write(ARCHIVE_MAGIC)
+            archive_file.write(BSON.encode({'concurrent_collections': 4, 'version': '0.1'}))
+            archive_file.write(BSON.encode({'db': 'edxapp', 'collection': 'modulestore.structures'}))
+            archive_file.write(terminator)
+            for db_name, collection, docs in segments:
+                archive_file.write(BSON.encode({'db': db_name, 'collection': collection, 'EOF': False}))
+                for doc in docs:
+                    archive_file.write(BSON.encode(doc))
+                archive_file.write(terminator)
+        return archive_path
+
+    def test_dump_directory(self):
+        self.write_bson('modulestore.active_versions.bson', self.active_versions_docs)
+        self.write_bson('modulestore.structures.bson.gz', reversed(self.structure_docs), gzipped=True)
+        graph = MongoDumpBackend(self.dump_dir, 'edxapp').structures_graph(0, 100)
+        self.assertEqual(
+            [(branch.branch, branch.structure_id) for branch in graph.branches],
+            [('draft-branch', str_id(3)), ('published-branch', str_id(2)), ('library', str_id(10))]
+        )
+        self.assertEqual(
+            graph.structures,
+            {
+                str_id(1): Structure(str_id(1), str_id(1), None),
+                str_id(2): Structure(str_id(2), str_id(1), str_id(1)),
+                str_id(3): Structure(str_id(3), str_id(1), str_id(2)),
+                str_id(10): Structure(str_id(10), str_id(10), None),
+            }
+        )
+
+    def test_archive(self):
+        # Segments of a collection are interleaved with other collections, and
+        # Structure 4 is in another database.
+        self.active_versions_docs[0]['versions']['draft-branch'] = ObjectId(self.recent_id)
+        archive_path = self.write_archive([
+            ('edxapp', 'modulestore.structures', self.structure_docs[:2]),
+            ('edxapp', 'modulestore.definitions', [{'_id': obj_id(200), 'fields': {}}]),
+            ('other', 'modulestore.structures', [dict(_id=obj_id(4), original_version=obj_id(4))]),
+            ('edxapp', 'modulestore.active_versions', self.active_versions_docs),
+            ('edxapp', 'modulestore.structures', self.structure_docs[2:]),
+            ('edxapp', 'modulestore.structures', []),
+        ])
+        graph = MongoDumpBackend(archive_path, 'edxapp').structures_graph(0, 100, compact=True)
+        self.assertIsInstance(graph, CompactStructuresGraph)
+        self.assertEqual(
+            list(graph.structures.keys()),
+            [str_id(1), str_id(2), str_id(3), str_id(10), self.recent_id]
+        )
+
+    @ddt.data(False, True)
+    def test_delete_ranges_stop_before_recent(self, compact):
+        # Structures 2, 3 and the first and third recent ones are deleted, but
+        # the second recent one was left out, so there mustn't be a delete
+        # range from the first recent one to the third.
+        recent_ids = [ObjectId.from_datetime(datetime(2016, 1, day)) for day in range(1, 5)]
+        self.structure_docs[4:] = [
+            dict(_id=recent_ids[0], original_version=obj_id(1), previous_version=obj_id(3)),
+            dict(_id=recent_ids[1], original_version=obj_id(1), previous_version=recent_ids[0]),
+            dict(_id=recent_ids[2], original_version=obj_id(1), previous_version=recent_ids[0]),
+            dict(_id=recent_ids[3], original_version=obj_id(1), previous_version=recent_ids[2]),
+        ]
+        self.active_versions_docs[0]['versions'] = {'draft-branch': recent_ids[3], 'published-branch': recent_ids[3]}
+        self.write_bson('modulestore.active_versions.bson', self.active_versions_docs)
+        self.write_bson('modulestore.structures.bson', self.structure_docs)
+        backend = MongoDumpBackend(self.dump_dir, 'edxapp')
+        graph = backend.structures_graph(0, 100, compact=compact)
+
+        self.assertEqual(backend.complete_before, str(ObjectId.from_datetime(datetime(2015, 5, 2, 23))))
+        plan = ChangePlan.create(graph, 0, ranges_before=backend.complete_before)
+        self.assertEqual(plan.delete, [str_id(2), str_id(3), str(recent_ids[0]), str(recent_ids[2])])
+        self.assertEqual(plan.delete_ranges, [(str_id(2), str_id(3))])
+        self.assertEqual(
+            ChangePlan.create(graph, 0).delete_ranges,
+            [(str_id(2), str_id(3)), (str(recent_ids[0]), str(recent_ids[2]))]
+        )
+
+    def test_missing_active_structure(self):
+        self.write_bson('modulestore.active_versions.bson', self.active_versions_docs)
+        del self.structure_docs[3]
+        self.write_bson('modulestore.structures.bson', self.structure_docs)
+        with self.assertRaisesRegex(ValueError, str_id(10)):
+            MongoDumpBackend(self.dump_dir, 'edxapp').structures_graph(0, 100)
+
+    @ddt.data(
+        ('structures', b'\x30\x00\x00', 'Truncated or corrupt BSON'),
+        ('structures', BSON.encode({'_id': ObjectId(), 'previous_version': None}), 'has no original_version'),
+        ('structures', struct.pack('<i', 10) + b'\x02s\x00\x01\x00\x00', 'Corrupt BSON'),
+        ('active_versions', BSON.encode({'_id': ObjectId(), 'org': 'edx'}), 'Malformed Active Version'),
+    )
+    @ddt.unpack
+    def test_malformed_dump(self, collection, raw_doc, message):
+        self.write_bson('modulestore.active_versions.bson', self.active_versions_docs)
+        self.write_bson('modulestore.structures.bson', self.structure_docs)
+        with open(os.path.join(self.dump_dir, 'edxapp', 'modulestore.{}.bson'.format(collection)), 'ab') as bson_file:
+            bson_file.write(raw_doc)
+        with self.assertRaisesRegex(ValueError, message):
+            MongoDumpBackend(self.dump_dir, 'edxapp').structures_graph(0, 100)
+
+    def test_structure_sizes(self):
+        self.write_bson('modulestore.active_versions.bson', self.active_versions_docs)
+        self.write_bson('modulestore.structures.bson', self.structure_docs)
+        sizes = MongoDumpBackend(self.dump_dir, 'edxapp').structure_sizes([str_id(10), str_id(5), str_id(1)], 0, 100)
+        self.assertEqual(
+            sizes,
+            [len(BSON.encode(self.structure_docs[3])), 0, len(BSON.encode(self.structure_docs[0]))]
+        )
+
+    def test_bson_id_fields(self):
+        raw_doc = BSON.encode({
+            'name': 'x', 'count': 2, 'big': 2 ** 40, 'ratio': 0.5, 'flag': True, 'nested': {'_id': obj_id(9)},
+            'items': [1, 2], 'data': b'\x00\x01', 'pattern': re.compile('a.*b'), 'nothing': None,
+            'when': datetime(2020, 1, 1), 'target': obj_id(7), 'after': obj_id(8),
+        })
+        self.assertEqual(
+            _bson_id_fields(raw_doc, (b'nothing', b'target', b'missing')),
+            {b'nothing': None, b'target': obj_id(7).binary}
+        )
+
+
 @unittest.skip("Requires local MongoDB instance (run manually).")
 class TestSplitMongoBackend(unittest.TestCase):
     """
@@ -318,10 +1313,12 @@ class TestSplitMongoBackend(unittest.TestCase):
         # Remove anything that might have been there from a previous test.
         database.drop_collection('modulestore.active_versions')
         database.drop_collection('modulestore.structures')
+        database.drop_collection('modulestore.definitions')
 
         # Convenince pointers to our collections.
         self.active_versions = database['modulestore.active_versions']
         self.structures = database['modulestore.structures']
+        self.definitions = database['modulestore.definitions']
 
         # The backend we should use in our tests for querying.
         self.backend = SplitMongoBackend(self.CONNECT_STR, self.DATABASE_NAME)
@@ -403,15 +1400,104 @@ class TestSplitMongoBackend(unittest.TestCase):
             [str_id(i) for i in [1, 2, 3, 4, 10, 11, 20]]
         )
 
+    def test_scoped_structures_graph(self):
+        """Scoped graphs only fetch the history of the branches they need."""
+        graph = self.backend.scoped_structures_graph(0, 2, keys=[LibraryLocator('edx', 'split_library')])
+        self.assertEqual([branch.key for branch in graph.branches], [LibraryLocator('edx', 'split_library')])
+        self.assertEqual(list(graph.structures), [str_id(20)])
+
+        # A rerun in another org shares history with the draft branch of
+        # split_course, so that branch has to be in the graph too.
+        self.active_versions.insert_one({
+            '_id': obj_id(102),
+            'edited_on': datetime(2012, 5, 4),
+            'org': 'other',
+            'course': 'split_course',
+            'run': 'rerun',
+            'versions': {'draft-branch': obj_id(3)},
+        })
+        graph = self.backend.scoped_structures_graph(0, 2, orgs=['other'])
+        self.assertEqual(
+            sorted((branch.key, branch.branch) for branch in graph.branches),
+            [
+                (CourseLocator('edx', 'split_course', '2017'), 'draft-branch'),
+                (CourseLocator('other', 'split_course', 'rerun'), 'draft-branch'),
+            ]
+        )
+        self.assertEqual(sorted(graph.structures), [str_id(i) for i in [1, 2, 3, 4]])
+
+        change_plan = ChangePlan.create(graph, 0, with_ranges=False)
+        self.assertEqual(change_plan.delete, [str_id(2)])
+        self.assertEqual(change_plan.delete_ranges, [])
+
+    def test_structure_sizes(self):
+        """Sizes come from the documents in the database."""
+        sizes = self.backend.structure_sizes([str_id(1), str_id(5), str_id(11)], 0, 2)
+        self.assertEqual(sizes[1], 0)
+        self.assertEqual(sizes[0], len(BSON.encode(self.structures.find_one({'_id': obj_id(1)}))))
+        self.assertEqual(sizes[2], len(BSON.encode(self.structures.find_one({'_id': obj_id(11)}))))
+
+    def test_record_ids(self):
+        """Record IDs follow the order the Structures were inserted in."""
+        record_ids = self.backend.record_ids([str_id(1), str_id(5), str_id(11), str_id(2)], 0, 2)
+        self.assertEqual(record_ids[1], 0)
+        self.assertLess(record_ids[0], record_ids[3])
+        self.assertLess(record_ids[3], record_ids[2])
+
+    def test_record_order_update(self):
+        """Deleting in record order deletes the same Structures."""
+        change_plan = ChangePlan(
+            delete=[str_id(i) for i in [2, 3]],
+            update_parents=[(str_id(4), str_id(1))]
+        )
+        change_plan = change_plan._replace(
+            delete_record_ids=array('q', self.backend.record_ids(change_plan.delete, 0, 100))
+        )
+        self.backend.update(change_plan, delay=0, record_order=True)
+        graph = self.backend.structures_graph(0, 100)
+        self.assertEqual(
+            list(graph.structures.keys()),
+            [str_id(i) for i in [1, 4, 10, 11, 20]]
+        )
+
+    def test_partitioned_structures_graph(self):
+        """Partitioned scans (in either graph format) find the same Structures."""
+        graph = self.backend.structures_graph(0, 100)
+        for compact in [False, True]:
+            partitioned_graph = self.backend.structures_graph(0, 2, compact, partitions=3, workers=2)
+            self.assertEqual(partitioned_graph.branches, graph.branches)
+            self.assertEqual(dict(partitioned_graph.structures), graph.structures)
+
+    def test_snapshot(self):
+        """Repeated scans with a snapshot only add what's changed."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            snapshot = StructuresSnapshot(os.path.join(temp_dir, 'structures.snapshot'))
+            graph = self.backend.structures_graph(0, 2, snapshot=snapshot)
+            self.assertEqual(dict(graph.structures), self.backend.structures_graph(0, 100).structures)
+
+            # Prune, add a new Structure, and add an older Structure that the
+            # snapshot has never seen.
+            self.backend.update(
+                ChangePlan(delete=[str_id(2), str_id(3)], update_parents=[(str_id(4), str_id(1))]), delay=0
+            )
+            self.structures.insert_many([
+                dict(_id=obj_id(21), original_version=obj_id(20), previous_version=obj_id(20)),
+                dict(_id=obj_id(5), original_version=obj_id(5), previous_version=None),
+            ])
+
+            graph = self.backend.structures_graph(0, 2, snapshot=snapshot)
+            self.assertEqual(dict(graph.structures), self.backend.structures_graph(0, 100).structures)
+
     def test_update(self):
         """Execute a simple update."""
-        self.backend.update(
+        num_deleted = self.backend.update(
             ChangePlan(
                 delete=[str_id(i) for i in [2, 3]],
                 update_parents=[(str_id(4), str_id(1))]
             ),
             delay=0
         )
+        self.assertEqual(num_deleted, 2)
         graph = self.backend.structures_graph(0, 100)
         self.assertEqual(
             list(graph.structures.keys()),
@@ -429,14 +1515,88 @@ class TestSplitMongoBackend(unittest.TestCase):
             }
         )
 
+    def test_adaptive_update(self):
+        """An adaptive throttle probing the real server does the same update."""
+        throttle = AdaptiveThrottle(0, 1, target_latency=1.0, max_lag=10, probe=self.backend.server_metrics)
+        self.backend.update(
+            ChangePlan(
+                delete=[str_id(i) for i in [2, 3]],
+                update_parents=[(str_id(4), str_id(1))]
+            ),
+            throttle=throttle
+        )
+        graph = self.backend.structures_graph(0, 100)
+        self.assertEqual(
+            list(graph.structures.keys()),
+            [str_id(i) for i in [1, 4, 10, 11, 20]]
+        )
+        self.assertEqual(throttle.num_items, 3)
+
+    def test_journaled_update(self):
+        """Concurrent, journaled deletion only deletes what's left."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            change_plan = ChangePlan(
+                delete=[str_id(i) for i in [2, 3, 11]],
+                update_parents=[(str_id(4), str_id(1))]
+            )
+            journal_path = os.path.join(temp_dir, 'prune.journal')
+            with PruneJournal(journal_path, change_plan.delete) as journal:
+                journal.record(str_id(11), str_id(11))
+            with PruneJournal(journal_path, change_plan.delete) as journal:
+                self.backend.update(change_plan, delay=0, batch_size=1, journal=journal, concurrency=2)
+        graph = self.backend.structures_graph(0, 100)
+        self.assertEqual(
+            list(graph.structures.keys()),
+            [str_id(i) for i in [1, 4, 10, 11, 20]]
+        )
+
+    def test_range_update(self):
+        """Delete ranges only remove the Structures in the plan."""
+        self.backend.update(
+            ChangePlan(
+                delete=[str_id(i) for i in [2, 3]],
+                update_parents=[(str_id(4), str_id(1))],
+                delete_ranges=[(str_id(2), str_id(3))],
+            ),
+            delay=0
+        )
+        graph = self.backend.structures_graph(0, 100)
+        self.assertEqual(
+            list(graph.structures.keys()),
+            [str_id(i) for i in [1, 4, 10, 11, 20]]
+        )
+
+    @patch('tubular.splitmongo.time.sleep')
+    def test_prune_definitions(self, _sleep):
+        """Only old Definitions that no Structure refers to are deleted."""
+        old_ids = [ObjectId.from_datetime(datetime(2015, 1, 1, second=i)) for i in range(4)]
+        new_id = ObjectId()
+        self.definitions.insert_many([{'_id': def_id} for def_id in old_ids + [new_id]])
+        self.structures.update_one(
+            {'_id': obj_id(4)},
+            {'$set': {'blocks': [{'block_id': 'course', 'definition': old_ids[1]}, {'block_id': 'about'}]}}
+        )
+        self.structures.update_one(
+            {'_id': obj_id(20)},
+            {'$set': {'blocks': [{'block_id': 'library', 'definition': old_ids[3]}]}}
+        )
+
+        self.assertEqual(self.backend.prune_definitions(0, 2, Throttle(0, 1), dry_run=True), 2)
+        self.assertEqual(self.definitions.count_documents({}), 5)
+        self.assertEqual(self.backend.prune_definitions(0, 2, Throttle(0, 1)), 2)
+        self.assertEqual(
+            sorted(doc['_id'] for doc in self.definitions.find()),
+            [old_ids[1], old_ids[3], new_id]
+        )
+
     def test_race_condition(self):
         """Create new Structures are during ChangePlan creation."""
         # Get the real method before we patch it...
         real_all_structures_fn = SplitMongoBackend._all_structures  # pylint: disable=protected-access
 
-        def add_structures(backend, delay, batch_size):
+        def add_structures(backend, delay, batch_size, *args):
             """Do what _all_structures() would do, then add new Structures."""
-            structures = real_all_structures_fn(backend, delay, batch_size)
+            structures = real_all_structures_fn(backend, delay, batch_size, *args)
 
             # Create new Structures
             self.structures.insert_one(
@@ -475,7 +1635,14 @@ class TestSplitMongoBackend(unittest.TestCase):
 
         with patch.object(SplitMongoBackend, '_all_structures', autospec=True) as all_structures_mock:
             all_structures_mock.side_effect = add_structures
-            graph = self.backend.structures_graph(0, 100)
+            with self.assertLogs('structures', level='INFO') as logs:
+                graph = self.backend.structures_graph(0, 100)
+            # Missing Structures are fetched a generation at a time: 5 and 7,
+            # then 6.
+            self.assertIn(
+                "INFO:structures:Fetched 3 Structures in 2 queries (1 fewer round trips than one query per Structure)",
+                logs.output
+            )
             self.assertEqual(len(graph.structures), 10)
             self.assertEqual(len(graph.branches), 4)
 
@@ -0,0 +1,117 @@
+"""
+Test the synthetic Split Modulestore generator and benchmarks.
+"""
+from collections import Counter
+from datetime import datetime, timezone
+import unittest
+
+from tubular.splitmongo import ChangePlan, IntegrityReport, KeepPolicy
+from tubular.splitmongo_synthetic import InMemoryBackend, SyntheticModulestore, delete_throughputs, run_benchmarks
+
+
+class TestSyntheticModulestore(unittest.TestCase):
+    """
+    The generated Structures should look like a real modulestore's.
+    """
+    def test_structures(self):
+        structures = list(SyntheticModulestore(5000, seed=3).structures())
+        self.assertEqual(len(structures), 5000)
+        structure_ids = [structure.id for structure in structures]
+        self.assertEqual(structure_ids, sorted(set(structure_ids)))
+
+        # Everything links back to earlier Structures.
+        for structure in structures:
+            self.assertLessEqual(structure.original_id, structure.id)
+            if structure.previous_id is not None:
+                self.assertLess(structure.previous_id, structure.id)
+
+        # The same seed gives the same data.
+        self.assertEqual(list(SyntheticModulestore(5000, seed=3).structures()), structures)
+        self.assertNotEqual(list(SyntheticModulestore(5000, seed=4).structures()), structures)
+
+    def test_branches(self):
+        modulestore = SyntheticModulestore(20000, rerun_fraction=0.5, orphan_fraction=0.1)
+        with self.assertRaises(ValueError):
+            modulestore.branches()
+        structures = {structure.id: structure for structure in modulestore.structures()}
+        branches = modulestore.branches()
+
+        branch_counts = Counter(branch.branch for branch in branches)
+        self.assertEqual(branch_counts['draft-branch'], branch_counts['published-branch'])
+        self.assertGreater(branch_counts['library'], 0)
+
+        # Draft and published branches share an Original, and reruns share
+        # one with another course.
+        originals = {}
+        for branch in branches:
+            self.assertIn(branch.structure_id, structures)
+            originals.setdefault(structures[branch.structure_id].original_id, set()).add(branch.key)
+        self.assertTrue(any(len(keys) > 1 for keys in originals.values()))
+
+        # Deleted courses leave unreachable Structures.
+        report = IntegrityReport.create(InMemoryBackend.from_modulestore(modulestore).structures_graph(0, 1000))
+        self.assertTrue(report.is_consistent())
+        self.assertGreater(len(report.unreachable), 0)
+
+
+class TestInMemoryBackend(unittest.TestCase):
+    """
+    InMemoryBackend should behave like SplitMongoBackend.
+    """
+    def test_update(self):
+        backend = InMemoryBackend.from_modulestore(SyntheticModulestore(10000, seed=1))
+        graph = backend.structures_graph(0, 1000, compact=True)
+        self.assertEqual(backend.round_trips, 11)
+        plan = ChangePlan.create(graph, 2)
+        self.assertEqual(backend.update(plan, batch_size=1000), len(plan.delete))
+
+        pruned_graph = backend.structures_graph(0, 1000)
+        self.assertEqual(len(pruned_graph.structures), len(graph) - len(plan.delete))
+        report = IntegrityReport.create(pruned_graph)
+        self.assertTrue(report.is_consistent())
+        self.assertEqual(len(report.unreachable), 0)
+        self.assertEqual(ChangePlan.create(pruned_graph, 2).delete, [])
+
+    def test_keep_policy(self):
+        """Time based retention keeps more history, all of it still linked up."""
+        now = datetime(2024, 1, 1, tzinfo=timezone.utc).timestamp()
+        backend = InMemoryBackend.from_modulestore(SyntheticModulestore(10000, seed=2))
+        graph = backend.structures_graph(0, 1000, compact=True)
+        count_plan = ChangePlan.create(graph, 2)
+        plan = ChangePlan.create(graph, 2, keep_policy=KeepPolicy(90, 2, now=now))
+        self.assertLess(len(plan.delete), len(count_plan.delete))
+        self.assertLessEqual(set(plan.delete), set(count_plan.delete))
+        backend.update(plan, batch_size=1000)
+
+        report = IntegrityReport.create(backend.structures_graph(0, 1000))
+        self.assertTrue(report.is_consistent())
+        self.assertEqual(len(report.unreachable), 0)
+
+    def test_run_benchmarks(self):
+        backend = InMemoryBackend.from_modulestore(SyntheticModulestore(2000))
+        results = run_benchmarks(backend, lambda: backend.round_trips, batch_size=500)
+        self.assertEqual(
+            [result.step for result in results],
+            [
+                'structures_graph', 'ChangePlan.create', 'ChangePlan.dump', 'ChangePlan.load',
+                'ChangePlan.dump_binary', 'ChangePlan.load_file (binary)', 'update',
+            ]
+        )
+        self.assertEqual(results[0].round_trips, 5)
+        self.assertGreater(results[-1].round_trips, 0)
+        self.assertTrue(all(result.peak_rss > 0 for result in results))
+
+    def test_locality_order(self):
+        """The locality order looks up record IDs, and deletes the same Structures."""
+        results = {}
+        for order in ['id', 'locality']:
+            backend = InMemoryBackend.from_modulestore(SyntheticModulestore(2000))
+            results[order] = run_benchmarks(
+                backend, lambda backend=backend: backend.round_trips, batch_size=500, order=order
+            )
+            self.assertEqual(len(backend.structures_graph(0, 500).structures), 2000 - results[order][-1].items)
+        self.assertGreater(results['locality'][1].round_trips, results['id'][1].round_trips)
+        self.assertEqual(results['locality'][-1].items, results['id'][-1].items)
+        self.assertEqual(set(delete_throughputs(results)), {'id', 'locality'})
+        with self.assertRaises(ValueError):
+            run_benchmarks(backend, lambda: backend.round_trips, order='random')
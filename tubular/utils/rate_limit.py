@@ -0,0 +1,124 @@
+"""
+Code used to limit how hard we call a service, shared between threads.
+"""
+
+
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+# Settings that can be given for each service, e.g. in the retirement config's
+# service_limits.
+LIMIT_SETTINGS = ('requests_per_second', 'max_in_flight')
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket that allows `rate` calls per second on average,
+    and bursts of up to `burst` calls.
+
+    A caller that has to wait reserves its token before sleeping, so waiting
+    callers are let through in the order they arrived, each 1 / `rate`
+    seconds after the last.
+    """
+    def __init__(self, rate, burst=None, clock=time.monotonic, sleep=time.sleep):
+        if rate <= 0:
+            raise ValueError("rate must be greater than 0. Value: {}".format(rate))
+        self.rate = rate
+        self.burst = max(burst or rate, 1)
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = self.burst
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token, sleeping until one is available. Returns the number of
+        seconds slept.
+        """
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait:
+            self._sleep(wait)
+        return wait
+
+
+class ServiceLimiter:
+    """
+    Limits calls to one service to `requests_per_second` (a TokenBucket) and
+    to `max_in_flight` at once. Either can be None for no limit.
+    """
+    def __init__(self, requests_per_second=None, max_in_flight=None):
+        for name, value in (('requests_per_second', requests_per_second), ('max_in_flight', max_in_flight)):
+            if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0):
+                raise ValueError("{} must be a number greater than 0. Value: {}".format(name, value))
+        if max_in_flight is not None and max_in_flight != int(max_in_flight):
+            raise ValueError("max_in_flight must be a whole number. Value: {}".format(max_in_flight))
+
+        self.requests_per_second = requests_per_second
+        self.max_in_flight = max_in_flight
+        self._bucket = TokenBucket(requests_per_second) if requests_per_second else None
+        self._slots = threading.BoundedSemaphore(int(max_in_flight)) if max_in_flight else None
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        Create a ServiceLimiter from a dict of LIMIT_SETTINGS, e.g. one entry
+        of the retirement config's service_limits.
+        """
+        if not isinstance(settings, dict):
+            raise ValueError("Limits must be a mapping of {}. Value: {}".format(', '.join(LIMIT_SETTINGS), settings))
+        unknown = set(settings) - set(LIMIT_SETTINGS)
+        if unknown:
+            raise ValueError("Unknown limits {}, expected {}".format(
+                ', '.join(sorted(unknown)), ', '.join(LIMIT_SETTINGS)
+            ))
+        return cls(**settings)
+
+    @contextmanager
+    def limit(self):
+        """
+        Wait for a free slot and then a token, and hold the slot until the
+        block is done. The slot is taken first so that callers queued for a
+        slot don't use up tokens while they wait.
+        """
+        if self._slots is not None:
+            self._slots.acquire()
+        try:
+            if self._bucket is not None:
+                self._bucket.acquire()
+            yield
+        finally:
+            if self._slots is not None:
+                self._slots.release()
+
+
+class RateLimitedClient:
+    """
+    Wraps an API client so that every call to one of its public methods goes
+    through `limiter`. Everything else (attributes, private methods) is passed
+    straight through, and retries done inside a method count as one call.
+    """
+    def __init__(self, client, limiter):
+        self._wrapped_client = client
+        self._limiter = limiter
+
+    def __getattr__(self, name):
+        attr = getattr(self._wrapped_client, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        @wraps(attr)
+        def limited(*args, **kwargs):
+            """
+            Call the client's method once the limiter lets us.
+            """
+            with self._limiter.limit():
+                return attr(*args, **kwargs)
+        return limited